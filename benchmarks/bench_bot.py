@@ -0,0 +1,451 @@
+"""
+Offline load test for the bot's command handlers.
+
+Starts local stub servers for OpenRouter (JSON and SSE) and Google Custom Search, swaps
+yt-dlp and FFmpeg for fakes, then feeds synthetic messages through the real on_message and
+discord.py's command pipeline (get_context, argument conversion, checks, invoke hooks) at a
+fixed rate and reports per-command latency, throughput and event-loop lag. No Discord
+connection or network access is needed.
+
+    python benchmarks/bench_bot.py [--rate 50] [--duration 20] [--users 50] [--channels 5]
+
+The stub serves --backends models (stub-0, stub-1, ...). --fail-rate and --slow-rate inject
+errors (503/429) and slow answers into stub-0 only, to exercise hedging and failover.
+"""
+import argparse
+import asyncio
+import contextlib
+import itertools
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import types
+
+from aiohttp import web
+from discord.ext import commands
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+ids = itertools.count(10**17)
+WORDS = ("the quick brown fox jumps over lazy dog music play queue song tonight anyone "
+         "wanna join voice later lol haha okay sure thanks bro").split()
+
+
+# -------------------- STUB UPSTREAM SERVERS --------------------
+def make_stub_app(args):
+    async def chat(request):
+        body = await request.json()
+        if body.get("model") == "stub-0":
+            roll = random.random()
+            if roll < args.fail_rate:
+                return web.json_response({"error": "injected failure"}, status=random.choice((429, 503)))
+            if roll < args.fail_rate + args.slow_rate:
+                await asyncio.sleep(args.slow_latency)
+        await asyncio.sleep(args.ai_latency)
+        words = [random.choice(WORDS) for _ in range(args.reply_words)]
+        if not body.get("stream"):
+            reply = {"choices": [{"message": {"role": "assistant", "content": " ".join(words)}}]}
+            return web.json_response(reply)
+        resp = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        try:
+            await resp.prepare(request)
+            await resp.write(b": OPENROUTER PROCESSING\n\n")
+            for word in words:
+                event = {"choices": [{"delta": {"content": word + " "}}]}
+                await resp.write(f"data: {json.dumps(event)}\n\n".encode())
+                await asyncio.sleep(args.token_interval)
+            await resp.write(b"data: [DONE]\n\n")
+        except ConnectionResetError:
+            pass  # the bot hung up, e.g. on the losing side of a hedged request
+        return resp
+
+    async def search(request):
+        await asyncio.sleep(args.search_latency)
+        query = request.query.get("q", "")
+        items = [{"link": f"https://images.example/{abs(hash(query))}/{i}.png"} for i in range(10)]
+        return web.json_response({"items": items})
+
+    app = web.Application()
+    app.router.add_post("/chat/completions", chat)
+    app.router.add_get("/customsearch", search)
+    return app
+
+
+def start_stub_server(args):
+    """Run the stubs on their own thread and loop so they don't skew the bot's loop lag."""
+    ready = threading.Event()
+    state = {}
+
+    def run():
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        runner = web.AppRunner(make_stub_app(args))
+        loop.run_until_complete(runner.setup())
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        loop.run_until_complete(site.start())
+        state["port"] = site._server.sockets[0].getsockname()[1]
+        state["loop"], state["runner"] = loop, runner
+        ready.set()
+        loop.run_forever()
+        loop.run_until_complete(runner.cleanup())
+
+    thread = threading.Thread(target=run, name="stub-server", daemon=True)
+    thread.start()
+    ready.wait()
+    return state
+
+
+class FakeYoutubeDL:
+    latency = 0.3
+
+    def __init__(self, options):
+        self.options = options
+
+    def extract_info(self, target, download=False):
+        time.sleep(self.latency)
+        if self.options.get("extract_flat") and "list=" in target:
+            entries = [{"url": f"https://video.example/watch?v={target[-4:]}{i}", "title": f"track {i}", "duration": 180}
+                       for i in range(25)]
+            return {"title": "bench playlist", "entries": entries}
+        title = target.split(":", 1)[-1]
+        entry = {
+            "title": title,
+            "url": f"https://media.example/{abs(hash(title))}.webm?expire={int(time.time()) + 6 * 3600}",
+            "duration": 180,
+        }
+        return {"entries": [entry]}
+
+
+# -------------------- FAKE DISCORD OBJECTS --------------------
+class FakeMessage:
+    def __init__(self, content="", author=None, channel=None, guild=None, embed=None):
+        self.id = next(ids)
+        self.content = content
+        self.author = author
+        self.channel = channel
+        self.guild = guild
+        self.embed = embed
+        self.mentions = []
+        self.reference = None
+        self.attachments = []
+
+    async def edit(self, content=None, **kwargs):
+        await asyncio.sleep(FakeChannel.send_latency)
+        self.content = content
+
+    async def delete(self):
+        await asyncio.sleep(FakeChannel.send_latency)
+
+    async def pin(self):
+        await asyncio.sleep(FakeChannel.send_latency)
+
+    async def unpin(self):
+        await asyncio.sleep(FakeChannel.send_latency)
+
+
+class FakeChannel:
+    send_latency = 0.05
+
+    def __init__(self, guild):
+        self.id = next(ids)
+        self.guild = guild
+        self.recent = []
+        self.sent = 0
+
+    async def send(self, content=None, embed=None, **kwargs):
+        await asyncio.sleep(self.send_latency)
+        self.sent += 1
+        return FakeMessage(content or "", channel=self, guild=self.guild, embed=embed)
+
+    @contextlib.asynccontextmanager
+    async def _typing(self):
+        yield
+
+    def typing(self):
+        return self._typing()
+
+    async def pins(self, limit=50, oldest_first=False):
+        await asyncio.sleep(self.send_latency)
+        return
+        yield  # an async iterator, like discord.py's, that finds no pins
+
+    async def history(self, limit=50):
+        for message in reversed(self.recent[-limit:]):
+            yield message
+
+
+class FakeVoiceClient:
+    track_seconds = 2.0
+
+    def __init__(self, channel):
+        self.channel = channel
+        self.connected = True
+        self.handle = None
+        self.after = None
+        self.paused = False
+
+    def is_connected(self):
+        return self.connected
+
+    def is_playing(self):
+        return self.handle is not None and not self.paused
+
+    def is_paused(self):
+        return self.paused
+
+    def play(self, source, after=None):
+        self.after = after
+        self.handle = asyncio.get_running_loop().call_later(self.track_seconds, self._finish)
+
+    def _finish(self):
+        after, self.after, self.handle = self.after, None, None
+        if after:
+            after(None)
+
+    def stop(self):
+        if self.handle:
+            self.handle.cancel()
+            self._finish()
+
+    def pause(self):
+        self.paused = True
+
+    def resume(self):
+        self.paused = False
+
+    async def move_to(self, channel):
+        self.channel = channel
+
+    async def disconnect(self, force=False):
+        self.connected = False
+        self.stop()
+        self.channel.guild.voice_client = None
+
+
+class FakeVoiceChannel:
+    def __init__(self, guild):
+        self.id = next(ids)
+        self.guild = guild
+
+    async def connect(self):
+        await asyncio.sleep(FakeChannel.send_latency)
+        self.guild.voice_client = FakeVoiceClient(self)
+        return self.guild.voice_client
+
+
+class FakeGuild:
+    def __init__(self):
+        self.id = next(ids)
+        self.voice_client = None
+        self.voice_channel = FakeVoiceChannel(self)
+
+
+class FakeUser:
+    def __init__(self, guild):
+        self.id = next(ids)
+        self.name = f"user{self.id % 10000}"
+        self.mention = f"<@{self.id}>"
+        self.bot = False
+        self.voice = types.SimpleNamespace(channel=guild.voice_channel)
+        self.guild_permissions = types.SimpleNamespace(manage_guild=True, manage_messages=True)
+
+
+class BenchContext(commands.Context):
+    """discord.py's Context, except that typing() uses the fake channel instead of the HTTP API."""
+
+    def typing(self, *, ephemeral=False):
+        return self.channel.typing()
+
+
+# -------------------- WORKLOAD --------------------
+def sentence(rng, low=3, high=15):
+    return " ".join(rng.choices(WORDS, k=rng.randint(low, high)))
+
+WORKLOAD = {
+    # kind: (weight, message text factory)
+    "chatter": (50, lambda rng: sentence(rng)),
+    "moderated": (3, lambda rng: sentence(rng) + " b1tch"),
+    "ask": (10, lambda rng: "*ask " + sentence(rng)),
+    "roleplay": (5, lambda rng: "*roleplay " + sentence(rng)),
+    "Rprompt": (2, lambda rng: "*Rprompt a pirate who loves " + rng.choice(WORDS)),
+    "recall": (3, lambda rng: "*recall 5"),
+    "search": (2, lambda rng: "*recall search " + " ".join(rng.sample(WORDS, 2))),
+    "image": (5, lambda rng: "*image " + rng.choice(WORDS)),
+    "play": (4, lambda rng: "*play " + rng.choice(WORDS)),
+    "multiplay": (1, lambda rng: "*play " + " | ".join(rng.sample(WORDS, 4))),
+    "playlist": (1, lambda rng: f"*play https://video.example/playlist?list=PL{rng.randrange(10**4):04d}"),
+    "queue": (3, lambda rng: "*queue"),
+    "choose": (5, lambda rng: "*choose " + " or ".join(rng.sample(WORDS, 3))),
+    "pinlist": (2, lambda rng: "*pinlist"),
+}
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+async def monitor_loop_lag(samples, interval=0.01):
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        samples.append(time.perf_counter() - started - interval)
+
+
+async def run_benchmark(args, main):
+    rng = random.Random(args.seed)
+    guilds = [FakeGuild() for _ in range(max(1, args.channels // 2))]
+    channels = [FakeChannel(guilds[i % len(guilds)]) for i in range(args.channels)]
+    users = [FakeUser(rng.choice(guilds)) for _ in range(args.users)]
+
+    # the command pipeline needs a running loop and a bot user, normally set up at login
+    await main.bot._async_setup_hook()
+    main.bot._connection.user = types.SimpleNamespace(id=next(ids), bot=True)
+    FakeMessage._state = main.bot._connection
+    command_errors = []
+
+    async def process_commands(message):
+        # Bot.process_commands, but with a Context that stays offline
+        ctx = await main.bot.get_context(message, cls=BenchContext)
+        await main.bot.invoke(ctx)
+        if ctx.command_failed:
+            raise RuntimeError(f"*{ctx.command} failed")
+
+    async def on_command_error(ctx, error):
+        command_errors.append(error)
+        if len(command_errors) == 1:
+            print(f"  first command error: {error!r}")
+
+    main.bot.process_commands = process_commands
+    main.bot.add_listener(on_command_error)
+
+    kinds = list(WORKLOAD)
+    weights = [WORKLOAD[k][0] for k in kinds]
+    latencies = {kind: [] for kind in kinds}
+    errors = {kind: 0 for kind in kinds}
+
+    async def handle(kind, message):
+        started = time.perf_counter()
+        try:
+            await main.on_message(message)
+        except Exception as e:
+            errors[kind] += 1
+            if errors[kind] == 1:
+                print(f"  {kind} failed: {e!r}")
+        latencies[kind].append(time.perf_counter() - started)
+
+    lag = []
+    lag_task = asyncio.create_task(monitor_loop_lag(lag))
+    tasks = set()
+    interval = 1.0 / args.rate
+    started = time.perf_counter()
+    sent = 0
+    while time.perf_counter() - started < args.duration:
+        kind = rng.choices(kinds, weights)[0]
+        channel = rng.choice(channels)
+        author = rng.choice(users)
+        message = FakeMessage(WORKLOAD[kind][1](rng), author=author, channel=channel, guild=channel.guild)
+        channel.recent.append(message)
+        del channel.recent[:-50]
+        task = asyncio.create_task(handle(kind, message))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+        sent += 1
+        # open-loop arrivals: schedule against the clock, not against completions
+        await asyncio.sleep(max(0.0, started + sent * interval - time.perf_counter()))
+    offered = time.perf_counter() - started
+    if tasks:
+        await asyncio.wait(tasks, timeout=args.drain_timeout)
+    elapsed = time.perf_counter() - started
+    lag_task.cancel()
+
+    print(f"\n{sent} messages offered at {sent / offered:.1f} msg/s over {offered:.1f}s "
+          f"({len(tasks)} still running after drain)\n")
+    print(f"{'command':<10} {'count':>6} {'err':>4} {'p50 ms':>9} {'p99 ms':>9} {'max ms':>9} {'done/s':>8}")
+    for kind in kinds:
+        values = latencies[kind]
+        if not values and not errors[kind]:
+            continue
+        print(f"{kind:<10} {len(values):>6} {errors[kind]:>4} {1000 * percentile(values, 50):>9.1f} "
+              f"{1000 * percentile(values, 99):>9.1f} {1000 * max(values, default=0):>9.1f} {len(values) / elapsed:>8.1f}")
+    if command_errors:
+        print(f"\n{len(command_errors)} command error(s) reported by discord.py")
+    print(f"\nevent-loop lag: p50 {1000 * percentile(lag, 50):.2f} ms, p99 {1000 * percentile(lag, 99):.2f} ms, "
+          f"max {1000 * max(lag, default=0):.2f} ms")
+    for name in ("http_client", "ai_scheduler", "ai_backends", "resolver", "image_cache", "dispatcher"):
+        subsystem = getattr(main, name, None)
+        if subsystem is not None and hasattr(subsystem, "stats"):
+            print(f"{name}: {subsystem.stats()}")
+
+    for player in list(main.players.values()):
+        await player.stop()
+    await main.http_client.close()
+
+
+def bench():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rate", type=float, default=50, help="messages per second")
+    parser.add_argument("--duration", type=float, default=20, help="seconds of traffic")
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--channels", type=int, default=6)
+    parser.add_argument("--ai-latency", type=float, default=0.5, help="stub AI time to first byte")
+    parser.add_argument("--token-interval", type=float, default=0.01, help="stub AI delay between SSE chunks")
+    parser.add_argument("--reply-words", type=int, default=60)
+    parser.add_argument("--backends", type=int, default=2, help="AI models served by the stub")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="share of stub-0 requests answered 429/503")
+    parser.add_argument("--slow-rate", type=float, default=0.0, help="share of stub-0 requests delayed by --slow-latency")
+    parser.add_argument("--slow-latency", type=float, default=8.0)
+    parser.add_argument("--search-latency", type=float, default=0.2)
+    parser.add_argument("--ytdl-latency", type=float, default=0.3)
+    parser.add_argument("--send-latency", type=float, default=0.05, help="simulated Discord REST latency")
+    parser.add_argument("--track-seconds", type=float, default=2.0)
+    parser.add_argument("--drain-timeout", type=float, default=30)
+    parser.add_argument("--rate-limits", action="store_true", help="keep the AI and Discord send rate limits")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    stub = start_stub_server(args)
+    base = f"http://127.0.0.1:{stub['port']}"
+    os.environ.update({
+        "OPENROUTER_URL": f"{base}/chat/completions",
+        "GOOGLE_SEARCH_URL": f"{base}/customsearch",
+        "GOOGLE_API_KEY": "bench",
+        "GOOGLE_CSE_ID": "bench",
+        "AI_API_KEY": "bench",
+        "AI_BACKENDS": ",".join(f"stub-{i}" for i in range(args.backends)),
+        "LOG_CONSOLE_LEVEL": "WARNING",
+    })
+    # keep the memory store, logs and caches out of the working tree
+    os.chdir(tempfile.mkdtemp(prefix="binky-bench-"))
+    import main
+
+    main.yt_dlp = types.SimpleNamespace(YoutubeDL=FakeYoutubeDL)
+    async def fake_audio_source(track, guild_id, volume=1.0):
+        return types.SimpleNamespace(cleanup=lambda: None)
+    main.create_audio_source = fake_audio_source
+    FakeYoutubeDL.latency = args.ytdl_latency
+    FakeChannel.send_latency = args.send_latency
+    FakeVoiceClient.track_seconds = args.track_seconds
+    if not args.rate_limits:
+        main.AI_RATE_USER = main.AI_RATE_CHANNEL = main.AI_RATE_GUILD = (1e9, 10**9)
+        main.SEND_RATE_CHANNEL = (1e9, 10**9)
+        main.dispatcher.global_bucket = main.TokenBucket(1e9, 10**9)
+    main.load_memory()
+
+    try:
+        asyncio.run(run_benchmark(args, main))
+    finally:
+        main.save_memory()
+        main.memory_store.close()
+        stub["loop"].call_soon_threadsafe(stub["loop"].stop)
+
+
+if __name__ == "__main__":
+    bench()
@@ -0,0 +1,61 @@
+"""
+Microbenchmark for the on_message banned-word filter.
+
+Runs the compiled single-pattern filter against the old per-word regex loop over a
+synthetic corpus and prints throughput per message.
+
+    python benchmarks/bench_moderation.py [--messages 20000]
+"""
+import argparse
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+# keep the memory store, logs and caches out of the working tree
+os.chdir(tempfile.mkdtemp(prefix="binky-bench-"))
+import main  # noqa: E402
+
+WORDS = ("the quick brown fox jumps over lazy dog music play queue song tonight anyone "
+         "wanna join voice later lol haha okay sure thanks bro pin this message please").split()
+OBFUSCATED = ["b1tch", "biiiitch", "b\u200bitch", "1d10t", "g@go", "B0B0", "tanginaaa"]
+
+
+def make_corpus(count: int, dirty_ratio: float = 0.05, seed: int = 7):
+    rng = random.Random(seed)
+    corpus = []
+    for _ in range(count):
+        words = rng.choices(WORDS, k=rng.randint(3, 40))
+        if rng.random() < dirty_ratio:
+            words.insert(rng.randrange(len(words) + 1), rng.choice(OBFUSCATED + main.DEFAULT_BANNED_WORDS))
+        corpus.append(" ".join(words))
+    return corpus
+
+
+def legacy_search(text: str):
+    lower = text.lower()
+    return any(re.search(rf"\b{re.escape(word)}\b", lower, re.IGNORECASE) for word in main.DEFAULT_BANNED_WORDS)
+
+
+def run(name: str, fn, corpus):
+    started = time.perf_counter()
+    hits = sum(1 for text in corpus if fn(text))
+    elapsed = time.perf_counter() - started
+    print(f"{name:<10} {len(corpus) / elapsed:>12,.0f} msg/s  {1e6 * elapsed / len(corpus):>8.2f} us/msg  {hits} hits")
+
+
+def bench():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--messages", type=int, default=20000)
+    args = parser.parse_args()
+
+    corpus = make_corpus(args.messages)
+    run("legacy", legacy_search, corpus)
+    run("compiled", lambda text: main.moderation.search(None, text), corpus)
+
+
+if __name__ == "__main__":
+    bench()
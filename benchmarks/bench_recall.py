@@ -0,0 +1,84 @@
+"""
+Long-term memory benchmark: embedding throughput and query latency of one slot's index.
+
+Fills a RecallIndex with synthetic roleplay turns, plants a few distinctive facts among
+them, then times queries and checks the facts come back in the top k. Uses NumPy when
+it is installed; --no-numpy times the pure-Python scorer instead.
+
+    python benchmarks/bench_recall.py [--turns 100000] [--queries 200] [--no-numpy]
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+# keep the memory store, logs and caches out of the working tree
+os.chdir(tempfile.mkdtemp(prefix="binky-bench-"))
+import main  # noqa: E402
+
+WORDS = ("sword castle dragon forest tavern king queen river mountain ship storm gold knight "
+         "spell potion village road night fire wolf blade shield armor quest map inn bard").split()
+FACTS = [
+    ("My dog's name is Biscuit and he chases squirrels", "what was my dog called again"),
+    ("I was born in a lighthouse on the northern coast", "where was I born"),
+    ("My favourite food is spicy ramen with extra egg", "what food do I like best"),
+    ("The password to the secret vault is moonflower", "what is the vault password"),
+]
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+def bench():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--turns", type=int, default=100000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--no-numpy", action="store_true", help="score in pure Python even if NumPy is installed")
+    args = parser.parse_args()
+
+    if args.no_numpy:
+        main._numpy = None
+    rng = random.Random(7)
+    texts = [" ".join(rng.choices(WORDS, k=rng.randint(8, 40))) for _ in range(args.turns)]
+    planted = {}
+    for fact, _ in FACTS:
+        i = rng.randrange(args.turns // 2)  # well outside the recent window
+        texts[i] = fact
+        planted[fact] = i
+
+    started = time.perf_counter()
+    vectors = main.embed_texts(texts)
+    embed_seconds = time.perf_counter() - started
+
+    index = main.RecallIndex(args.turns)
+    for text, vector in zip(texts, vectors):
+        index.add(main.Turn("user", text), vector)
+
+    latencies = []
+    for q in range(args.queries):
+        query = FACTS[q % len(FACTS)][1] if q % 2 else " ".join(rng.choices(WORDS, k=12))
+        started = time.perf_counter()
+        recollection = main.Recollection(index.turns, index.scores(main.embed_texts([query])[0]))
+        recollection.top(skip_recent=40)
+        latencies.append(time.perf_counter() - started)
+
+    found = 0
+    for fact, question in FACTS:
+        recollection = main.Recollection(index.turns, index.scores(main.embed_texts([question])[0]))
+        found += any(turn.content == fact for turn in recollection.top(skip_recent=40))
+
+    print(f"{args.turns} turns, embedder {main.long_memory.stats()['embedder']}, "
+          f"scorer {'numpy' if main.load_numpy() else 'pure python'}")
+    print(f"embed     {args.turns / embed_seconds:,.0f} turns/s")
+    print(f"query     p50 {1000 * statistics.median(latencies):.1f} ms, p99 {1000 * percentile(latencies, 99):.1f} ms")
+    print(f"recall@{main.LONG_MEMORY_TOP_K}  {found}/{len(FACTS)} planted facts found")
+
+
+if __name__ == "__main__":
+    bench()
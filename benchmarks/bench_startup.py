@@ -0,0 +1,82 @@
+"""
+Cold-start benchmark: how long main.py takes to import, and (with --live) to reach READY.
+
+Each run is a fresh interpreter in a scratch directory, so nothing is cached between runs.
+Prints the median of every startup phase main.py records with mark_startup().
+
+    python benchmarks/bench_startup.py [--runs 5] [--live]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+IMPORT_ONLY = """
+import json, sys
+sys.path.insert(0, {root!r})
+import main
+main.log_listener.stop()
+print("PHASES " + json.dumps(main.startup_phases))
+"""
+
+LIVE = """
+import json, sys
+sys.path.insert(0, {root!r})
+import main
+
+@main.bot.listen("on_ready")
+async def _report():
+    if not main.startup_logged:
+        main.log_startup_timing()
+    print("PHASES " + json.dumps(main.startup_phases), flush=True)
+    await main.bot.close()
+
+main.bot.run(main.DISCORD_TOKEN, log_handler=None)
+main.log_listener.stop()
+"""
+
+
+def run_once(code: str, timeout: float):
+    started = time.perf_counter()
+    out = subprocess.run(
+        [sys.executable, "-c", code.format(root=ROOT)],
+        cwd=tempfile.mkdtemp(prefix="binky-startup-"),
+        env=dict(os.environ, LOG_CONSOLE_LEVEL="ERROR"),
+        capture_output=True, text=True, timeout=timeout,
+    )
+    wall = time.perf_counter() - started
+    for line in out.stdout.splitlines():
+        if line.startswith("PHASES "):
+            return wall, json.loads(line[len("PHASES "):])
+    raise RuntimeError(f"run failed (exit {out.returncode}):\n{out.stderr[-2000:]}")
+
+
+def bench():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--live", action="store_true", help="log in with DISCORD_TOKEN and time until READY")
+    parser.add_argument("--timeout", type=float, default=120)
+    args = parser.parse_args()
+
+    code = LIVE if args.live else IMPORT_ONLY
+    walls, phases = [], {}
+    for _ in range(args.runs):
+        wall, recorded = run_once(code, args.timeout)
+        walls.append(wall)
+        for phase, seconds in recorded:
+            phases.setdefault(phase, []).append(seconds)
+
+    print(f"{'phase':<22} {'median ms':>10} {'max ms':>10}")
+    for phase, values in phases.items():
+        print(f"{phase:<22} {1000 * statistics.median(values):>10.1f} {1000 * max(values):>10.1f}")
+    print(f"{'process wall time':<22} {1000 * statistics.median(walls):>10.1f} {1000 * max(walls):>10.1f}")
+
+
+if __name__ == "__main__":
+    bench()
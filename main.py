@@ -1,138 +1,1380 @@
+import time
+STARTUP_STARTED = time.perf_counter()
+
 import discord
 from discord.ext import commands
 import logging
+import logging.handlers
+import queue
+import gzip
+import shutil
 from dotenv import load_dotenv
 import os
 import asyncio
-import yt_dlp
 import random
 import re
 import aiohttp
 import json
-import requests
-
+import contextvars
+import traceback
+import sys
+import datetime
+import contextlib
+from collections import OrderedDict, deque
+from urllib.parse import parse_qs, urlsplit
+import sqlite3
+import hashlib
+import shlex
+import array
+import heapq
+import math
+import zlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+# startup timing: (phase, seconds) in order, logged once the bot is READY
+startup_phases = []
+_startup_mark = STARTUP_STARTED
+
+def mark_startup(phase: str):
+    global _startup_mark
+    now = time.perf_counter()
+    startup_phases.append((phase, now - _startup_mark))
+    _startup_mark = now
+
+mark_startup("imports")
 
 # -------------------- ENVIRONMENT --------------------
-load_dotenv()
+# the .env next to main.py wins; otherwise search upwards from the working directory
+dotenv_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".env")
+load_dotenv(dotenv_path if os.path.exists(dotenv_path) else None)
 DISCORD_TOKEN = os.getenv("DISCORD_TOKEN")
 AI_API_KEY = os.getenv("AI_API_KEY")  # OpenRouter key
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
 GOOGLE_CSE_ID = os.getenv("GOOGLE_CSE_ID")
 
+# upstream endpoints (point these at a local fake server to test without network access)
+OPENROUTER_URL = os.getenv("OPENROUTER_URL", "https://openrouter.ai/api/v1/chat/completions")
+GOOGLE_SEARCH_URL = os.getenv("GOOGLE_SEARCH_URL", "https://www.googleapis.com/customsearch/v1")
 
-if not GOOGLE_API_KEY or not GOOGLE_CSE_ID:
-    print("⚠️ Google API key or CSE ID is missing. Please set them in your .env file.")
-else:
-    print("✅ Google API key and CSE ID loaded successfully!")
-    print("GOOGLE_CSE_ID:", GOOGLE_CSE_ID)
-
+# -------------------- LOGGING SETUP --------------------
+LOG_FILE = os.getenv("LOG_FILE", "discord.log")
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", str(5 * 1024 * 1024)))  # size-based rotation
+LOG_ROTATE_WHEN = os.getenv("LOG_ROTATE_WHEN", "")  # e.g. "midnight" to rotate by time instead of size
+LOG_BACKUPS = int(os.getenv("LOG_BACKUPS", "5"))
+LOG_JSON = os.getenv("LOG_JSON", "0") == "1"         # one JSON object per line in the log file
+LOG_CONSOLE_LEVEL = os.getenv("LOG_CONSOLE_LEVEL", "INFO")
+# per-logger levels; gateway payload dumps (discord.gateway DEBUG) stay off unless asked for
+LOG_LEVELS = os.getenv("LOG_LEVELS", "binky=DEBUG,discord=INFO,discord.gateway=WARNING")
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record, "%Y-%m-%dT%H:%M:%S"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+def _gzip_rotator(source, dest):
+    with open(source, "rb") as f_in, gzip.open(dest, "wb") as f_out:
+        shutil.copyfileobj(f_in, f_out)
+    os.remove(source)
+
+def setup_logging():
+    """
+    Route the bot's and discord.py's logs through a queue so file I/O (and rotation
+    with gzip compression) happens on the listener thread, not the event loop.
+    Safe to call more than once; handlers are only attached the first time.
+    """
+    global log_listener
+    if log_listener is not None:
+        return log_listener
 
+    if LOG_ROTATE_WHEN:
+        file_handler = logging.handlers.TimedRotatingFileHandler(
+            LOG_FILE, when=LOG_ROTATE_WHEN, backupCount=LOG_BACKUPS, encoding="utf-8")
+    else:
+        file_handler = logging.handlers.RotatingFileHandler(
+            LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUPS, encoding="utf-8")
+    file_handler.rotator = _gzip_rotator
+    file_handler.namer = lambda name: name + ".gz"
 
-    #-------------------Force explicit path workaround for the env issue---------------------
-dotenv_path = os.path.join(os.path.dirname(__file__), '.env')
-load_dotenv(dotenv_path)
+    console_handler = logging.StreamHandler()
+    console_handler.setLevel(LOG_CONSOLE_LEVEL.upper())
 
-print("DEBUG: Current working directory:", os.getcwd())
-print("DEBUG: .env path:", dotenv_path)
-print("DEBUG: GOOGLE_API_KEY =", os.getenv("GOOGLE_API_KEY"))
-print("DEBUG: GOOGLE_CSE_ID =", os.getenv("GOOGLE_CSE_ID"))
+    formatter = logging.Formatter("[%(asctime)s] [%(levelname)-8s] %(name)s: %(message)s", "%Y-%m-%d %H:%M:%S")
+    file_handler.setFormatter(JsonFormatter() if LOG_JSON else formatter)
+    console_handler.setFormatter(formatter)
 
+    log_queue = queue.SimpleQueue()
+    log_listener = logging.handlers.QueueListener(log_queue, file_handler, console_handler, respect_handler_level=True)
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    for name in ("binky", "discord"):
+        logging.getLogger(name).addHandler(queue_handler)
+        logging.getLogger(name).propagate = False
 
+    for item in LOG_LEVELS.split(","):
+        name, _, level = item.partition("=")
+        if name.strip() and level.strip():
+            logging.getLogger(name.strip()).setLevel(level.strip().upper())
 
+    log_listener.start()
+    return log_listener
 
-# -------------------- LOGGING SETUP --------------------
 
+log_listener = None
+setup_logging()
+logger = logging.getLogger("binky")
 
+if not GOOGLE_API_KEY or not GOOGLE_CSE_ID:
+    logger.warning("Google API key or CSE ID is missing. Please set them in your .env file.")
+mark_startup("config and logging")
+
+# -------------------- FILES --------------------
+def atomic_write(path: str, payload: str):
+    """Replace path with payload in one step, so a crash never leaves half a file behind."""
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(payload)
+    os.replace(tmp, path)
+
+# -------------------- HTTP CLIENT --------------------
+HTTP_POOL_LIMIT = int(os.getenv("HTTP_POOL_LIMIT", "100"))          # total open connections
+HTTP_POOL_LIMIT_PER_HOST = int(os.getenv("HTTP_POOL_LIMIT_PER_HOST", "10"))
+HTTP_KEEPALIVE_SECONDS = float(os.getenv("HTTP_KEEPALIVE_SECONDS", "60"))
+HTTP_DNS_CACHE_SECONDS = int(os.getenv("HTTP_DNS_CACHE_SECONDS", "300"))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "10"))
+HTTP_TOTAL_TIMEOUT = float(os.getenv("HTTP_TOTAL_TIMEOUT", "30"))
+
+class HttpClient:
+    """
+    One pooled aiohttp session for the lifetime of the bot.
 
-if not os.path.exists("discord.log"):
-    with open("discord.log", "w", encoding="utf-8"):
-        pass
+    Connections to openrouter.ai / googleapis.com are kept alive and reused across
+    commands instead of paying DNS + TCP + TLS setup on every call. Keeps simple
+    counters so pool saturation shows up in stats().
+    """
 
-logger = logging.getLogger("binky")
-logger.setLevel(logging.DEBUG)
+    def __init__(self):
+        self.session = None
+        self.in_flight = {}         # host -> requests currently holding a connection
+        self.requests = 0
+        self.errors = 0
+        self.saturated = 0          # requests that started while their host's pool was full
+        self.connections_created = 0
+        self.connections_reused = 0
+        self.total_seconds = 0.0
+
+    async def start(self):
+        if self.session is not None and not self.session.closed:
+            return
+        trace = aiohttp.TraceConfig()
+        trace.on_connection_create_end.append(self._on_connection_created)
+        trace.on_connection_reuseconn.append(self._on_connection_reused)
+        connector = aiohttp.TCPConnector(
+            limit=HTTP_POOL_LIMIT,
+            limit_per_host=HTTP_POOL_LIMIT_PER_HOST,
+            keepalive_timeout=HTTP_KEEPALIVE_SECONDS,
+            ttl_dns_cache=HTTP_DNS_CACHE_SECONDS,
+            use_dns_cache=True,
+        )
+        self.session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=HTTP_TOTAL_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+            trace_configs=[trace],
+        )
+        logger.info("HTTP client started (limit=%d, per host=%d)", HTTP_POOL_LIMIT, HTTP_POOL_LIMIT_PER_HOST)
+
+    async def close(self):
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+            logger.info("HTTP client closed. %s", self.stats())
+        self.session = None
+
+    async def _on_connection_created(self, session, ctx, params):
+        self.connections_created += 1
+
+    async def _on_connection_reused(self, session, ctx, params):
+        self.connections_reused += 1
+
+    @contextlib.asynccontextmanager
+    async def request(self, method: str, url: str, **kwargs):
+        """Like session.request(), but on the shared pool and with metrics."""
+        if self.session is None or self.session.closed:
+            # commands can run before setup_hook in odd reconnect paths; never fail for that
+            await self.start()
+        host = urlsplit(url).hostname or ""
+        if self.in_flight.get(host, 0) >= HTTP_POOL_LIMIT_PER_HOST:
+            self.saturated += 1
+            logger.debug("HTTP pool for %s is saturated (%d in flight)", host, self.in_flight[host])
+        self.in_flight[host] = self.in_flight.get(host, 0) + 1
+        self.requests += 1
+        started = time.perf_counter()
+        try:
+            async with self.session.request(method, url, **kwargs) as resp:
+                yield resp
+        except Exception:
+            self.errors += 1
+            raise
+        finally:
+            self.in_flight[host] -= 1
+            elapsed = time.perf_counter() - started
+            self.total_seconds += elapsed
+            record_phase("upstream", elapsed)
+
+    def get(self, url: str, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url: str, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def stats(self) -> dict:
+        return {
+            "requests": self.requests,
+            "errors": self.errors,
+            "in_flight": sum(self.in_flight.values()),
+            "saturated": self.saturated,
+            "connections_created": self.connections_created,
+            "connections_reused": self.connections_reused,
+            "avg_ms": round(1000 * self.total_seconds / self.requests, 1) if self.requests else 0.0,
+        }
+
+
+http_client = HttpClient()
+
+# -------------------- SHARDING --------------------
+# SHARD_MODE: "" runs one plain Bot, "auto" runs an AutoShardedBot in this process,
+# "cluster" is set by the cluster launcher on each worker it starts.
+SHARD_MODE = os.getenv("SHARD_MODE", "")
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", "0")) or None
+SHARD_IDS = [int(x) for x in os.getenv("SHARD_IDS", "").split(",") if x.strip()] or None
+WORKER_ID = os.getenv("WORKER_ID", "")
+CLUSTER_WORKERS = int(os.getenv("CLUSTER_WORKERS", "0"))  # > 0 turns `python main.py` into the cluster launcher
+CLUSTER_DIR = os.getenv("CLUSTER_DIR", "cluster")         # workers write health files here
+HEALTH_INTERVAL = 30                                      # seconds between worker health reports
+WORKER_STABLE_SECONDS = 300                               # a worker up this long starts its restart backoff over
+
+def shard_ranges(shard_count: int, workers: int) -> list:
+    """Split shard ids 0..shard_count-1 into contiguous ranges, one per worker."""
+    workers = max(1, min(workers, shard_count))
+    size, extra = divmod(shard_count, workers)
+    ranges, start = [], 0
+    for i in range(workers):
+        end = start + size + (1 if i < extra else 0)
+        ranges.append(list(range(start, end)))
+        start = end
+    return ranges
+
+def worker_env(worker_id: int, ranges: list, shard_count: int) -> dict:
+    """Environment for cluster worker worker_id, which runs the shards in ranges[worker_id]."""
+    env = dict(os.environ)
+    env.pop("CLUSTER_WORKERS", None)
+    quota = int(env.get("GOOGLE_DAILY_QUOTA", "100"))
+    metrics_port = int(env.get("METRICS_PORT", "0"))
+    audio_cache_dir = env.get("AUDIO_CACHE_DIR", "")
+    audio_cache_mb = int(env.get("AUDIO_CACHE_MAX_MB", "2048"))
+    env.update({
+        "SHARD_MODE": "cluster",
+        "SHARD_COUNT": str(shard_count),
+        "SHARD_IDS": ",".join(map(str, ranges[worker_id])),
+        "WORKER_ID": str(worker_id),
+        # per-worker files for anything that is rewritten whole
+        "LOG_FILE": f"discord.{worker_id}.log",
+        "IMAGE_CACHE_FILE": f"image_cache.{worker_id}.json",
+        "GOOGLE_DAILY_QUOTA": str(quota // len(ranges)),
+        "AUDIO_CACHE_DIR": os.path.join(audio_cache_dir, f"worker-{worker_id}") if audio_cache_dir else "",
+        "AUDIO_CACHE_MAX_MB": str(audio_cache_mb // len(ranges)),
+        # each worker serves its own metrics; they can't all bind one port
+        "METRICS_PORT": str(metrics_port + worker_id) if metrics_port else "0",
+    })
+    return env
+
+async def report_health():
+    """Worker side: write this process's health to CLUSTER_DIR for the launcher to aggregate."""
+    path = os.path.join(CLUSTER_DIR, f"worker-{WORKER_ID}.json")
+    loop = asyncio.get_running_loop()
+    while True:
+        latencies = {str(shard_id): round(latency, 3) for shard_id, latency in getattr(bot, "latencies", [])}
+        health = {
+            "worker": WORKER_ID,
+            "pid": os.getpid(),
+            "shards": SHARD_IDS,
+            "ready": bot.is_ready(),
+            "guilds": len(bot.guilds),
+            "latencies": latencies,
+            "players": len(players),
+            "memory_slots": memory_usage()["slots"],
+            "time": time.time(),
+        }
+        try:
+            await loop.run_in_executor(None, atomic_write, path, json.dumps(health))
+        except Exception:
+            logger.exception("Failed to write health file %s", path)
+        await asyncio.sleep(HEALTH_INTERVAL)
+
+def fetch_recommended_shards() -> int:
+    """Ask Discord how many shards this bot should run."""
+    import urllib.request
+    req = urllib.request.Request(
+        "https://discord.com/api/v10/gateway/bot",
+        headers={"Authorization": f"Bot {DISCORD_TOKEN}", "User-Agent": "DiscordBot (binky, 1.0)"},
+    )
+    with urllib.request.urlopen(req, timeout=15) as resp:
+        return int(json.load(resp)["shards"])
 
-file_handler = logging.FileHandler(filename="discord.log", encoding="utf-8", mode="a")
-file_handler.setLevel(logging.DEBUG)
+def run_cluster(workers: int):
+    """
+    Launcher side: start one worker process per shard range, restart workers that die and
+    log the cluster's combined health. Each worker owns its guilds outright, so their
+    conversation memory and music state never live in two processes; workers share only
+    the SQLite memory store, where each reads and writes just its own guilds' channels.
+    The hourly compaction prunes all slots, so only worker 0 runs it.
+    """
+    import subprocess
+
+    shard_count = SHARD_COUNT or fetch_recommended_shards()
+    ranges = shard_ranges(shard_count, workers)
+    os.makedirs(CLUSTER_DIR, exist_ok=True)
+    logger.info("Starting %d worker(s) for %d shard(s): %s", len(ranges), shard_count, ranges)
+
+    def spawn(worker_id: int):
+        env = worker_env(worker_id, ranges, shard_count)
+        return subprocess.Popen([sys.executable, os.path.abspath(__file__)], env=env)
+
+    procs = {i: spawn(i) for i in range(len(ranges))}
+    started = {i: time.monotonic() for i in procs}
+    restarts = {i: 0 for i in procs}
+    restart_at = {}  # worker_id -> monotonic time a dead worker gets replaced
+    next_report = time.monotonic() + HEALTH_INTERVAL
+    try:
+        while True:
+            time.sleep(1)
+            now = time.monotonic()
+            for worker_id, proc in list(procs.items()):
+                if worker_id in restart_at:
+                    if now >= restart_at[worker_id]:
+                        del restart_at[worker_id]
+                        procs[worker_id] = spawn(worker_id)
+                        started[worker_id] = now
+                elif proc.poll() is not None:
+                    if now - started[worker_id] >= WORKER_STABLE_SECONDS:
+                        restarts[worker_id] = 0
+                    restarts[worker_id] += 1
+                    delay = min(60, 2 ** restarts[worker_id])
+                    restart_at[worker_id] = now + delay
+                    logger.warning("Worker %d exited with %s; restarting in %ds (restart #%d)",
+                                   worker_id, proc.returncode, delay, restarts[worker_id])
+            if now < next_report:
+                continue
+            next_report = now + HEALTH_INTERVAL
+            ready = guilds = stale = 0
+            for worker_id in procs:
+                try:
+                    with open(os.path.join(CLUSTER_DIR, f"worker-{worker_id}.json"), "r", encoding="utf-8") as f:
+                        health = json.load(f)
+                except (OSError, ValueError):
+                    stale += 1
+                    continue
+                if time.time() - health.get("time", 0) > 3 * HEALTH_INTERVAL:
+                    stale += 1
+                    continue
+                ready += bool(health.get("ready"))
+                guilds += health.get("guilds", 0)
+            logger.info("Cluster health: %d/%d workers ready, %d stale, %d restarting, %d guilds",
+                        ready, len(procs), stale, len(restart_at), guilds)
+    except KeyboardInterrupt:
+        logger.info("Stopping cluster...")
+    finally:
+        for proc in procs.values():
+            proc.terminate()
+        for proc in procs.values():
+            try:
+                proc.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                proc.kill()
 
-console_handler = logging.StreamHandler()
-console_handler.setLevel(logging.INFO)
+# -------------------- BOT SETUP --------------------
+class BinkyBot(commands.AutoShardedBot if SHARD_MODE else commands.Bot):
+    async def setup_hook(self):
+        mark_startup("login")
+        # the store (and a first-run memory.json migration) opens in the background;
+        # slot lookups queue behind it on the same executor
+        self.loop.run_in_executor(memory_store.executor, load_memory)
+        self.loop.run_in_executor(None, load_tokenizer)
+        image_cache.ensure_loaded()
+        await http_client.start()
+        instrumentation.start()
+        if METRICS_PORT:
+            await start_metrics_server()
+        if WORKER_ID:
+            self.loop.create_task(report_health())
+        check_command_intents(self.intents)
+        mark_startup("setup_hook")
+
+    async def close(self):
+        await super().close()
+        await http_client.close()
+        await instrumentation.stop()
+
+# Lean mode connects with only the intents the commands below need and keeps discord.py's
+# caches to match, instead of the default intents plus members (every member cached,
+# presence/typing/reaction events processed for nothing).
+LEAN_MODE = os.getenv("LEAN_MODE", "1") == "1"
+LEAN_MAX_MESSAGES = int(os.getenv("LEAN_MAX_MESSAGES", "0"))  # message cache size; 0 disables it
+
+# every prefix command needs these; COMMAND_INTENTS lists anything extra per command
+BASE_INTENTS = ("guilds", "guild_messages", "dm_messages", "message_content")
+COMMAND_INTENTS = {
+    "play": ("voice_states",),
+    "pause": ("voice_states",),
+    "resume": ("voice_states",),
+    "skip": ("voice_states",),
+    "stop": ("voice_states",),
+    "loop": ("voice_states",),
+    "queue": ("voice_states",),
+}
 
-formatter = logging.Formatter("[%(asctime)s] [%(levelname)-8s] %(name)s: %(message)s", "%Y-%m-%d %H:%M:%S")
-file_handler.setFormatter(formatter)
-console_handler.setFormatter(formatter)
+def lean_intents() -> discord.Intents:
+    intents = discord.Intents.none()
+    for flag in BASE_INTENTS + tuple(f for flags in COMMAND_INTENTS.values() for f in flags):
+        setattr(intents, flag, True)
+    return intents
+
+def check_command_intents(intents: discord.Intents):
+    """Warn about registered commands whose declared intents are not enabled."""
+    for command in bot.commands:
+        missing = [flag for flag in COMMAND_INTENTS.get(command.name, ()) if not getattr(intents, flag)]
+        if missing:
+            logger.warning("Command %s needs intents %s, which are disabled", command.name, ", ".join(missing))
+
+if LEAN_MODE:
+    intents = lean_intents()
+    bot_options = {
+        # only members in voice channels are needed (music commands check ctx.author.voice)
+        "member_cache_flags": discord.MemberCacheFlags.from_intents(intents),
+        "max_messages": LEAN_MAX_MESSAGES or None,
+        "chunk_guilds_at_startup": False,
+    }
+else:
+    intents = discord.Intents.default()
+    intents.message_content = True
+    intents.members = True
+    bot_options = {}
+if SHARD_MODE:
+    bot_options.update(shard_count=SHARD_COUNT, shard_ids=SHARD_IDS)
+bot = BinkyBot(command_prefix="*", intents=intents, **bot_options)
+
+class GatewayStats:
+    """Counts gateway events by type so *stats can show events per second."""
+
+    def __init__(self):
+        self.counts = {}
+        self.total = 0
+        self.started = time.monotonic()
+        self.window_start = self.started
+        self.window_total = 0
+
+    def record(self, event_type: str):
+        self.counts[event_type] = self.counts.get(event_type, 0) + 1
+        self.total += 1
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        window = now - self.window_start
+        rate = (self.total - self.window_total) / window if window > 0 else 0.0
+        self.window_start, self.window_total = now, self.total
+        top = sorted(self.counts.items(), key=lambda kv: kv[1], reverse=True)[:5]
+        return {
+            "events": self.total,
+            "events_per_s": round(rate, 2),
+            "top": dict(top),
+            "guilds": len(bot.guilds),
+            "users_cached": len(bot.users),
+            "members_cached": sum(len(g.members) for g in bot.guilds),
+            "messages_cached": len(bot.cached_messages),
+        }
+
+
+gateway_stats = GatewayStats()
+
+# -------------------- INSTRUMENTATION --------------------
+LOOP_LAG_INTERVAL = 0.25        # seconds between event-loop lag samples
+LOOP_BLOCK_THRESHOLD = float(os.getenv("LOOP_BLOCK_THRESHOLD", "0.2"))  # seconds; longer stalls get a stack dump
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))  # serve Prometheus text on 127.0.0.1:PORT/metrics when set
+                                                    # (cluster worker N serves on PORT + N)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+class Histogram:
+    """Fixed-bucket latency histogram (seconds), Prometheus-style."""
+
+    __slots__ = ("counts", "count", "total")
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, seconds: float):
+        i = 0
+        while i < len(LATENCY_BUCKETS) and seconds > LATENCY_BUCKETS[i]:
+            i += 1
+        self.counts[i] += 1
+        self.count += 1
+        self.total += seconds
+
+    def percentile(self, pct: float) -> float:
+        """Upper bound of the bucket holding the given percentile."""
+        if not self.count:
+            return 0.0
+        rank = pct / 100 * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank:
+                return LATENCY_BUCKETS[i] if i < len(LATENCY_BUCKETS) else float("inf")
+        return float("inf")
+
+# phase -> seconds for the command running in the current task (None outside commands)
+command_timings = contextvars.ContextVar("command_timings", default=None)
+
+def record_phase(phase: str, seconds: float):
+    """Attribute time spent in a phase (queue_wait, upstream, send) to the running command."""
+    timings = command_timings.get()
+    if timings is not None:
+        timings[phase] = timings.get(phase, 0.0) + seconds
+
+class Instrumentation:
+    """
+    Command latency histograms plus an event-loop watchdog.
 
-logger.addHandler(file_handler)
-logger.addHandler(console_handler)
+    A task samples loop lag; a separate thread notices when the loop has not ticked for
+    LOOP_BLOCK_THRESHOLD seconds and logs the loop thread's stack so blocking calls show up.
+    """
 
-# -------------------- BOT SETUP --------------------
-intents = discord.Intents.default()
-intents.message_content = True
-intents.members = True
-bot = commands.Bot(command_prefix="*", intents=intents)
+    def __init__(self):
+        self.histograms = {}    # (command, phase) -> Histogram
+        self.errors = {}        # command -> failed invocations
+        self.loop_lag = Histogram()
+        self.blocked = 0
+        self.started_at = time.time()
+        self.heartbeat = time.monotonic()
+        self.loop_thread_id = None
+        self.lag_task = None
+        self.watchdog = None
+        self.stopping = threading.Event()
+
+    def observe(self, command: str, phase: str, seconds: float):
+        histogram = self.histograms.get((command, phase))
+        if histogram is None:
+            histogram = self.histograms[(command, phase)] = Histogram()
+        histogram.observe(seconds)
+
+    def start(self):
+        if self.lag_task is not None:
+            return
+        self.loop_thread_id = threading.get_ident()
+        self.heartbeat = time.monotonic()
+        self.lag_task = asyncio.get_running_loop().create_task(self._sample_lag())
+        self.watchdog = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self.watchdog.start()
+
+    async def stop(self):
+        self.stopping.set()
+        if self.lag_task is not None:
+            self.lag_task.cancel()
+            self.lag_task = None
+
+    async def _sample_lag(self):
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(LOOP_LAG_INTERVAL)
+            self.heartbeat = now = time.monotonic()
+            self.loop_lag.observe(max(0.0, now - started - LOOP_LAG_INTERVAL))
+
+    def _watch(self):
+        reported = None
+        while not self.stopping.wait(LOOP_BLOCK_THRESHOLD / 2):
+            stalled = time.monotonic() - self.heartbeat - LOOP_LAG_INTERVAL
+            if stalled < LOOP_BLOCK_THRESHOLD:
+                reported = None
+                continue
+            if reported == self.heartbeat:
+                continue  # already logged this stall
+            reported = self.heartbeat
+            self.blocked += 1
+            frame = sys._current_frames().get(self.loop_thread_id)
+            stack = "".join(traceback.format_stack(frame)) if frame else "(no frame)"
+            logger.warning("Event loop blocked for %.0f ms. Loop thread stack:\n%s", stalled * 1000, stack)
+
+    def summary(self) -> list:
+        """Per-command rows of (command, count, p50, p99, phase means)."""
+        rows = []
+        for (command, phase), histogram in sorted(self.histograms.items()):
+            if phase != "total":
+                continue
+            phases = {
+                p: self.histograms[(command, p)].total / histogram.count
+                for p in ("queue_wait", "upstream", "send") if (command, p) in self.histograms
+            }
+            rows.append((command, histogram.count, histogram.percentile(50), histogram.percentile(99), phases))
+        return rows
+
+    def prometheus(self) -> str:
+        lines = [
+            "# TYPE binky_command_seconds histogram",
+        ]
+        for (command, phase), histogram in sorted(self.histograms.items()):
+            labels = f'command="{command}",phase="{phase}"'
+            seen = 0
+            for bound, n in zip(LATENCY_BUCKETS, histogram.counts):
+                seen += n
+                lines.append(f'binky_command_seconds_bucket{{{labels},le="{bound}"}} {seen}')
+            lines.append(f'binky_command_seconds_bucket{{{labels},le="+Inf"}} {histogram.count}')
+            lines.append(f"binky_command_seconds_sum{{{labels}}} {histogram.total}")
+            lines.append(f"binky_command_seconds_count{{{labels}}} {histogram.count}")
+        lines.append("# TYPE binky_command_errors_total counter")
+        for command, n in sorted(self.errors.items()):
+            lines.append(f'binky_command_errors_total{{command="{command}"}} {n}')
+        lines.append("# TYPE binky_loop_lag_seconds histogram")
+        seen = 0
+        for bound, n in zip(LATENCY_BUCKETS, self.loop_lag.counts):
+            seen += n
+            lines.append(f'binky_loop_lag_seconds_bucket{{le="{bound}"}} {seen}')
+        lines.append(f'binky_loop_lag_seconds_bucket{{le="+Inf"}} {self.loop_lag.count}')
+        lines.append(f"binky_loop_lag_seconds_sum {self.loop_lag.total}")
+        lines.append(f"binky_loop_lag_seconds_count {self.loop_lag.count}")
+        lines.append("# TYPE binky_loop_blocked_total counter")
+        lines.append(f"binky_loop_blocked_total {self.blocked}")
+        return "\n".join(lines) + "\n"
+
+
+instrumentation = Instrumentation()
+
+def timed_send(send):
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await send(*args, **kwargs)
+        finally:
+            record_phase("send", time.perf_counter() - started)
+    return wrapper
+
+@bot.before_invoke
+async def start_command_timer(ctx):
+    ctx.timing_started = time.perf_counter()
+    command_timings.set({})
+    ctx.send = timed_send(dispatcher.sender(ctx.channel))
+
+@bot.after_invoke
+async def stop_command_timer(ctx):
+    name = ctx.command.qualified_name if ctx.command else "unknown"
+    timings = command_timings.get() or {}
+    instrumentation.observe(name, "total", time.perf_counter() - getattr(ctx, "timing_started", time.perf_counter()))
+    for phase, seconds in timings.items():
+        instrumentation.observe(name, phase, seconds)
+    if ctx.command_failed:
+        instrumentation.errors[name] = instrumentation.errors.get(name, 0) + 1
+    command_timings.set(None)
+
+async def start_metrics_server():
+    """Serve instrumentation.prometheus() on 127.0.0.1:METRICS_PORT/metrics."""
+    from aiohttp import web
+
+    async def metrics(request):
+        return web.Response(text=instrumentation.prometheus() + dispatcher.prometheus() + response_cache.prometheus(), content_type="text/plain")
+
+    app = web.Application()
+    app.router.add_get("/metrics", metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", METRICS_PORT).start()
+    logger.info("Metrics available at http://127.0.0.1:%d/metrics", METRICS_PORT)
 
 # -------------------- GLOBALS --------------------
-queues = {}            # guild_id -> list of songs
-loop_mode = {}         # guild_id -> bool
+players = {}           # guild_id -> GuildPlayer
 
-# conversation_memory structure:
-# { "channel_id": { "user_id": { "history": [ {"role":"user"/"assistant","content": "..."} , ... ],
-#                                "persona": "some persona string" } , ... }, ... }
+# conversation_memory structure (only recently used slots; the rest stay in MEMORY_DB_FILE):
+# { "channel_id": { "user_id": MemorySlot(history=[Turn(role, content), ...], persona="...") , ... }, ... }
 conversation_memory = {}
-MEMORY_FILE = "memory.json"
+MEMORY_FILE = "memory.json"      # legacy whole-file store, migrated into MEMORY_DB_FILE once
+MEMORY_DB_FILE = "memory.db"     # append-only SQLite (WAL) store
 
 # Controls
 HISTORY_MESSAGE_LIMIT = 200  # per user per channel keep last N messages (user+assistant entries count separately)
+AUTOSAVE_INTERVAL = 300      # seconds between background flushes of queued memory changes
+COMPACT_EVERY = 12           # compact the store every N autosave cycles (~1 hour)
+MEMORY_MAX_SLOTS = int(os.getenv("MEMORY_MAX_SLOTS", "2000"))       # (channel, user) slots kept in RAM
+MEMORY_IDLE_SECONDS = int(os.getenv("MEMORY_IDLE_SECONDS", "3600"))  # unload slots unused for this long
+
+class Turn:
+    """One history entry. Slotted, with the role interned, so it is much smaller than a dict."""
+
+    __slots__ = ("role", "content")
+
+    def __init__(self, role: str, content: str):
+        self.role = sys.intern(role)
+        self.content = content
+
+    def as_message(self) -> dict:
+        return {"role": self.role, "content": self.content}
+
+class MemorySlot:
+    """What the bot remembers for one user in one channel."""
+
+    __slots__ = ("history", "persona", "last_used")
+
+    def __init__(self, history=None, persona: str = ""):
+        self.history = history if history is not None else []
+        self.persona = persona
+        self.last_used = time.monotonic()
+
+# -------------------- LONG-TERM MEMORY --------------------
+LONG_MEMORY = os.getenv("LONG_MEMORY", "1") == "1"                            # recall relevant older turns into prompts
+LONG_MEMORY_TOP_K = int(os.getenv("LONG_MEMORY_TOP_K", "4"))                  # older turns recalled per request
+LONG_MEMORY_TOKENS = int(os.getenv("LONG_MEMORY_TOKENS", "400"))              # prompt tokens set aside for them
+LONG_MEMORY_MIN_SCORE = float(os.getenv("LONG_MEMORY_MIN_SCORE", "0.2"))      # cosine similarity below this is noise
+LONG_MEMORY_MAX_TURNS = int(os.getenv("LONG_MEMORY_MAX_TURNS", "20000"))      # turns kept per slot in the store
+LONG_MEMORY_INDEX_TURNS = int(os.getenv("LONG_MEMORY_INDEX_TURNS", "5000"))  # newest turns per slot searched in RAM
+LONG_MEMORY_CACHE_MB = int(os.getenv("LONG_MEMORY_CACHE_MB", "64"))           # RAM for loaded slot indexes (LRU)
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "")                            # sentence-transformers model name; empty = hashing embedder
+HASH_EMBEDDING_DIM = 512
+
+STOPWORDS = frozenset(
+    "a an and are as at be but by do for from has have i if in is it its me my of on or so that the "
+    "this to was we were what when with you your s t d ll m re ve".split()
+)
+
+def hash_embedding(text: str) -> array.array:
+    """
+    Embed text by hashing its words into HASH_EMBEDDING_DIM signed buckets. No model,
+    stable across runs, and good enough to find turns that share vocabulary.
+    """
+    vector = array.array("f", bytes(4 * HASH_EMBEDDING_DIM))
+    for word in re.findall(r"\w+", text.lower()):
+        if word in STOPWORDS:
+            continue
+        h = zlib.crc32(word.encode())
+        vector[h % HASH_EMBEDDING_DIM] += 1.0 if h & 0x80000000 else -1.0
+    norm = math.sqrt(sum(v * v for v in vector))
+    if norm:
+        for i, v in enumerate(vector):
+            if v:
+                vector[i] = v / norm
+    return vector
+
+_embedding_model = None
+
+def embed_texts(texts: list) -> list:
+    """Embed texts as unit-length float32 arrays. Runs on the memory store thread, never the event loop."""
+    global _embedding_model
+    if EMBEDDING_MODEL:
+        if _embedding_model is None:
+            try:
+                from sentence_transformers import SentenceTransformer
+                _embedding_model = SentenceTransformer(EMBEDDING_MODEL, device="cpu")
+            except Exception:
+                logger.exception("Could not load embedding model %s; using the hashing embedder.", EMBEDDING_MODEL)
+                _embedding_model = False
+        if _embedding_model:
+            return [array.array("f", v) for v in _embedding_model.encode(texts, normalize_embeddings=True)]
+    return [hash_embedding(text) for text in texts]
+
+_numpy = False  # imported on first use; None when it isn't installed
+
+def load_numpy():
+    global _numpy
+    if _numpy is False:
+        try:
+            import numpy as module
+        except ImportError:
+            module = None
+        _numpy = module
+    return _numpy
+
+class RecallIndex:
+    """
+    Embedded turns of one slot, oldest first, at most max_turns of them: adding past that
+    drops the oldest eighth. Scored with one NumPy matrix product when NumPy is installed,
+    otherwise in pure Python over the query's non-zero dimensions.
+    """
+
+    def __init__(self, max_turns: int = LONG_MEMORY_INDEX_TURNS):
+        self.max_turns = max(1, max_turns)
+        self.turns = []
+        self.np = load_numpy()
+        self.rows = []          # array('f') per turn, without NumPy
+        self.matrix = None      # (capacity, dim) float32, with NumPy; capacity <= max_turns
+
+    def __len__(self):
+        return len(self.turns)
+
+    def add(self, turn: Turn, vector):
+        if len(self.turns) >= self.max_turns:
+            self._trim(max(1, self.max_turns // 8))
+        n = len(self.turns)
+        if self.np is None:
+            self.rows.append(vector)
+        else:
+            if self.matrix is None:
+                self.matrix = self.np.zeros((min(64, self.max_turns), len(vector)), dtype=self.np.float32)
+            elif n == len(self.matrix):
+                grown = self.np.zeros((min(2 * n, self.max_turns), self.matrix.shape[1]), dtype=self.np.float32)
+                grown[:n] = self.matrix
+                self.matrix = grown
+            self.matrix[n] = vector
+        self.turns.append(turn)
+
+    def _trim(self, count: int):
+        del self.turns[:count]
+        if self.np is None:
+            del self.rows[:count]
+        else:
+            n = len(self.turns)
+            self.matrix[:n] = self.matrix[count:count + n]
+
+    def nbytes(self) -> int:
+        """Approximate RAM held by the vectors, which dominate an index's size."""
+        if self.np is not None:
+            return self.matrix.nbytes if self.matrix is not None else 0
+        return sum(row.itemsize * len(row) + 64 for row in self.rows)
+
+    def scores(self, query):
+        """Cosine similarity of every stored turn to the query vector (both are unit length)."""
+        n = len(self.turns)
+        if self.np is not None:
+            if not n:
+                return self.np.zeros(0, dtype=self.np.float32)
+            return self.matrix[:n] @ self.np.asarray(query, dtype=self.np.float32)
+        nonzero = [(i, v) for i, v in enumerate(query) if v]
+        return [sum(row[i] * v for i, v in nonzero) for row in self.rows]
+
+class Recollection:
+    """Scores of one slot's older turns against the current prompt; build_context picks from them."""
+
+    def __init__(self, turns: list, scores):
+        self.turns = turns
+        self.scores = scores
+
+    def top(self, skip_recent: int, k: int = LONG_MEMORY_TOP_K, min_score: float = LONG_MEMORY_MIN_SCORE) -> list:
+        """Best k turns older than the newest skip_recent ones, in conversation order."""
+        candidates = len(self.turns) - skip_recent
+        if candidates <= 0 or k <= 0:
+            return []
+        scores = self.scores
+        if isinstance(scores, list):
+            best = heapq.nlargest(k, range(candidates), key=scores.__getitem__)
+        elif candidates > k:
+            best = scores[:candidates].argpartition(-k)[-k:].tolist()
+        else:
+            best = range(candidates)
+        return [self.turns[i] for i in sorted(best) if scores[i] >= min_score]
+
+class LongTermMemory:
+    """
+    Per-(channel, user) vector indexes over everything said in a slot, including turns
+    that have aged out of the HISTORY_MESSAGE_LIMIT window.
+
+    Turns are embedded once, when the store writes them, and kept with their vectors in
+    the store's recall table. Indexes hold a slot's newest LONG_MEMORY_INDEX_TURNS turns,
+    are loaded on demand and are evicted least recently used first once together they pass
+    LONG_MEMORY_CACHE_MB. Everything here runs on the store's single thread, which also serializes it.
+    """
+
+    def __init__(self):
+        self.indexes = OrderedDict()  # (channel_id, user_id) -> RecallIndex
+        self.searches = 0
+        self.search_seconds = 0.0
+
+    def extend(self, channel_id: str, user_id: str, turns: list, vectors: list):
+        """Called by the store after it has written new turns."""
+        index = self.indexes.get((channel_id, user_id))
+        if index is not None:
+            for turn, vector in zip(turns, vectors):
+                index.add(turn, vector)
+            self._evict()
+
+    def discard(self, channel_id: str, user_id: str = None):
+        for key in [k for k in self.indexes if k[0] == channel_id and user_id in (None, k[1])]:
+            del self.indexes[key]
+
+    def _index(self, channel_id: str, user_id: str) -> RecallIndex:
+        key = (channel_id, user_id)
+        index = self.indexes.get(key)
+        if index is None:
+            index = self.indexes[key] = RecallIndex()
+            for role, content, vector in memory_store.load_recall(channel_id, user_id, LONG_MEMORY_INDEX_TURNS):
+                index.add(Turn(role, content), vector)
+        self.indexes.move_to_end(key)
+        self._evict()
+        return index
+
+    def nbytes(self) -> int:
+        return sum(index.nbytes() for index in list(self.indexes.values()))
+
+    def _evict(self):
+        # the most recently used index always stays, even if it alone is over the budget
+        while len(self.indexes) > 1 and self.nbytes() > LONG_MEMORY_CACHE_MB * 2**20:
+            self.indexes.popitem(last=False)
+
+    def _search(self, channel_id: str, user_id: str, prompt: str):
+        started = time.perf_counter()
+        memory_store.flush()  # so turns from the last few requests are indexed
+        index = self._index(channel_id, user_id)
+        if not index:
+            return None
+        recollection = Recollection(list(index.turns), index.scores(embed_texts([prompt])[0]))
+        self.searches += 1
+        self.search_seconds += time.perf_counter() - started
+        return recollection
+
+    async def recall(self, channel_id: str, user_id: str, prompt: str):
+        """Score the slot's stored turns against prompt. Returns a Recollection, or None."""
+        if not LONG_MEMORY:
+            return None
+        started = time.perf_counter()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(
+                memory_store.executor, self._search, channel_id, user_id, prompt)
+        except Exception:
+            logger.exception("Long-term memory lookup failed for %s/%s", channel_id, user_id)
+            return None
+        finally:
+            record_phase("recall", time.perf_counter() - started)
+
+    def stats(self) -> dict:
+        return {
+            "indexes": len(self.indexes),
+            "turns": sum(len(index) for index in list(self.indexes.values())),
+            "mib": round(self.nbytes() / 2**20, 1),
+            "searches": self.searches,
+            "avg_ms": round(1000 * self.search_seconds / self.searches, 1) if self.searches else 0.0,
+            "embedder": EMBEDDING_MODEL if _embedding_model else "hashing",
+            "numpy": bool(load_numpy()),
+        }
+
+
+long_memory = LongTermMemory()
+
+# -------------------- MEMORY STORE --------------------
+class ConversationStore:
+    """
+    Append-only persistence for conversation_memory.
+
+    Commands queue small change records (new history entries, persona updates, deletions)
+    and save_memory() writes only those records in one transaction on a dedicated thread,
+    so the event loop never serializes the whole memory. Old history rows beyond
+    HISTORY_MESSAGE_LIMIT are pruned by compact(), which runs in the background.
+    Every turn is also written, with its embedding, to the recall table that backs
+    long_memory and *recall search; that table keeps up to LONG_MEMORY_MAX_TURNS per slot.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS slots (
+            channel_id TEXT NOT NULL,
+            user_id    TEXT NOT NULL,
+            persona    TEXT NOT NULL DEFAULT '',
+            PRIMARY KEY (channel_id, user_id)
+        );
+        CREATE TABLE IF NOT EXISTS history (
+            id         INTEGER PRIMARY KEY AUTOINCREMENT,
+            channel_id TEXT NOT NULL,
+            user_id    TEXT NOT NULL,
+            role       TEXT NOT NULL,
+            content    TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS history_slot ON history (channel_id, user_id, id);
+        CREATE TABLE IF NOT EXISTS recall (
+            id         INTEGER PRIMARY KEY AUTOINCREMENT,
+            channel_id TEXT NOT NULL,
+            user_id    TEXT NOT NULL,
+            role       TEXT NOT NULL,
+            content    TEXT NOT NULL,
+            vector     BLOB NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS recall_slot ON recall (channel_id, user_id, id);
+        -- full-text index over recall, kept in step by triggers; "slot" lets a MATCH stay within one slot
+        CREATE VIEW IF NOT EXISTS recall_docs AS
+            SELECT id, content, channel_id || ' ' || user_id AS slot FROM recall;
+        CREATE VIRTUAL TABLE IF NOT EXISTS recall_fts USING fts5(
+            content, slot, content='recall_docs', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+        );
+        CREATE TRIGGER IF NOT EXISTS recall_fts_insert AFTER INSERT ON recall BEGIN
+            INSERT INTO recall_fts (rowid, content, slot) VALUES (new.id, new.content, new.channel_id || ' ' || new.user_id);
+        END;
+        CREATE TRIGGER IF NOT EXISTS recall_fts_delete AFTER DELETE ON recall BEGIN
+            INSERT INTO recall_fts (recall_fts, rowid, content, slot)
+            VALUES ('delete', old.id, old.content, old.channel_id || ' ' || old.user_id);
+        END;
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        # a single worker keeps every write ordered and owns the connection
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="memory-store")
+        self.pending = []  # queued (op, args) records not yet written
+        self.lock = threading.Lock()
+        self.conn = None
+
+    def _connect(self):
+        if self.conn is None:
+            self.conn = sqlite3.connect(self.path, check_same_thread=False)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            self.conn.execute("PRAGMA busy_timeout=5000")  # cluster workers share the file
+            indexed = self.conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'recall_fts'").fetchone()
+            self.conn.executescript(self.SCHEMA)
+            if not indexed:
+                with self.conn:
+                    self.conn.execute("INSERT INTO recall_fts (recall_fts) VALUES ('rebuild')")
+        return self.conn
+
+    @property
+    def dirty(self) -> bool:
+        return bool(self.pending)
+
+    def queue(self, op: str, *args):
+        """Record a change to be written on the next flush."""
+        with self.lock:
+            self.pending.append((op, args))
+
+    def _apply(self, conn, op: str, args):
+        """Apply one change record. Returns a callback to run once the transaction commits, if any."""
+        if op == "append":
+            channel_id, user_id, entries = args
+            conn.execute("INSERT OR IGNORE INTO slots (channel_id, user_id) VALUES (?, ?)", (channel_id, user_id))
+            conn.executemany(
+                "INSERT INTO history (channel_id, user_id, role, content) VALUES (?, ?, ?, ?)",
+                [(channel_id, user_id, turn.role, turn.content) for turn in entries],
+            )
+            vectors = embed_texts([turn.content for turn in entries])
+            conn.executemany(
+                "INSERT INTO recall (channel_id, user_id, role, content, vector) VALUES (?, ?, ?, ?, ?)",
+                [(channel_id, user_id, turn.role, turn.content, vector.tobytes()) for turn, vector in zip(entries, vectors)],
+            )
+            return lambda: long_memory.extend(channel_id, user_id, entries, vectors)
+        elif op == "persona":
+            channel_id, user_id, persona = args
+            conn.execute(
+                "INSERT INTO slots (channel_id, user_id, persona) VALUES (?, ?, ?) "
+                "ON CONFLICT (channel_id, user_id) DO UPDATE SET persona = excluded.persona",
+                (channel_id, user_id, persona),
+            )
+        elif op == "drop_slot":
+            channel_id, user_id = args
+            conn.execute("DELETE FROM slots WHERE channel_id = ? AND user_id = ?", (channel_id, user_id))
+            conn.execute("DELETE FROM history WHERE channel_id = ? AND user_id = ?", (channel_id, user_id))
+            conn.execute("DELETE FROM recall WHERE channel_id = ? AND user_id = ?", (channel_id, user_id))
+            return lambda: long_memory.discard(channel_id, user_id)
+        elif op == "drop_channel":
+            (channel_id,) = args
+            conn.execute("DELETE FROM slots WHERE channel_id = ?", (channel_id,))
+            conn.execute("DELETE FROM history WHERE channel_id = ?", (channel_id,))
+            conn.execute("DELETE FROM recall WHERE channel_id = ?", (channel_id,))
+            return lambda: long_memory.discard(channel_id)
+        else:
+            raise ValueError(f"unknown memory op {op!r}")
+
+    def flush(self) -> int:
+        """Write queued changes in a single transaction. Returns the number of records written."""
+        with self.lock:
+            ops, self.pending = self.pending, []
+        if not ops:
+            return 0
+        try:
+            conn = self._connect()
+            with conn:
+                committed = [self._apply(conn, op, args) for op, args in ops]
+        except Exception:
+            # put the records back in front so nothing is lost; the next flush retries
+            with self.lock:
+                self.pending[:0] = ops
+            raise
+        for callback in committed:
+            if callback is not None:
+                callback()
+        return len(ops)
+
+    def compact(self):
+        """Prune history beyond HISTORY_MESSAGE_LIMIT per slot and checkpoint the WAL."""
+        conn = self._connect()
+        with conn:
+            conn.execute(
+                "DELETE FROM history WHERE id IN ("
+                " SELECT id FROM (SELECT id, ROW_NUMBER() OVER ("
+                "  PARTITION BY channel_id, user_id ORDER BY id DESC) AS rn FROM history)"
+                " WHERE rn > ?)",
+                (HISTORY_MESSAGE_LIMIT,),
+            )
+            conn.execute(
+                "DELETE FROM recall WHERE id IN ("
+                " SELECT id FROM (SELECT id, ROW_NUMBER() OVER ("
+                "  PARTITION BY channel_id, user_id ORDER BY id DESC) AS rn FROM recall)"
+                " WHERE rn > ?)",
+                (LONG_MEMORY_MAX_TURNS,),
+            )
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    def load_slot(self, channel_id: str, user_id: str):
+        """Read one slot (None if the store has nothing for it). Writes queued changes first."""
+        self.flush()
+        conn = self._connect()
+        row = conn.execute("SELECT persona FROM slots WHERE channel_id = ? AND user_id = ?", (channel_id, user_id)).fetchone()
+        rows = conn.execute(
+            "SELECT role, content FROM history WHERE channel_id = ? AND user_id = ? ORDER BY id DESC LIMIT ?",
+            (channel_id, user_id, HISTORY_MESSAGE_LIMIT),
+        ).fetchall()
+        if row is None and not rows:
+            return None
+        history = [Turn(role, content) for role, content in reversed(rows)]
+        return MemorySlot(history, row[0] if row else "")
+
+    def load_recall(self, channel_id: str, user_id: str, limit: int = -1) -> list:
+        """
+        Read a slot's newest limit stored turns (all of them by default) as (role, content,
+        vector), oldest first. Slots stored before the recall table existed are embedded
+        from their history on first read.
+        """
+        conn = self._connect()
+        rows = conn.execute(
+            "SELECT role, content, vector FROM recall WHERE channel_id = ? AND user_id = ? ORDER BY id DESC LIMIT ?",
+            (channel_id, user_id, limit),
+        ).fetchall()[::-1]
+        if not rows:
+            history = conn.execute(
+                "SELECT role, content FROM history WHERE channel_id = ? AND user_id = ? ORDER BY id",
+                (channel_id, user_id),
+            ).fetchall()
+            if not history:
+                return []
+            vectors = embed_texts([content for _, content in history])
+            rows = [(role, content, vector.tobytes()) for (role, content), vector in zip(history, vectors)]
+            with conn:
+                conn.executemany(
+                    "INSERT INTO recall (channel_id, user_id, role, content, vector) VALUES (?, ?, ?, ?, ?)",
+                    [(channel_id, user_id, *row) for row in rows],
+                )
+        dim = len(embed_texts([""])[0])
+        loaded = []
+        for role, content, blob in rows:
+            vector = array.array("f")
+            vector.frombytes(blob)
+            if len(vector) == dim:  # rows embedded by a different model are skipped
+                loaded.append((role, content, vector))
+        return loaded
+
+    def search(self, channel_id: str, user_id: str, terms: list, limit: int, offset: int = 0):
+        """
+        Full-text search over one slot's stored turns, best match first (BM25).
+        Returns (total matches, [(role, snippet), ...]) for the requested page.
+        """
+        self.flush()
+        conn = self._connect()
+        if not conn.execute("SELECT 1 FROM recall WHERE channel_id = ? AND user_id = ? LIMIT 1",
+                            (channel_id, user_id)).fetchone():
+            self.load_recall(channel_id, user_id)  # indexes history stored before the recall table existed
+        query = 'slot : "{}" AND content : ({})'.format(
+            f"{channel_id} {user_id}", " ".join('"' + term.replace('"', '""') + '"' for term in terms))
+        total = conn.execute("SELECT COUNT(*) FROM recall_fts WHERE recall_fts MATCH ?", (query,)).fetchone()[0]
+        rows = conn.execute(
+            "SELECT r.role, snippet(recall_fts, 0, '**', '**', '…', 24) FROM recall_fts "
+            "JOIN recall r ON r.id = recall_fts.rowid WHERE recall_fts MATCH ? "
+            "ORDER BY bm25(recall_fts) LIMIT ? OFFSET ?",
+            (query, limit, offset),
+        ).fetchall()
+        return total, rows
+
+    def count_slots(self) -> int:
+        return self._connect().execute("SELECT COUNT(*) FROM slots").fetchone()[0]
+
+    def migrate_json(self, json_path: str) -> int:
+        """Import a legacy memory.json into an empty store. Returns the number of slots imported."""
+        with open(json_path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        if not isinstance(data, dict):
+            raise ValueError("root is not a dict")
+        imported = 0
+        try:
+            for channel_id, users in data.items():
+                # older builds left other top-level keys (e.g. "persona_memory") next to channel ids
+                if not isinstance(users, dict):
+                    continue
+                for user_id, slot in users.items():
+                    if not isinstance(slot, dict) or "history" not in slot:
+                        continue
+                    self.queue("persona", str(channel_id), str(user_id), slot.get("persona") or "")
+                    history = [Turn(m.get("role", "user"), m.get("content", ""))
+                               for m in slot.get("history") or [] if isinstance(m, dict)]
+                    if history:
+                        self.queue("append", str(channel_id), str(user_id), history[-HISTORY_MESSAGE_LIMIT:])
+                    imported += 1
+        except Exception:
+            with self.lock:
+                self.pending.clear()  # don't leave a half-imported memory queued
+            raise
+        self.flush()
+        return imported
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+
+memory_store = ConversationStore(MEMORY_DB_FILE)
+autosave_task = None
 
 # -------------------- MEMORY HELPERS FOR OPEN AI RP --------------------
 def save_memory():
-    """Save conversation memory to a JSON file."""
+    """Flush queued memory changes to the store without blocking the event loop."""
     try:
-        with open(MEMORY_FILE, "w", encoding="utf-8") as f:
-            json.dump(conversation_memory, f, ensure_ascii=False, indent=2)
-        logger.debug("Memory saved to %s", MEMORY_FILE)
-    except Exception as e:
-        logger.exception("Failed to save memory: %s", e)
-
-def load_memory():
-    """Load saved conversations from disk (if present)."""
-    global conversation_memory
-    if os.path.exists(MEMORY_FILE):
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        loop = None
+    if loop is None:
         try:
-            with open(MEMORY_FILE, "r", encoding="utf-8") as f:
-                data = json.load(f)
-                # Basic validation: ensure dict structure
-                if isinstance(data, dict):
-                    conversation_memory = data
-                    logger.info("Memory loaded: %d channel keys", len(conversation_memory))
-                else:
-                    logger.warning("memory.json malformed: root is not a dict. Starting fresh.")
-                    conversation_memory = {}
+            written = memory_store.flush()
+            logger.debug("Memory flushed: %d change(s) written to %s", written, MEMORY_DB_FILE)
         except Exception as e:
-            logger.exception("Failed to load memory: %s", e)
-            conversation_memory = {}
-    else:
-        logger.info("No memory file found; starting with empty memory.")
-        conversation_memory = {}
+            logger.exception("Failed to save memory: %s", e)
+        return None
+    future = loop.run_in_executor(memory_store.executor, memory_store.flush)
+    future.add_done_callback(_log_flush_result)
+    return future
+
+def _log_flush_result(future):
+    if future.exception():
+        logger.error("Failed to save memory: %s", future.exception())
+    elif future.result():
+        logger.debug("Memory flushed: %d change(s) written to %s", future.result(), MEMORY_DB_FILE)
+
+def load_memory():
+    """Open the conversation store, migrating memory.json on first run. Slots load on demand."""
+    try:
+        if not os.path.exists(MEMORY_DB_FILE) and os.path.exists(MEMORY_FILE):
+            try:
+                imported = memory_store.migrate_json(MEMORY_FILE)
+                logger.info("Migrated %d conversation slot(s) from %s to %s", imported, MEMORY_FILE, MEMORY_DB_FILE)
+            except Exception as e:
+                logger.exception("Failed to migrate %s: %s. Starting fresh.", MEMORY_FILE, e)
+        logger.info("Memory store ready: %d stored slot(s)", memory_store.count_slots())
+    except Exception as e:
+        logger.exception("Failed to open memory store: %s", e)
 
 async def autosave():
-    """Auto-save loop to persist memory periodically."""
+    """Auto-save loop: flush only when something changed, unload idle slots, compact now and then."""
+    loop = asyncio.get_running_loop()
+    cycles = 0
     while True:
-        save_memory()
-        await asyncio.sleep(300)  # every 5 minutes
-
-def ensure_user_channel_slot(channel_id: str, user_id: str):
-    """Ensure nested dicts exist for channel and user with default persona."""
-    if channel_id not in conversation_memory:
-        conversation_memory[channel_id] = {}
-    if user_id not in conversation_memory[channel_id]:
-        conversation_memory[channel_id][user_id] = {"history": [], "persona": ""}
-
-def trim_history(channel_id: str, user_id: str):
-    """Trim history to the allowed limit per user/channel."""
-    hist = conversation_memory[channel_id][user_id]["history"]
-    if len(hist) > HISTORY_MESSAGE_LIMIT:
-        # keep the most recent items
-        conversation_memory[channel_id][user_id]["history"] = hist[-HISTORY_MESSAGE_LIMIT:]
+        await asyncio.sleep(AUTOSAVE_INTERVAL)
+        if memory_store.dirty:
+            save_memory()
+        evict_idle_slots()
+        cycles += 1
+        # compaction prunes every slot in the shared store, so in a cluster only worker 0 runs it
+        if cycles % COMPACT_EVERY == 0 and WORKER_ID in ("", "0"):
+            try:
+                await loop.run_in_executor(memory_store.executor, memory_store.compact)
+                logger.debug("Memory store compacted.")
+            except Exception:
+                logger.exception("Failed to compact memory store.")
+
+def cached_slot(channel_id: str, user_id: str):
+    users = conversation_memory.get(channel_id)
+    return users.get(user_id) if users else None
+
+async def get_slot(channel_id: str, user_id: str, create: bool = False):
+    """
+    Return the MemorySlot for a user in a channel, loading it from the store if it is
+    not in RAM. Returns None when nothing is stored, unless create is set.
+    """
+    slot = cached_slot(channel_id, user_id)
+    if slot is None:
+        loaded = await asyncio.get_running_loop().run_in_executor(
+            memory_store.executor, memory_store.load_slot, channel_id, user_id)
+        slot = cached_slot(channel_id, user_id)  # another command may have loaded it meanwhile
+        if slot is None and (loaded is not None or create):
+            slot = loaded or MemorySlot()
+            conversation_memory.setdefault(channel_id, {})[user_id] = slot
+            if sum(len(users) for users in conversation_memory.values()) > MEMORY_MAX_SLOTS:
+                evict_idle_slots()
+    if slot is not None:
+        slot.last_used = time.monotonic()
+    return slot
+
+def _unload_slot(channel_id: str, user_id: str):
+    users = conversation_memory.get(channel_id)
+    if users is not None:
+        users.pop(user_id, None)
+        if not users:
+            conversation_memory.pop(channel_id, None)
+    conversation_summaries.pop((channel_id, user_id), None)
+
+def evict_idle_slots():
+    """Drop idle or least recently used slots from RAM; they stay in the store and reload on demand."""
+    slots = sorted(
+        ((slot.last_used, channel_id, user_id) for channel_id, users in conversation_memory.items()
+         for user_id, slot in users.items()),
+    )
+    cutoff = time.monotonic() - MEMORY_IDLE_SECONDS
+    excess = len(slots) - MEMORY_MAX_SLOTS
+    evicted = 0
+    for i, (last_used, channel_id, user_id) in enumerate(slots):
+        if last_used >= cutoff and i >= excess:
+            break
+        _unload_slot(channel_id, user_id)
+        evicted += 1
+    if evicted:
+        logger.debug("Unloaded %d idle memory slot(s); %d left in RAM", evicted, len(slots) - evicted)
+
+def memory_usage() -> dict:
+    """Approximate RAM held by loaded conversation slots."""
+    slots = turns = total = 0
+    for users in conversation_memory.values():
+        total += sys.getsizeof(users)
+        for slot in users.values():
+            slots += 1
+            turns += len(slot.history)
+            total += sys.getsizeof(slot) + sys.getsizeof(slot.history) + sys.getsizeof(slot.persona)
+            total += sum(sys.getsizeof(turn) + sys.getsizeof(turn.content) for turn in slot.history)
+    return {
+        "slots": slots,
+        "turns": turns,
+        "bytes": total,
+        "bytes_per_slot": total // slots if slots else 0,
+    }
+
+def append_history(channel_id: str, user_id: str, *entries):
+    """Append turns to a user's history and queue them for the store."""
+    slot = cached_slot(channel_id, user_id)
+    if slot is not None:
+        slot.history.extend(entries)
+        if len(slot.history) > HISTORY_MESSAGE_LIMIT:
+            # keep the most recent items
+            del slot.history[:-HISTORY_MESSAGE_LIMIT]
+    # an unloaded slot picks these up from the store when it is next loaded
+    memory_store.queue("append", channel_id, user_id, list(entries))
+
+def set_persona_memory(channel_id: str, user_id: str, persona: str):
+    slot = cached_slot(channel_id, user_id)
+    if slot is not None:
+        slot.persona = persona
+    memory_store.queue("persona", channel_id, user_id, persona)
+
+def forget_slot(channel_id: str, user_id: str):
+    _unload_slot(channel_id, user_id)
+    memory_store.queue("drop_slot", channel_id, user_id)
+
+def forget_channel(channel_id: str):
+    conversation_memory.pop(channel_id, None)
+    for key in [k for k in conversation_summaries if k[0] == channel_id]:
+        conversation_summaries.pop(key, None)
+    memory_store.queue("drop_channel", channel_id)
 
 # -------------------- HELPERS --------------------
 def clean_openrouter_output(text: str) -> str:
@@ -142,66 +1384,1076 @@ def clean_openrouter_output(text: str) -> str:
     cleaned = re.sub(r"<s>\s*\[OUT\]\s*|\s*\[/OUT\]\s*</s>", "", text)
     return cleaned.strip()
 
-# -------------------- AI CALL --------------------
-async def call_ai_api(messages, timeout_seconds: int = 30):
+# -------------------- AI BACKENDS --------------------
+# comma-separated "model" or "model@chat-completions-url", in order of preference
+AI_BACKENDS = os.getenv("AI_BACKENDS", "openai/gpt-oss-20b:free")
+AI_RETRIES = int(os.getenv("AI_RETRIES", "2"))                       # retries per backend on 429/5xx
+AI_RETRY_BASE = 0.5                                                  # seconds, doubled per retry, jittered
+AI_HEDGE = os.getenv("AI_HEDGE", "1") == "1"                         # race a second backend when the first is slow
+AI_HEDGE_DEFAULT = float(os.getenv("AI_HEDGE_DEFAULT", "5"))         # hedge delay until a backend has enough samples
+AI_HEDGE_MIN_SAMPLES = 10
+AI_BREAKER_FAILURES = int(os.getenv("AI_BREAKER_FAILURES", "3"))     # consecutive failures that open a circuit
+AI_BREAKER_COOLDOWN = float(os.getenv("AI_BREAKER_COOLDOWN", "30"))  # seconds before an open circuit is retried
+
+class AIError(Exception):
+    """An AI request that produced no usable reply."""
+
+    def __init__(self, message: str, status: int = None):
+        super().__init__(message)
+        self.status = status
+
+class EmptyReply(AIError):
+    pass
+
+def ai_error_note(error: Exception) -> str:
+    """What to tell the user when an AI request failed. Never stored in history."""
+    if isinstance(error, asyncio.TimeoutError):
+        return "⚠️ The AI request timed out; try again."
+    if isinstance(error, AIError):
+        return f"⚠️ {error}"
+    return f"⚠️ Error contacting AI: {error}"
+
+class AIBackend:
+    """One model at one endpoint, with its own latency samples and circuit breaker."""
+
+    def __init__(self, model: str, url: str):
+        self.model = model
+        self.url = url
+        self.latency = {"reply": deque(maxlen=200), "first_token": deque(maxlen=200)}  # recent successes, seconds
+        self.requests = 0
+        self.errors = 0
+        self.retries = 0
+        self.failures = 0      # consecutive; AI_BREAKER_FAILURES opens the circuit
+        self.open_until = 0.0
+        self.probing = False   # a half-open circuit lets one request through at a time
+
+    def state(self, now: float) -> str:
+        if self.failures < AI_BREAKER_FAILURES:
+            return "closed"
+        return "open" if now < self.open_until else "half-open"
+
+    def available(self, now: float) -> bool:
+        state = self.state(now)
+        return state == "closed" or (state == "half-open" and not self.probing)
+
+    def percentile(self, kind: str, pct: float) -> float:
+        samples = sorted(self.latency[kind])
+        return samples[min(len(samples) - 1, int(pct / 100 * len(samples)))] if samples else 0.0
+
+    def hedge_delay(self, kind: str) -> float:
+        if len(self.latency[kind]) < AI_HEDGE_MIN_SAMPLES:
+            return AI_HEDGE_DEFAULT
+        return max(0.5, self.percentile(kind, 95))
+
+    def succeeded(self, kind: str, seconds: float):
+        self.latency[kind].append(seconds)
+        self.failures = 0
+        self.probing = False
+
+    def failed(self, error: Exception):
+        self.errors += 1
+        self.failures += 1
+        self.probing = False
+        if self.failures >= AI_BREAKER_FAILURES:
+            self.open_until = time.monotonic() + AI_BREAKER_COOLDOWN
+            if self.failures == AI_BREAKER_FAILURES:
+                logger.warning("AI backend %s disabled for %.0fs after %d failures: %s",
+                               self.model, AI_BREAKER_COOLDOWN, self.failures, error)
+
+    @contextlib.asynccontextmanager
+    async def post(self, payload: dict, timeout: aiohttp.ClientTimeout):
+        """POST to the backend, retrying 429/5xx with jittered exponential backoff. Yields the 200 response."""
+        headers = {"Authorization": f"Bearer {AI_API_KEY}", "Content-Type": "application/json"}
+        if payload.get("stream"):
+            headers["Accept"] = "text/event-stream"
+        payload = dict(payload, model=self.model)
+        for attempt in range(AI_RETRIES + 1):
+            async with http_client.post(self.url, headers=headers, json=payload, timeout=timeout) as resp:
+                if resp.status == 200:
+                    yield resp
+                    return
+                text = await resp.text()
+                if (resp.status != 429 and resp.status < 500) or attempt == AI_RETRIES:
+                    logger.warning("AI backend %s returned %s: %s", self.model, resp.status, text[:400])
+                    raise AIError(f"API Error {resp.status}: {text[:200]}", resp.status)
+                retry_after = resp.headers.get("Retry-After", "")
+            delay = float(retry_after) if retry_after.isdigit() else AI_RETRY_BASE * 2 ** attempt
+            delay = min(10.0, delay) * random.uniform(0.5, 1.5)
+            self.retries += 1
+            logger.info("AI backend %s returned %s; retrying in %.1fs", self.model, resp.status, delay)
+            await asyncio.sleep(delay)
+
+    async def complete(self, messages, timeout_seconds: float) -> str:
+        timeout = aiohttp.ClientTimeout(total=timeout_seconds, connect=HTTP_CONNECT_TIMEOUT)
+        async with self.post({"messages": messages}, timeout) as resp:
+            try:
+                res = await resp.json(content_type=None)
+            except ValueError:
+                raise AIError(f"API returned invalid JSON: {(await resp.text())[:200]}")
+        try:
+            content = res.get("choices", [{}])[0].get("message", {}).get("content", "")
+        except Exception:
+            content = ""
+        content = clean_openrouter_output(content or "")
+        if not content:
+            logger.warning("AI backend %s returned empty content: %s", self.model, str(res)[:400])
+            raise EmptyReply("The AI didn’t return a response.")
+        return content
+
+    async def stream(self, messages, timeout_seconds: float):
+        """Async generator yielding content deltas from the backend's SSE stream."""
+        timeout = aiohttp.ClientTimeout(total=timeout_seconds, connect=HTTP_CONNECT_TIMEOUT, sock_read=30)
+        async with self.post({"messages": messages, "stream": True}, timeout) as resp:
+            async for raw in resp.content:
+                line = raw.decode("utf-8", "replace").strip()
+                # blank lines separate events; lines starting with ':' are keep-alive comments
+                if not line.startswith("data:"):
+                    continue
+                payload = line[5:].strip()
+                if payload == "[DONE]":
+                    return
+                try:
+                    event = json.loads(payload)
+                except ValueError:
+                    logger.debug("Skipping malformed SSE payload: %s", payload[:200])
+                    continue
+                if event.get("error"):
+                    raise AIError(f"API Error: {str(event['error'])[:200]}")
+                delta = (event.get("choices") or [{}])[0].get("delta") or {}
+                if delta.get("content"):
+                    yield delta["content"]
+
+    def stats(self, now: float) -> dict:
+        return {
+            "state": self.state(now),
+            "requests": self.requests,
+            "errors": self.errors,
+            "retries": self.retries,
+            "p50_ms": round(1000 * self.percentile("reply", 50)),
+            "p95_ms": round(1000 * self.percentile("reply", 95)),
+            "ttft_p95_ms": round(1000 * self.percentile("first_token", 95)),
+        }
+
+class AIBackendPool:
+    """
+    Sends each AI request to the preferred healthy backend, hedging with the next one when
+    the first hasn't answered within its own p95 latency and failing over when it errors.
+    Backends whose circuit is open are skipped until their cooldown has passed.
+    """
+
+    def __init__(self, spec: str):
+        self.backends = []
+        for entry in filter(None, (part.strip() for part in spec.split(","))):
+            model, _, url = entry.partition("@")
+            self.backends.append(AIBackend(model, url or OPENROUTER_URL))
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.failovers = 0
+
+    async def _attempt(self, backend: AIBackend, kind: str, call):
+        now = time.monotonic()
+        if backend.state(now) == "half-open":
+            backend.probing = True
+        backend.requests += 1
+        started = time.perf_counter()
+        try:
+            result = await call(backend)
+        except asyncio.CancelledError:
+            backend.probing = False  # lost a race; says nothing about the backend's health
+            raise
+        except Exception as e:
+            backend.failed(e)
+            raise
+        backend.succeeded(kind, time.perf_counter() - started)
+        return result
+
+    async def _race(self, kind: str, call, deadline: float, discard=None):
+        """
+        Run call(backend) on the best backend, adding a hedge or failover backend as needed.
+        Returns the first successful result; discard(result) disposes of any other.
+        """
+        now = time.monotonic()
+        candidates = [b for b in self.backends if b.available(now)]
+        if not candidates:
+            raise AIError("The AI is unavailable right now; try again in a bit.")
+        running = {}  # task -> backend
+        hedges = 0
+        errors = []
+
+        def launch():
+            backend = candidates.pop(0)
+            running[asyncio.create_task(self._attempt(backend, kind, call))] = backend
+            return backend
+
+        newest = launch()
+        try:
+            while running:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise asyncio.TimeoutError()
+                wait = remaining
+                if AI_HEDGE and candidates and not hedges:
+                    wait = min(wait, newest.hedge_delay(kind))
+                done, _ = await asyncio.wait(running, timeout=wait, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    if AI_HEDGE and candidates and not hedges and time.monotonic() < deadline:
+                        hedges += 1
+                        self.hedged += 1
+                        logger.info("AI backend %s is slow; hedging with %s", newest.model, candidates[0].model)
+                        newest = launch()
+                    continue
+                winner = None
+                for task in done:
+                    backend = running.pop(task)
+                    if task.exception() is not None:
+                        errors.append(task.exception())
+                        logger.warning("AI backend %s failed: %r", backend.model, task.exception())
+                    elif winner is None:
+                        winner = task.result()
+                        if hedges and backend is newest:
+                            self.hedge_wins += 1
+                    elif discard is not None:
+                        await discard(task.result())
+                if winner is not None:
+                    return winner
+                if candidates and not running:
+                    self.failovers += 1
+                    newest = launch()
+            raise errors[-1]
+        finally:
+            for task in running:
+                task.cancel()
+            if running:
+                await asyncio.gather(*running, return_exceptions=True)
+
+    async def complete(self, messages, timeout_seconds: float = 30) -> str:
+        """Return the reply text, or raise AIError / asyncio.TimeoutError."""
+        deadline = time.monotonic() + timeout_seconds
+        return await self._race("reply", lambda b: b.complete(messages, timeout_seconds), deadline)
+
+    async def stream(self, messages, timeout_seconds: float = 60):
+        """
+        Async generator yielding content deltas. The race is decided by the first token:
+        whichever backend produces one first streams the rest of the reply.
+        """
+        async def first_delta(backend):
+            deltas = backend.stream(messages, timeout_seconds)
+            try:
+                return await deltas.__anext__(), deltas
+            except StopAsyncIteration:
+                raise EmptyReply("The AI didn’t return a response.")
+            except BaseException:
+                await deltas.aclose()
+                raise
+
+        async def close(result):
+            await result[1].aclose()
+
+        deadline = time.monotonic() + min(timeout_seconds, 30)
+        first, deltas = await self._race("first_token", first_delta, deadline, discard=close)
+        try:
+            yield first
+            async for delta in deltas:
+                yield delta
+        finally:
+            await deltas.aclose()
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        return {
+            "hedged": self.hedged,
+            "hedge_wins": self.hedge_wins,
+            "failovers": self.failovers,
+            "backends": {b.model: b.stats(now) for b in self.backends},
+        }
+
+
+ai_backends = AIBackendPool(AI_BACKENDS)
+
+async def call_ai_api(messages, timeout_seconds: int = 30) -> str:
     """
     messages: list of {"role": "...", "content": "..."} compatible with OpenRouter
-    Returns: string (reply) or an error note string.
+    Returns the reply text. Raises AIError or asyncio.TimeoutError when no backend answered.
     """
-    url = "https://openrouter.ai/api/v1/chat/completions"
-    headers = {
-        "Authorization": f"Bearer {AI_API_KEY}",
-        "Content-Type": "application/json"
-    }
-    data = {
-        "model": "openai/gpt-oss-20b:free",  # change model if needed
-        "messages": messages
-    }
+    return await ai_backends.complete(messages, timeout_seconds)
+
+# -------------------- STREAMING REPLIES --------------------
+AI_STREAMING = os.getenv("AI_STREAMING", "1") == "1"
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.2"))  # seconds between message edits
+DISCORD_MESSAGE_LIMIT = 2000
 
+def split_message(text: str, limit: int = DISCORD_MESSAGE_LIMIT):
+    """
+    Split text into Discord-sized chunks, preferring paragraph, line and sentence
+    boundaries. A code block cut in two is closed and reopened so both halves render.
+    """
+    chunks = []
+    while text:
+        if len(text) <= limit:
+            chunks.append(text)
+            break
+        window = text[:limit - 4]  # room to close a code block
+        cut = -1
+        for sep in ("\n\n", "\n", ". ", "! ", "? ", " "):
+            cut = window.rfind(sep)
+            if cut > limit // 2:
+                cut += len(sep)
+                break
+        if cut <= limit // 2:
+            cut = len(window)
+        chunk, text = text[:cut], text[cut:]
+        fence = re.findall(r"^```(\w*)", chunk, re.MULTILINE)
+        if len(fence) % 2:
+            chunk = chunk.rstrip("\n") + "\n```"
+            text = f"```{fence[-1]}\n" + text
+        chunks.append(chunk)
+    return chunks
+
+async def stream_ai_api(messages, timeout_seconds: int = 60):
+    """Async generator yielding content deltas from the fastest healthy AI backend."""
+    async for delta in ai_backends.stream(messages, timeout_seconds):
+        yield delta
+
+class StreamingReply:
+    """Shows a growing reply by editing messages, opening a new one every 2000 characters."""
+
+    def __init__(self, ctx):
+        self.ctx = ctx
+        self.text = ""
+        self.messages = []   # sent discord.Message objects
+        self.shown = []      # content currently displayed in each message
+        self.last_edit = 0.0
+
+    async def update(self, final: bool = False):
+        now = time.monotonic()
+        if not final and now - self.last_edit < STREAM_EDIT_INTERVAL:
+            return
+        self.last_edit = now
+        for i, chunk in enumerate(split_message(clean_openrouter_output(self.text))):
+            if i < len(self.messages):
+                if self.shown[i] != chunk:
+                    await self.messages[i].edit(content=chunk)
+                    self.shown[i] = chunk
+            else:
+                self.messages.append(await self.ctx.send(chunk))
+                self.shown.append(chunk)
+
+async def stream_reply(ctx, messages, empty_note: str):
+    """Stream an AI reply into the channel. Returns the reply text, or None if the request failed."""
+    reply = StreamingReply(ctx)
+    started = time.perf_counter()
+    first_visible = None
+    failed = False
     try:
-        timeout = aiohttp.ClientTimeout(total=timeout_seconds)
-        async with aiohttp.ClientSession(timeout=timeout) as session:
-            async with session.post(url, headers=headers, json=data) as resp:
-                text = await resp.text()
-                if resp.status != 200:
-                    logger.warning("AI API returned non-200 status %s: %s", resp.status, text[:400])
-                    return f"⚠️ API Error {resp.status}: {text[:200]}"
-                # parse json
-                try:
-                    res = await resp.json()
-                except Exception as e:
-                    logger.exception("Failed to parse AI response JSON: %s", e)
-                    return f"⚠️ API returned invalid JSON: {text[:200]}"
+        async with ctx.typing():
+            async for delta in stream_ai_api(messages):
+                reply.text += delta
+                if first_visible is None and reply.text.strip():
+                    await reply.update(final=True)
+                    first_visible = time.perf_counter() - started
+                    logger.info("AI stream in %s: first token visible after %.2fs", ctx.channel.id, first_visible)
+                else:
+                    await reply.update()
+    except EmptyReply:
+        pass
+    except Exception as e:
+        if isinstance(e, asyncio.TimeoutError):
+            logger.warning("AI stream in %s timed out.", ctx.channel.id)
+        else:
+            logger.exception("Error while streaming AI response: %s", e)
+        failed = True
+        reply.text += f"\n{ai_error_note(e)}" if reply.text else ai_error_note(e)
+    if not clean_openrouter_output(reply.text):
+        failed = True
+        reply.text = empty_note
+    await reply.update(final=True)
+    logger.info("AI stream in %s finished in %.2fs (%d chars, %d message(s))",
+                ctx.channel.id, time.perf_counter() - started, len(reply.text), len(reply.messages))
+    return None if failed else clean_openrouter_output(reply.text)
+
+async def respond_with_ai(ctx, messages, empty_note: str):
+    """
+    Get an AI reply and post it, streamed when AI_STREAMING is on. Returns the reply text,
+    or None when the request failed and the user was shown an error note instead.
+    """
+    if AI_STREAMING:
+        return await stream_reply(ctx, messages, empty_note)
+    reply = None
+    async with ctx.typing():
+        try:
+            reply = await call_ai_api(messages)
+        except EmptyReply:
+            note = empty_note
+        except Exception as e:
+            logger.warning("AI request in %s failed: %r", ctx.channel.id, e)
+            note = ai_error_note(e)
+    for chunk in split_message(reply or note):
+        await ctx.send(chunk)
+    return reply
+
+# -------------------- CONTEXT BUILDER --------------------
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "3000"))  # prompt tokens per AI request
+CONTEXT_SUMMARY = os.getenv("CONTEXT_SUMMARY", "0") == "1"            # summarize turns that fall out of the budget
+SUMMARY_REFRESH_TURNS = int(os.getenv("SUMMARY_REFRESH_TURNS", "20"))  # regenerate after this many newly dropped turns
+MESSAGE_TOKEN_OVERHEAD = 4  # role/formatting tokens the chat format adds per message
+
+# (channel_id, user_id) -> {"text": rolling summary, "last": newest history entry it covers}
+conversation_summaries = {}
+summary_tasks = set()
+
+def estimate_tokens(text: str) -> int:
+    """Cheap tokenizer fallback: ~4 characters per token."""
+    return (len(text) + 3) // 4 if text else 0
+
+def load_tokenizer():
+    """
+    Switch token counting to tiktoken's o200k_base. Runs in an executor at startup: the
+    first use may download the BPE file, and any failure (not installed, offline) just
+    leaves the estimate in place.
+    """
+    global count_tokens
+    try:
+        import tiktoken
+        encoding = tiktoken.get_encoding("o200k_base")
+    except ImportError:
+        return
+    except Exception as e:
+        logger.warning("Could not load the tiktoken encoding (%r); estimating tokens from length.", e)
+        return
+    if count_tokens is estimate_tokens:  # leave a tokenizer someone swapped in alone
+        count_tokens = lambda text: len(encoding.encode(text or "", disallowed_special=()))
 
-                # defensive extraction
-                try:
-                    content = res.get("choices", [{}])[0].get("message", {}).get("content", "")
-                except Exception:
-                    content = ""
-
-                content = clean_openrouter_output(content or "")
-                if not content:
-                    logger.warning("AI returned empty content. Full raw response (truncated): %s", str(res)[:400])
-                    return "⚠️ The AI didn’t return a response."
-                return content
-    except asyncio.TimeoutError:
-        logger.exception("AI API call timed out.")
-        return "⚠️ The AI request timed out; try again."
+# swap this for any callable(str) -> int to match the model in use
+count_tokens = estimate_tokens
+
+def message_tokens(message: dict) -> int:
+    return count_tokens(message.get("content", "")) + MESSAGE_TOKEN_OVERHEAD
+
+def build_context(channel_id: str, user_id: str, system_prompt: str, history: list, prompt: str,
+                  budget: int = None, recollection=None):
+    """
+    Assemble the messages for an AI request within a token budget.
+
+    Keeps the system prompt, the new user message and as many of the most recent history
+    turns as fit. Older turns are replaced by the cached rolling summary when there is one,
+    plus, given a Recollection from long_memory, the older turns most relevant to the prompt
+    (up to LONG_MEMORY_TOKENS). Returns (messages, report) where report carries the token
+    counts for logging.
+    """
+    budget = budget or CONTEXT_TOKEN_BUDGET
+    system = {"role": "system", "content": system_prompt}
+    user = {"role": "user", "content": prompt}
+    used = message_tokens(system) + message_tokens(user)
+    history_costs = [count_tokens(turn.content) + MESSAGE_TOKEN_OVERHEAD for turn in history]
+    full = used + sum(history_costs)
+
+    summary_message = None
+    cached = conversation_summaries.get((channel_id, user_id))
+    if cached and full > budget:
+        summary_message = {"role": "system", "content": f"Summary of the earlier conversation: {cached['text']}"}
+        used += message_tokens(summary_message)
+
+    def fit_recent(used, reserve):
+        kept = 0
+        for cost in reversed(history_costs):
+            if used + reserve + cost > budget:
+                break
+            used += cost
+            kept += 1
+        return used, kept
+
+    reserve = LONG_MEMORY_TOKENS if recollection is not None and full > budget else 0
+    with_recent, kept = fit_recent(used, reserve)
+    recall_message = None
+    recalled = []
+    if reserve:
+        recall_used = 0
+        for turn in recollection.top(skip_recent=kept):
+            cost = count_tokens(turn.content) + MESSAGE_TOKEN_OVERHEAD
+            if recall_used + cost <= reserve:
+                recalled.append(f"{turn.role.capitalize()}: {turn.content}")
+                recall_used += cost
+        if recalled:
+            recall_message = {"role": "system", "content": "Relevant earlier moments:\n" + "\n".join(recalled)}
+            used = with_recent + message_tokens(recall_message)
+        else:
+            used, kept = fit_recent(used, 0)  # nothing relevant; give the room back to recent turns
+    else:
+        used = with_recent
+    dropped = len(history) - kept
+    if not dropped and summary_message:
+        used -= message_tokens(summary_message)
+        summary_message = None
+
+    messages = [system]
+    if summary_message:
+        messages.append(summary_message)
+    if recall_message:
+        messages.append(recall_message)
+    messages.extend(turn.as_message() for turn in history[dropped:])
+    messages.append(user)
+
+    report = {"full_tokens": full, "sent_tokens": used, "kept_turns": kept, "dropped_turns": dropped,
+              "summarized": summary_message is not None,
+              "recalled": len(recalled)}
+    if dropped:
+        schedule_summary_refresh(channel_id, user_id, history[:dropped])
+    return messages, report
+
+def log_context_report(command: str, channel_id: str, report: dict):
+    saved = report["full_tokens"] - report["sent_tokens"]
+    pct = 100 * saved / report["full_tokens"] if report["full_tokens"] else 0
+    logger.info(
+        "%s context in %s: sent %d of %d tokens (saved %d, %.0f%%), %d turns kept, %d dropped, %d recalled%s",
+        command, channel_id, report["sent_tokens"], report["full_tokens"], saved, pct,
+        report["kept_turns"], report["dropped_turns"], report.get("recalled", 0),
+        ", summary used" if report["summarized"] else "",
+    )
+
+def schedule_summary_refresh(channel_id: str, user_id: str, older: list):
+    """Regenerate the rolling summary in the background once enough new turns have been dropped."""
+    if not CONTEXT_SUMMARY:
+        return
+    key = (channel_id, user_id)
+    cached = conversation_summaries.get(key)
+    new_turns = len(older)
+    if cached:
+        # Turn objects are shared, so identity survives trimming and list copies
+        for i in range(len(older) - 1, -1, -1):
+            if older[i] is cached["last"]:
+                new_turns = len(older) - 1 - i
+                break
+    if new_turns < SUMMARY_REFRESH_TURNS:
+        return
+    if any(getattr(t, "summary_key", None) == key for t in summary_tasks):
+        return
+    task = asyncio.get_running_loop().create_task(_refresh_summary(key, list(older), cached))
+    task.summary_key = key
+    summary_tasks.add(task)
+    task.add_done_callback(summary_tasks.discard)
+
+async def _refresh_summary(key, older: list, cached):
+    # newest dropped turns matter most; clip the input so the summary call itself stays within budget
+    lines, used = [], 0
+    for m in reversed(older):
+        line = f"{m.role}: {m.content}"
+        used += count_tokens(line)
+        if used > CONTEXT_TOKEN_BUDGET:
+            break
+        lines.append(line)
+    lines.reverse()
+    previous = f"Existing summary: {cached['text']}\n\n" if cached else ""
+    messages = [
+        {"role": "system", "content": "Summarize the conversation below in under 150 words. Keep names, facts, "
+                                      "preferences and ongoing storylines; drop small talk."},
+        {"role": "user", "content": previous + "\n".join(lines)},
+    ]
+    # summaries count against the channel's AI budget; when it is spent, the next request retries
+    if not ai_scheduler.take_background(int(key[0])):
+        logger.debug("Summary refresh for %s deferred: channel is at its AI rate limit", key)
+        return
+    try:
+        async with ai_scheduler.background():
+            text = await call_ai_api(messages)
     except Exception as e:
-        logger.exception("Unexpected error calling AI API: %s", e)
-        return f"⚠️ Error contacting AI: {e}"
+        logger.warning("Summary refresh for %s failed: %r", key, e)
+        return
+    conversation_summaries[key] = {"text": text, "last": older[-1]}
+    logger.debug("Summary refreshed for %s covering %d turns", key, len(older))
+
+# -------------------- AI SCHEDULER --------------------
+AI_MAX_CONCURRENCY = int(os.getenv("AI_MAX_CONCURRENCY", "4"))  # upstream AI calls in flight at once
+# token buckets as (requests per minute, burst)
+AI_RATE_USER = (6, 3)
+AI_RATE_CHANNEL = (20, 8)
+AI_RATE_GUILD = (60, 20)
+
+class TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, per_minute: float, burst: int):
+        self.rate = per_minute / 60.0
+        self.capacity = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self) -> float:
+        """Seconds until one token is available (0 if one is available now)."""
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+class AIScheduler:
+    """
+    Admission control for the AI commands.
+
+    Requests are rate limited per user, channel and guild with token buckets, then wait
+    in a FIFO queue for one of AI_MAX_CONCURRENCY upstream slots. Requests for the same
+    (channel, user) also run one at a time so their history updates land in order.
+    Background calls (summaries) share the slots but only get one no user is waiting for.
+    """
+
+    def __init__(self, concurrency: int):
+        self.concurrency = concurrency
+        self.running = 0
+        self.waiters = deque()      # futures of requests waiting for a slot, oldest first
+        self.idle_waiters = deque() # futures of background calls, served when waiters is empty
+        self.buckets = {}           # (scope, id) -> TokenBucket
+        self.slot_locks = {}        # (channel_id, user_id) -> [asyncio.Lock, users]
+        self.admitted = 0
+        self.rejected = 0
+        self.queued = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def _buckets_for(self, ctx):
+        scopes = [("user", ctx.author.id, AI_RATE_USER), ("channel", ctx.channel.id, AI_RATE_CHANNEL)]
+        if ctx.guild:
+            scopes.append(("guild", ctx.guild.id, AI_RATE_GUILD))
+        for scope, key, (per_minute, burst) in scopes:
+            bucket = self.buckets.get((scope, key))
+            if bucket is None:
+                bucket = self.buckets[(scope, key)] = TokenBucket(per_minute, burst)
+            yield bucket
+
+    def check_rate(self, ctx) -> float:
+        """Take a token from every bucket, or return the seconds to wait if any is empty."""
+        now = time.monotonic()
+        buckets = list(self._buckets_for(ctx))
+        for bucket in buckets:
+            bucket.refill(now)
+        retry_after = max(bucket.wait_time() for bucket in buckets)
+        if retry_after:
+            self.rejected += 1
+            return retry_after
+        for bucket in buckets:
+            bucket.tokens -= 1
+        if len(self.buckets) > 10000:
+            self._prune(now)
+        return 0.0
+
+    def take_background(self, channel_id: int) -> bool:
+        """Charge a background call to the channel's bucket. Returns False, taking nothing, if it is empty."""
+        bucket = self.buckets.get(("channel", channel_id))
+        if bucket is None:
+            bucket = self.buckets[("channel", channel_id)] = TokenBucket(*AI_RATE_CHANNEL)
+        bucket.refill(time.monotonic())
+        if bucket.wait_time():
+            return False
+        bucket.tokens -= 1
+        return True
+
+    def _prune(self, now: float):
+        # a bucket that has refilled completely holds no state worth keeping
+        for key, bucket in list(self.buckets.items()):
+            bucket.refill(now)
+            if bucket.tokens >= bucket.capacity:
+                del self.buckets[key]
+
+    @contextlib.asynccontextmanager
+    async def slot(self, ctx):
+        """Hold the caller's (channel, user) lock and one upstream slot for the duration of the block."""
+        key = (ctx.channel.id, ctx.author.id)
+        entry = self.slot_locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        started = time.monotonic()
+        try:
+            async with entry[0]:
+                await self._acquire(ctx)
+                waited = time.monotonic() - started
+                record_phase("queue_wait", waited)
+                self.admitted += 1
+                self.wait_total += waited
+                self.wait_max = max(self.wait_max, waited)
+                if waited > 1:
+                    logger.info("AI request from %s waited %.1fs for a slot", ctx.author, waited)
+                try:
+                    yield
+                finally:
+                    self._release()
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                self.slot_locks.pop(key, None)
+
+    async def _acquire(self, ctx):
+        if self.running < self.concurrency and not self.waiters:
+            self.running += 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        self.waiters.append(future)
+        self.queued += 1
+        dispatcher.post(ctx.channel, f"⏳ Lots of questions right now, {ctx.author.mention} — you're #{len(self.waiters)} in line.", notice=True)
+        await self._wait_turn(future, self.waiters)
+
+    @contextlib.asynccontextmanager
+    async def background(self):
+        """Hold one upstream slot at low priority: never ahead of a waiting user request."""
+        if self.running < self.concurrency and not self.waiters and not self.idle_waiters:
+            self.running += 1
+        else:
+            future = asyncio.get_running_loop().create_future()
+            self.idle_waiters.append(future)
+            await self._wait_turn(future, self.idle_waiters)
+        try:
+            yield
+        finally:
+            self._release()
+
+    async def _wait_turn(self, future, waiters: deque):
+        try:
+            await future  # _release hands its slot over by resolving this
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self._release()  # got the slot just as we were cancelled; pass it on
+            elif future in waiters:
+                waiters.remove(future)
+            raise
+
+    def _release(self):
+        for waiters in (self.waiters, self.idle_waiters):
+            while waiters:
+                future = waiters.popleft()
+                if not future.done():
+                    future.set_result(None)
+                    return
+        self.running -= 1
+
+    def stats(self) -> dict:
+        return {
+            "running": self.running,
+            "queue_depth": len(self.waiters),
+            "background_waiting": len(self.idle_waiters),
+            "admitted": self.admitted,
+            "queued": self.queued,
+            "rate_limited": self.rejected,
+            "avg_wait_ms": round(1000 * self.wait_total / self.admitted, 1) if self.admitted else 0.0,
+            "max_wait_ms": round(1000 * self.wait_max, 1),
+        }
+
+
+ai_scheduler = AIScheduler(AI_MAX_CONCURRENCY)
+
+async def check_ai_rate(ctx) -> bool:
+    """Tell the user to slow down and return False when they are over an AI rate limit."""
+    retry_after = ai_scheduler.check_rate(ctx)
+    if retry_after:
+        await dispatcher.send(ctx.channel, f"⏳ Slow down, {ctx.author.mention}! Try again in {retry_after:.0f}s.", notice=True)
+        return False
+    return True
+
+# -------------------- OUTBOUND MESSAGES --------------------
+# token buckets as (messages per minute, burst), matching Discord's send limits
+SEND_RATE_CHANNEL = (60, 5)      # 5 messages per 5s per channel
+SEND_RATE_GLOBAL = (3000, 50)    # 50 requests per second per bot
+SEND_MAX_PAGES = int(os.getenv("SEND_MAX_PAGES", "5"))  # long replies are cut off after this many messages
+SEND_LATENCY_CHANNELS = 200      # channels whose send latency is tracked (LRU)
+
+class Outgoing:
+    __slots__ = ("content", "kwargs", "notice", "future", "queued_at")
+
+    def __init__(self, content, kwargs: dict, notice: bool):
+        self.content = content
+        self.kwargs = kwargs
+        self.notice = notice
+        self.future = asyncio.get_running_loop().create_future()
+        self.queued_at = time.monotonic()
+
+class Outbox:
+    __slots__ = ("items", "bucket", "task")
+
+    def __init__(self):
+        self.items = deque()
+        self.bucket = TokenBucket(*SEND_RATE_CHANNEL)
+        self.task = None
+
+class MessageDispatcher:
+    """
+    The one path for messages the bot posts.
+
+    Sends are queued per channel and posted in order by one worker per channel, which paces
+    itself with token buckets mirroring Discord's limits so bursts wait here instead of
+    running into 429s. Text over 2000 characters is split across messages. Short notices
+    (notice=True) that pile up behind the rate limit go out together as one message.
+    """
+
+    def __init__(self):
+        self.outboxes = {}              # channel id -> Outbox
+        self.global_bucket = TokenBucket(*SEND_RATE_GLOBAL)
+        self.latency = Histogram()      # queued -> posted, all channels
+        self.channel_latency = OrderedDict()  # channel id -> Histogram
+        self.sent = 0
+        self.coalesced = 0
+        self.paginated = 0
+        self.throttled = 0
+        self.failed = 0
+
+    async def send(self, channel, content=None, *, notice: bool = False, **kwargs):
+        """Queue a message for channel and wait until it is posted. Returns the (last) message sent."""
+        return await self._enqueue(channel, content, notice, kwargs)
+
+    def post(self, channel, content=None, *, notice: bool = False, **kwargs):
+        """Queue a message without waiting for it. Failures are logged."""
+        self._enqueue(channel, content, notice, kwargs).add_done_callback(self._log_failure)
+
+    @staticmethod
+    def _log_failure(future):
+        if not future.cancelled() and future.exception() is not None:
+            logger.warning("Could not post message: %s", future.exception())
+
+    def _enqueue(self, channel, content, notice: bool, kwargs: dict):
+        outbox = self.outboxes.get(channel.id)
+        if outbox is None:
+            outbox = self.outboxes[channel.id] = Outbox()
+            if len(self.outboxes) > 10000:
+                self._prune()
+        notice = notice and isinstance(content, str) and not kwargs
+        item = Outgoing(content, kwargs, notice)
+        outbox.items.append(item)
+        if outbox.task is None or outbox.task.done():
+            outbox.task = asyncio.create_task(self._drain(channel, outbox))
+        return item.future
+
+    def sender(self, channel):
+        """A drop-in replacement for channel.send / ctx.send that goes through the dispatcher."""
+        async def send(content=None, **kwargs):
+            return await self.send(channel, content, **kwargs)
+        return send
+
+    def _prune(self):
+        now = time.monotonic()
+        for channel_id, outbox in list(self.outboxes.items()):
+            outbox.bucket.refill(now)
+            if not outbox.items and outbox.bucket.tokens >= outbox.bucket.capacity:
+                del self.outboxes[channel_id]
+
+    async def _drain(self, channel, outbox):
+        while outbox.items:
+            if outbox.items[0].future.done():  # caller went away
+                outbox.items.popleft()
+                continue
+            await self._throttle(outbox.bucket)
+            batch = [outbox.items.popleft()]
+            if batch[0].notice:
+                size = len(batch[0].content)
+                while outbox.items and outbox.items[0].notice and size + 1 + len(outbox.items[0].content) <= DISCORD_MESSAGE_LIMIT:
+                    size += 1 + len(outbox.items[0].content)
+                    batch.append(outbox.items.popleft())
+            try:
+                if len(batch) > 1:
+                    message = await channel.send("\n".join(item.content for item in batch))
+                    self.coalesced += len(batch) - 1
+                else:
+                    message = await self._post(channel, outbox, batch[0])
+            except Exception as e:
+                self.failed += 1
+                for item in batch:
+                    if not item.future.done():
+                        item.future.set_exception(e)
+                continue
+            now = time.monotonic()
+            for item in batch:
+                self._observe(channel.id, now - item.queued_at)
+                if not item.future.done():
+                    item.future.set_result(message)
+
+    async def _post(self, channel, outbox, item):
+        if not isinstance(item.content, str) or len(item.content) <= DISCORD_MESSAGE_LIMIT:
+            self.sent += 1
+            return await channel.send(item.content, **item.kwargs)
+        chunks = split_message(item.content)
+        if len(chunks) > SEND_MAX_PAGES:
+            chunks = chunks[:SEND_MAX_PAGES]
+            chunks[-1] = chunks[-1][:DISCORD_MESSAGE_LIMIT - 20] + "\n… (cut off)"
+        self.paginated += 1
+        for i, chunk in enumerate(chunks):
+            if i:
+                await self._throttle(outbox.bucket)
+            last = i == len(chunks) - 1
+            message = await channel.send(chunk, **(item.kwargs if last else {}))
+            self.sent += 1
+        return message
+
+    async def _throttle(self, bucket):
+        waited = False
+        while True:
+            now = time.monotonic()
+            bucket.refill(now)
+            self.global_bucket.refill(now)
+            wait = max(bucket.wait_time(), self.global_bucket.wait_time())
+            if not wait:
+                break
+            waited = True
+            await asyncio.sleep(wait)
+        bucket.tokens -= 1
+        self.global_bucket.tokens -= 1
+        if waited:
+            self.throttled += 1
+
+    def _observe(self, channel_id: int, seconds: float):
+        self.latency.observe(seconds)
+        histogram = self.channel_latency.get(channel_id)
+        if histogram is None:
+            histogram = self.channel_latency[channel_id] = Histogram()
+            if len(self.channel_latency) > SEND_LATENCY_CHANNELS:
+                self.channel_latency.popitem(last=False)
+        else:
+            self.channel_latency.move_to_end(channel_id)
+        histogram.observe(seconds)
+
+    def stats(self) -> dict:
+        slowest = sorted(self.channel_latency.items(), key=lambda kv: kv[1].percentile(99), reverse=True)[:3]
+        return {
+            "queued": sum(len(outbox.items) for outbox in self.outboxes.values()),
+            "sent": self.sent,
+            "coalesced": self.coalesced,
+            "paginated": self.paginated,
+            "throttled": self.throttled,
+            "failed": self.failed,
+            "p50_ms": round(1000 * self.latency.percentile(50)),
+            "p99_ms": round(1000 * self.latency.percentile(99)),
+            "slowest_p99_ms": {channel_id: round(1000 * h.percentile(99)) for channel_id, h in slowest},
+        }
+
+    def prometheus(self) -> str:
+        lines = ["# TYPE binky_send_seconds histogram"]
+        seen = 0
+        for bound, n in zip(LATENCY_BUCKETS, self.latency.counts):
+            seen += n
+            lines.append(f'binky_send_seconds_bucket{{le="{bound}"}} {seen}')
+        lines.append(f'binky_send_seconds_bucket{{le="+Inf"}} {self.latency.count}')
+        lines.append(f"binky_send_seconds_sum {self.latency.total}")
+        lines.append(f"binky_send_seconds_count {self.latency.count}")
+        lines.append("# TYPE binky_channel_send_seconds summary")
+        for channel_id, histogram in self.channel_latency.items():
+            lines.append(f'binky_channel_send_seconds_sum{{channel="{channel_id}"}} {histogram.total}')
+            lines.append(f'binky_channel_send_seconds_count{{channel="{channel_id}"}} {histogram.count}')
+        lines.append("# TYPE binky_send_throttled_total counter")
+        lines.append(f"binky_send_throttled_total {self.throttled}")
+        return "\n".join(lines) + "\n"
+
+
+dispatcher = MessageDispatcher()
+
+# -------------------- MODERATION --------------------
+MODERATION_FILE = os.getenv("MODERATION_FILE", "moderation.json")
+MODERATION_RELOAD_SECONDS = 30  # how often to check the word list file for changes
+DEFAULT_BANNED_WORDS = ["faggot", "bitch", "nigger", "nigga", "idiot", "tangina", "gago", "bobo"]
+
+# characters commonly swapped in for letters to dodge the filter
+LEET_VARIANTS = {
+    "a": "a4@", "b": "b8", "e": "e3", "g": "g9", "i": "i1!|", "l": "l1|",
+    "o": "o0", "s": "s5$", "t": "t7+", "z": "z2",
+}
+ZERO_WIDTH = "[\u200b\u200c\u200d\u2060\ufeff\u00ad]*"
+
+def compile_banned_words(words):
+    """
+    Compile a word list into one case-insensitive pattern.
+
+    Each letter matches its leetspeak variants repeated any number of times, with zero-width
+    characters allowed in between, so "b1iiitch" or a word split by a zero-width space is
+    caught by the same single regex search instead of normalizing the message first.
+    """
+    alternatives = []
+    for word in sorted({w.strip().lower() for w in words if w and w.strip()}, key=len, reverse=True):
+        letters = []
+        for ch in word:
+            variants = LEET_VARIANTS.get(ch, ch)
+            letters.append(f"[{re.escape(variants)}]+" if len(variants) > 1 else f"{re.escape(ch)}+")
+        alternatives.append(ZERO_WIDTH.join(letters))
+    if not alternatives:
+        return None
+    return re.compile(rf"(?<!\w)(?:{'|'.join(alternatives)})(?!\w)", re.IGNORECASE)
+
+class ModerationFilter:
+    """
+    Banned-word matcher with per-guild word lists.
+
+    MODERATION_FILE (optional) looks like
+        {"banned_words": [...], "guilds": {"<guild id>": [...extra words...]}}
+    and is picked up again without a restart when its mtime changes.
+    """
+
+    def __init__(self, path: str, default_words):
+        self.path = path
+        self.default_words = list(default_words)
+        self.words = list(default_words)
+        self.guild_words = {}
+        self.patterns = {}          # guild id (or None) -> compiled pattern
+        self.mtime = None
+        self.checked_at = 0.0
+
+    def reload(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            self.words = list(data.get("banned_words", self.default_words))
+            self.guild_words = {str(k): list(v) for k, v in (data.get("guilds") or {}).items()}
+            logger.info("Moderation word list loaded from %s (%d guild overrides)", self.path, len(self.guild_words))
+        except FileNotFoundError:
+            self.words, self.guild_words = list(self.default_words), {}
+        except Exception:
+            logger.exception("Failed to load %s; keeping the previous word list.", self.path)
+            return
+        self.patterns = {}
+
+    def maybe_reload(self):
+        now = time.monotonic()
+        if now - self.checked_at < MODERATION_RELOAD_SECONDS:
+            return
+        self.checked_at = now
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            mtime = None
+        if mtime != self.mtime:
+            self.mtime = mtime
+            self.reload()
+
+    def pattern_for(self, guild_id):
+        key = str(guild_id) if guild_id is not None and str(guild_id) in self.guild_words else None
+        if key not in self.patterns:
+            self.patterns[key] = compile_banned_words(self.words + self.guild_words.get(key, []))
+        return self.patterns[key]
+
+    def search(self, guild_id, text: str):
+        """Return the first banned-word match in text, or None."""
+        self.maybe_reload()
+        pattern = self.pattern_for(guild_id)
+        return pattern.search(text) if pattern and text else None
+
+
+moderation = ModerationFilter(MODERATION_FILE, DEFAULT_BANNED_WORDS)
 
 # -------------------- EVENTS --------------------
+startup_logged = False
+
+def log_startup_timing():
+    global startup_logged
+    startup_logged = True
+    mark_startup("connect to READY")
+    breakdown = ", ".join(f"{phase} {seconds:.2f}s" for phase, seconds in startup_phases)
+    logger.info("Startup took %.2fs: %s", time.perf_counter() - STARTUP_STARTED, breakdown)
+
 @bot.event
 async def on_ready():
     logger.info("%s is now online! ✅", bot.user)
-    # attach discord internal logs to our file/console handlers
-    discord_logger = logging.getLogger("discord")
-    discord_logger.setLevel(logging.DEBUG)
-    discord_logger.addHandler(file_handler)
-    discord_logger.addHandler(console_handler)
-    # start autosave
-    bot.loop.create_task(autosave())
+    if not startup_logged:
+        log_startup_timing()
+        # import yt-dlp now, off the loop, so the first *play doesn't pay for it
+        resolver.executor.submit(load_yt_dlp)
+    logger.info("Gateway: %s", gateway_stats.stats())
+    # start autosave once; on_ready fires again after every reconnect
+    global autosave_task
+    if autosave_task is None or autosave_task.done():
+        autosave_task = bot.loop.create_task(autosave())
+
+@bot.event
+async def on_socket_event_type(event_type):
+    gateway_stats.record(event_type)
 
 @bot.event
 async def on_message(message):
@@ -212,11 +2464,12 @@ async def on_message(message):
     content = message.content or ""
     lower = content.lower()
 
-    banned_words = ["faggot", "bitch", "nigger", "nigga", "idiot", "tangina", "gago", "bobo"]
-    if any(re.search(rf"\b{re.escape(word)}\b", lower, re.IGNORECASE) for word in banned_words):
+    if moderation.search(message.guild.id if message.guild else None, content):
         try:
+            scold = f"{message.author.mention}, {random.choice(['you bad bad boy!', 'You dirty boy!', 'tsk tsk, hindi pwede yan!', 'huwag ganun, please!'])}"
             await message.delete()
-            await message.channel.send(f"{message.author.mention}, {random.choice(['you bad bad boy!', 'You dirty boy!', 'tsk tsk, hindi pwede yan!', 'huwag ganun, please!'])}")
+            # only scold once the message is really gone; the send itself needn't hold up on_message
+            dispatcher.post(message.channel, scold, notice=True)
             logger.info("Deleted banned message from %s: %s", message.author, content[:100])
         except discord.Forbidden:
             logger.warning("Missing permission to delete message from %s", message.author)
@@ -224,62 +2477,180 @@ async def on_message(message):
             logger.exception("Failed to delete or notify about banned message.")
         return
 
+    remember_user_message(message)
+
     # simple text triggers
     if lower.startswith("*hello") or lower.startswith("*hey"):
-        await message.channel.send(f"Sup {message.author.mention}!")
+        await dispatcher.send(message.channel, f"Sup {message.author.mention}!", notice=True)
         return
     if lower.startswith("*bye"):
-        await message.channel.send("Bye 👋")
+        await dispatcher.send(message.channel, "Bye 👋", notice=True)
         return
 
     await bot.process_commands(message)
 
 # -------------------- PIN COMMANDS --------------------
+PINS_PER_PAGE = 10
+RECENT_MESSAGE_CHANNELS = 5000  # channels whose latest user message is remembered for *pin
+PIN_CLOCK_SLACK = 10            # seconds between our pin call and the event and pin time Discord reports
+
+def pin_preview(msg) -> str:
+    return (msg.content[:50] + "...") if msg.content and len(msg.content) > 50 else (msg.content or "[embed/attachment]")
+
+class PinIndex:
+    """
+    Cached pin lists per channel, so *pinlist and *unpin don't fetch pins every time.
+
+    Pins are numbered oldest first, so pinning something new doesn't renumber the rest.
+    Our own pin/unpin calls update the cache directly and expect one pins update event
+    each, within PIN_CLOCK_SLACK seconds. Any other pins update event means the pins
+    changed behind our back, and the channel is fetched again on next use. Those events
+    only carry the newest pin's time, which can't show that an older pin was removed.
+    An expected event is still checked against the newest cached pin, so a missed event
+    can't hide someone else's change for long.
+    """
+
+    def __init__(self):
+        # channel id -> [(message id, preview, pinned_at, exact), ...] oldest first; exact is
+        # False while pinned_at is our own clock from a pin we made, not Discord's time
+        self.channels = {}
+        self.expected = {}  # channel id -> deque of monotonic times of our own unconfirmed pin changes
+
+    async def get(self, channel) -> list:
+        pins = self.channels.get(channel.id)
+        if pins is None:
+            messages = [m async for m in channel.pins(limit=None, oldest_first=True)]
+            pins = self.channels[channel.id] = [(m.id, pin_preview(m), m.pinned_at, True) for m in messages]
+        return pins
+
+    def _expect(self, channel_id: int):
+        self.expected.setdefault(channel_id, deque()).append(time.monotonic())
+
+    def added(self, channel_id: int, msg):
+        pins = self.channels.get(channel_id)
+        if pins is not None and all(entry[0] != msg.id for entry in pins):
+            pins.append((msg.id, pin_preview(msg), discord.utils.utcnow(), False))
+            self._expect(channel_id)
+
+    def removed(self, channel_id: int, message_id: int, own: bool = False):
+        """Drop a pin from the cache; own is True when the bot unpinned it itself."""
+        pins = self.channels.get(channel_id)
+        if pins is not None:
+            pins[:] = [entry for entry in pins if entry[0] != message_id]
+            if own:
+                self._expect(channel_id)
+
+    def pins_updated(self, channel_id: int, last_pin):
+        """Handle a pins update event from the gateway; last_pin is the newest pin's time or None."""
+        pins = self.channels.get(channel_id)
+        if pins is None:
+            return
+        pending = self.expected.get(channel_id)
+        cutoff = time.monotonic() - PIN_CLOCK_SLACK
+        while pending and pending[0] < cutoff:
+            pending.popleft()
+        if not pending:
+            current = False  # not one of ours
+        else:
+            pending.popleft()
+            if not pins:
+                current = last_pin is None
+            else:
+                message_id, preview, pinned_at, exact = pins[-1]
+                if exact:
+                    current = last_pin == pinned_at
+                else:
+                    current = last_pin is not None and abs((last_pin - pinned_at).total_seconds()) <= PIN_CLOCK_SLACK
+                    if current:
+                        pins[-1] = (message_id, preview, last_pin, True)
+        if not current:
+            del self.channels[channel_id]
+            self.expected.pop(channel_id, None)
+
+
+pin_index = PinIndex()
+last_user_message = OrderedDict()  # channel id -> latest non-command user message seen in it
+
+def remember_user_message(message):
+    if message.author.bot or (message.content and message.content.startswith(bot.command_prefix)):
+        return
+    last_user_message[message.channel.id] = message
+    last_user_message.move_to_end(message.channel.id)
+    if len(last_user_message) > RECENT_MESSAGE_CHANNELS:
+        last_user_message.popitem(last=False)
+
+@bot.event
+async def on_guild_channel_pins_update(channel, last_pin):
+    pin_index.pins_updated(channel.id, last_pin)
+
+@bot.event
+async def on_raw_message_delete(payload):
+    last = last_user_message.get(payload.channel_id)
+    if last is not None and last.id == payload.message_id:
+        last_user_message.pop(payload.channel_id, None)
+    pin_index.removed(payload.channel_id, payload.message_id)
+
 @bot.command(name="pin")
 async def pin_message(ctx):
-    pinned = False
-    async for msg in ctx.channel.history(limit=50):
-        if msg.id != ctx.message.id and not msg.author.bot and not (msg.content and msg.content.startswith(bot.command_prefix)):
-            try:
-                await msg.pin()
-                await ctx.send(f"Pinned the message above, {ctx.author.mention}! 📌")
-                pinned = True
-            except discord.Forbidden:
-                await ctx.send("I don't have permission to pin messages.")
-            except discord.HTTPException:
-                await ctx.send("Something went wrong while trying to pin.")
-            break
-    if not pinned:
+    # a reply pins the replied-to message; otherwise the latest user message we saw here
+    target = ctx.message.reference.resolved if ctx.message.reference else None
+    if not isinstance(target, discord.Message):
+        target = last_user_message.get(ctx.channel.id)
+    if target is None:
+        # nothing seen since startup; fall back to scanning recent history
+        async for msg in ctx.channel.history(limit=50):
+            if msg.id != ctx.message.id and not msg.author.bot and not (msg.content and msg.content.startswith(bot.command_prefix)):
+                target = msg
+                break
+    if target is None:
         await ctx.send("No suitable user messages found to pin!")
+        return
+    try:
+        await target.pin()
+        pin_index.added(ctx.channel.id, target)
+        await ctx.send(f"Pinned the message above, {ctx.author.mention}! 📌")
+    except discord.Forbidden:
+        await ctx.send("I don't have permission to pin messages.")
+    except discord.HTTPException:
+        await ctx.send("Something went wrong while trying to pin.")
 
 @bot.command(name="pinlist", aliases=["pins"])
-async def list_pins(ctx):
-    pinned_messages = await ctx.channel.pins()
-    if not pinned_messages:
+async def list_pins(ctx, page: int = 1):
+    pins = await pin_index.get(ctx.channel)
+    if not pins:
         await ctx.send("No pinned messages in this channel.")
         return
 
-    response = "**📌 Pinned Messages:**\n"
-    for i, msg in enumerate(pinned_messages, start=1):
-        preview = (msg.content[:50] + "...") if msg.content and len(msg.content) > 50 else (msg.content or "[embed/attachment]")
-        response += f"{i}️⃣ {preview}\n"
-    await ctx.send(response)
+    pages = (len(pins) + PINS_PER_PAGE - 1) // PINS_PER_PAGE
+    page = min(max(page, 1), pages)
+    start = (page - 1) * PINS_PER_PAGE
+    lines = [f"**{i}.** {entry[1]}" for i, entry in enumerate(pins[start:start + PINS_PER_PAGE], start=start + 1)]
+    embed = discord.Embed(title="📌 Pinned Messages", description="\n".join(lines), color=0xE74C3C)
+    footer = f"Page {page}/{pages} • {len(pins)} pins"
+    if page < pages:
+        footer += f" • *pinlist {page + 1} for more"
+    embed.set_footer(text=footer)
+    await ctx.send(embed=embed)
 
 @bot.command(name="unpin")
 async def unpin_message(ctx, number: int = None):
-    pinned_messages = await ctx.channel.pins()
-    if not pinned_messages:
+    pins = await pin_index.get(ctx.channel)
+    if not pins:
         await ctx.send("No pinned messages to unpin.")
         return
 
-    if number is None or number < 1 or number > len(pinned_messages):
+    if number is None or number < 1 or number > len(pins):
         await ctx.send("Please specify a valid message number to unpin (e.g., `*unpin 2`).")
         return
 
-    message_to_unpin = pinned_messages[number - 1]
+    message_id = pins[number - 1][0]
     try:
-        await message_to_unpin.unpin()
+        await ctx.channel.get_partial_message(message_id).unpin()
+        pin_index.removed(ctx.channel.id, message_id, own=True)
         await ctx.send(f"Unpinned message #{number}, {ctx.author.mention}.")
+    except discord.NotFound:
+        pin_index.removed(ctx.channel.id, message_id)
+        await ctx.send("That message isn't pinned anymore.")
     except discord.Forbidden:
         await ctx.send("I don't have permission to unpin messages.")
     except discord.HTTPException:
@@ -287,7 +2658,7 @@ async def unpin_message(ctx, number: int = None):
 
 # -------------------- MUSIC BOT --------------------
 YTDL_OPTIONS = {
-    "format": "bestaudio/best",
+    "format": "bestaudio[acodec=opus]/bestaudio/best",  # Opus streams play without re-encoding
     "noplaylist": True,
     "quiet": True,
     "geo_bypass": True,
@@ -295,13 +2666,647 @@ YTDL_OPTIONS = {
     "nocheckcertificate": True
 }
 
+# playlists are listed without resolving each entry; entries resolve shortly before they play
+YTDL_FLAT_OPTIONS = {
+    "extract_flat": "in_playlist",
+    "noplaylist": False,
+    "quiet": True,
+    "skip_download": True,
+}
+
 FFMPEG_OPTIONS = {
     "before_options": "-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5",
     "options": "-vn"
 }
 
+yt_dlp = None  # imported on first use: it is slow to import and only the music commands need it
+
+def load_yt_dlp():
+    global yt_dlp
+    if yt_dlp is None:
+        import yt_dlp as module
+        yt_dlp = module
+    return yt_dlp
+
+YTDL_WORKERS = int(os.getenv("YTDL_WORKERS", "4"))              # threads dedicated to yt-dlp lookups
+YTDL_CACHE_TTL = int(os.getenv("YTDL_CACHE_TTL", "10800"))      # seconds, used when a URL carries no expiry
+YTDL_CACHE_SIZE = int(os.getenv("YTDL_CACHE_SIZE", "512"))
+YTDL_BATCH_LOOKUPS = max(1, YTDL_WORKERS // 2)  # workers a multi-track *play may use, leaving room for other guilds
+STREAM_EXPIRY_MARGIN = 120  # seconds of slack before a signed stream URL counts as expired
+
+class TrackResolver:
+    """
+    Resolves search queries to stream URLs with yt-dlp.
+
+    Lookups run on a small dedicated thread pool, each thread reusing its own YoutubeDL
+    instance. Results are cached per normalized query until the signed stream URL is about
+    to expire (long enough to play the whole track), and identical lookups that are already
+    running are shared instead of started twice.
+    """
+
+    EXPIRE_RE = re.compile(r"[?&/]expire[=/](\d+)")
+
+    def __init__(self, workers: int, ttl: int, max_entries: int):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ytdl")
+        self.local = threading.local()
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.cache = OrderedDict()  # normalized query -> track dict
+        self.in_flight = {}         # normalized query -> asyncio.Future
+        self.batch_slots = asyncio.Semaphore(YTDL_BATCH_LOOKUPS)
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def normalize(query: str) -> str:
+        if query.startswith(("http://", "https://")):
+            return query.strip()  # video ids are case-sensitive
+        return " ".join(query.lower().split())
+
+    @staticmethod
+    def is_playlist(query: str) -> bool:
+        """A playlist URL with no single video in it; a shared video keeps playing just that video."""
+        if not query.startswith(("http://", "https://")):
+            return False
+        parts = urlsplit(query)
+        if "v" in parse_qs(parts.query) or (parts.hostname or "").endswith("youtu.be"):
+            return False
+        return "list" in parse_qs(parts.query) or any(
+            marker in parts.path for marker in ("/playlist", "/sets/", "/album/"))
+
+    @staticmethod
+    def stub(query: str, title: str = None, duration: int = 0) -> dict:
+        """A queue entry that has no stream URL yet; the player resolves it when it comes up."""
+        return {"query": query, "title": title or query, "url": None, "duration": duration or 0,
+                "codec": None, "expires": 0}
+
+    def _extract_flat(self, url: str) -> dict:
+        ydl = getattr(self.local, "flat_ydl", None)
+        if ydl is None:
+            ydl = self.local.flat_ydl = load_yt_dlp().YoutubeDL(YTDL_FLAT_OPTIONS)
+        return ydl.extract_info(url, download=False)
+
+    async def expand(self, url: str):
+        """List a playlist as (title, stub tracks) without resolving any stream URLs."""
+        started = time.perf_counter()
+        info = await asyncio.get_running_loop().run_in_executor(self.executor, self._extract_flat, url)
+        record_phase("upstream", time.perf_counter() - started)
+        tracks = []
+        for entry in info.get("entries") or []:
+            if not entry:
+                continue  # private or deleted videos
+            page = entry.get("webpage_url") or entry.get("url")
+            if not page:
+                continue
+            if not page.startswith(("http://", "https://")) and entry.get("ie_key") == "Youtube":
+                page = f"https://www.youtube.com/watch?v={page}"
+            tracks.append(self.stub(page, entry.get("title"), entry.get("duration")))
+        return info.get("title") or "playlist", tracks
+
+    async def resolve_into(self, track: dict):
+        """Resolve a stub in place, using at most YTDL_BATCH_LOOKUPS workers across batches."""
+        async with self.batch_slots:
+            if not self.is_fresh(track):
+                track.update(await self.resolve(track["query"]))
+
+    def _extract(self, query: str) -> dict:
+        ydl = getattr(self.local, "ydl", None)
+        if ydl is None:
+            ydl = self.local.ydl = load_yt_dlp().YoutubeDL(YTDL_OPTIONS)
+        target = query if query.startswith(("http://", "https://")) else f"ytsearch:{query}"
+        info = ydl.extract_info(target, download=False)
+        if "entries" in info:
+            info = info["entries"][0]
+        return info
+
+    def _track(self, query: str, info: dict) -> dict:
+        url = info.get("url")
+        match = self.EXPIRE_RE.search(url or "")
+        expires = int(match.group(1)) if match else time.time() + self.ttl
+        return {
+            "query": query,
+            "title": info.get("title", "Unknown title"),
+            "url": url,
+            "duration": info.get("duration") or 0,
+            "codec": info.get("acodec"),
+            "id": info.get("id"),
+            "extractor": info.get("extractor_key"),
+            "expires": expires,
+        }
+
+    @staticmethod
+    def is_fresh(track: dict) -> bool:
+        # the URL has to stay valid for the whole song since FFmpeg reconnects with it
+        return time.time() + track.get("duration", 0) + STREAM_EXPIRY_MARGIN < track.get("expires", 0)
+
+    async def resolve(self, query: str) -> dict:
+        key = self.normalize(query)
+        track = self.cache.get(key)
+        if track and self.is_fresh(track):
+            self.cache.move_to_end(key)
+            self.hits += 1
+            return dict(track)
+        if key in self.in_flight:
+            self.hits += 1
+            shared = self.in_flight[key]
+            try:
+                return dict(await asyncio.shield(shared))
+            except asyncio.CancelledError:
+                if not shared.cancelled():
+                    raise  # we were cancelled ourselves
+                return await self.resolve(query)  # the lookup we joined was cancelled; run our own
+
+        self.misses += 1
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.in_flight[key] = future
+        started = time.perf_counter()
+        try:
+            info = await loop.run_in_executor(self.executor, self._extract, query)
+            record_phase("upstream", time.perf_counter() - started)
+            track = self._track(query, info)
+            self.cache[key] = track
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.max_entries:
+                self.cache.popitem(last=False)
+            future.set_result(track)
+            return dict(track)
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # mark retrieved; waiters still get it
+            raise
+        finally:
+            if not future.done():
+                future.cancel()  # we were cancelled; waiters start their own lookup
+            self.in_flight.pop(key, None)
+
+    def prefetch(self, query: str, delay: float = 0.0):
+        """Refresh a queued track's stream URL in the background, optionally after a delay."""
+        async def run():
+            if delay:
+                await asyncio.sleep(delay)
+            key = self.normalize(query)
+            track = self.cache.get(key)
+            if (track and self.is_fresh(track)) or key in self.in_flight:
+                return
+            try:
+                await self.resolve(query)
+            except Exception as e:
+                logger.warning("Prefetch for %r failed: %s", query, e)
+
+        return asyncio.get_running_loop().create_task(run())
+
+    def stats(self) -> dict:
+        return {"cached": len(self.cache), "in_flight": len(self.in_flight), "hits": self.hits, "misses": self.misses}
+
+
+resolver = TrackResolver(YTDL_WORKERS, YTDL_CACHE_TTL, YTDL_CACHE_SIZE)
+
+MUSIC_IDLE_TIMEOUT = int(os.getenv("MUSIC_IDLE_TIMEOUT", "300"))  # seconds with an empty queue before leaving voice
+MUSIC_HISTORY_SIZE = 20
+MUSIC_QUEUE_LIMIT = int(os.getenv("MUSIC_QUEUE_LIMIT", "200"))  # tracks queued per guild
+PLAYLIST_WARM = 3  # playlist entries resolved right away; the rest resolve just before they play
+
+MUSIC_BITRATE = int(os.getenv("MUSIC_BITRATE", "128"))    # kbps, when FFmpeg has to encode Opus
+MUSIC_VOLUME = float(os.getenv("MUSIC_VOLUME", "1.0"))    # default volume for new players (1.0 = as is)
+MUSIC_OPUS_PASSTHROUGH = os.getenv("MUSIC_OPUS_PASSTHROUGH", "1") == "1"  # copy Opus sources instead of re-encoding
+
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+
+def process_cpu_seconds(pid: int) -> float:
+    """User + system CPU time of a process, from /proc (0.0 where that isn't available)."""
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+    except (OSError, IndexError, ValueError):
+        return 0.0
+
+class AudioStats:
+    """Per-guild playback time and the CPU it cost, recorded as each track's source is cleaned up."""
+
+    def __init__(self):
+        self.lock = threading.Lock()  # sources are cleaned up on the audio player threads
+        self.guilds = {}  # guild id -> {"tracks", "passthrough", "seconds", "ffmpeg_cpu", "player_cpu"}
+
+    def record(self, guild_id: int, seconds: float, ffmpeg_cpu: float, player_cpu: float, passthrough: bool):
+        with self.lock:
+            entry = self.guilds.setdefault(
+                guild_id, {"tracks": 0, "passthrough": 0, "seconds": 0.0, "ffmpeg_cpu": 0.0, "player_cpu": 0.0}
+            )
+            entry["tracks"] += 1
+            entry["passthrough"] += passthrough
+            entry["seconds"] += seconds
+            entry["ffmpeg_cpu"] += ffmpeg_cpu
+            entry["player_cpu"] += player_cpu
+
+    def stats(self) -> dict:
+        with self.lock:
+            entries = list(self.guilds.values())
+        seconds = sum(e["seconds"] for e in entries)
+        cpu = sum(e["ffmpeg_cpu"] + e["player_cpu"] for e in entries)
+        return {
+            "playing": sum(1 for p in players.values() if p.voice and p.voice.is_playing()),
+            "tracks": sum(e["tracks"] for e in entries),
+            "passthrough": sum(e["passthrough"] for e in entries),
+            "ffmpeg_cpu_s": round(sum(e["ffmpeg_cpu"] for e in entries), 1),
+            "player_cpu_s": round(sum(e["player_cpu"] for e in entries), 1),
+            "cpu_per_stream_pct": round(100 * cpu / seconds, 2) if seconds else 0.0,
+            "streams_per_core": round(seconds / cpu) if cpu else None,
+        }
+
+
+audio_stats = AudioStats()
+
+class TrackAudio(discord.FFmpegOpusAudio):
+    """FFmpegOpusAudio that reports its CPU cost (FFmpeg plus the audio player thread) to audio_stats."""
+
+    def __init__(self, source: str, guild_id: int, passthrough: bool, **kwargs):
+        # set before FFmpeg starts: if it fails to, __del__ still runs cleanup()
+        self.guild_id = guild_id
+        self.passthrough = passthrough
+        self.started = time.monotonic()
+        self.accounted = False
+        super().__init__(source, **kwargs)
+
+    def cleanup(self):
+        if not self.accounted:
+            self.accounted = True
+            process = getattr(self, "_process", None)
+            ffmpeg_cpu = process_cpu_seconds(process.pid) if getattr(process, "pid", None) else 0.0
+            # discord.py cleans the source up at the end of its own player thread, which did the sending
+            player_cpu = time.thread_time() if isinstance(threading.current_thread(), discord.player.AudioPlayer) else 0.0
+            audio_stats.record(self.guild_id, time.monotonic() - self.started, ffmpeg_cpu, player_cpu, self.passthrough)
+        super().cleanup()
+
+AUDIO_CACHE_DIR = os.getenv("AUDIO_CACHE_DIR", "")                     # folder for cached Opus files; empty = off
+AUDIO_CACHE_MAX_MB = int(os.getenv("AUDIO_CACHE_MAX_MB", "2048"))
+AUDIO_CACHE_MIN_PLAYS = int(os.getenv("AUDIO_CACHE_MIN_PLAYS", "3"))   # plays before a track gets cached
+AUDIO_CACHE_MAX_SECONDS = 1200                                         # longer tracks (mixes, streams) aren't cached
+AUDIO_CACHE_TRACKED = 10000                                            # uncached tracks whose plays are counted
+
+class AudioCache:
+    """
+    Local Opus files for tracks that keep getting played.
+
+    After AUDIO_CACHE_MIN_PLAYS plays a track is fetched and encoded into AUDIO_CACHE_DIR by
+    a background FFmpeg process, one at a time; later plays read the file instead of the
+    network. Each file's size and SHA-256 are recorded and checked before it is used, and
+    the least recently played files are deleted once the folder passes AUDIO_CACHE_MAX_MB.
+    """
+
+    def __init__(self, folder: str, max_bytes: int, min_plays: int):
+        self.folder = folder
+        self.index_path = os.path.join(folder, "index.json") if folder else ""
+        self.max_bytes = max_bytes
+        self.min_plays = min_plays
+        self.entries = OrderedDict()  # key -> {"title", "size", "sha256", "last_used"}, least recently played first
+        self.plays = OrderedDict()    # key -> play count, for tracks not cached yet
+        self.populating = set()
+        self.tasks = set()
+        self.slots = asyncio.Semaphore(1)
+        self.loaded = False
+        self.hits = 0
+        self.misses = 0
+        self.populated = 0
+        self.evicted = 0
+        self.corrupt = 0
+        self.failed = 0
+
+    @staticmethod
+    def key(track: dict):
+        """Stable file name for a track, or None when yt-dlp gave it no id."""
+        if not track.get("id"):
+            return None
+        return hashlib.sha1(f"{track.get('extractor') or ''}:{track['id']}".encode()).hexdigest()[:24]
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.folder, key + ".opus")
+
+    def load(self):
+        """Read the index, dropping entries whose file is missing or the wrong size. Runs in an executor."""
+        self.loaded = True
+        os.makedirs(self.folder, exist_ok=True)
+        for name in os.listdir(self.folder):
+            if name.endswith(".part"):
+                os.remove(os.path.join(self.folder, name))  # left over from an interrupted download
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except Exception:
+            logger.exception("Failed to read %s; starting with an empty audio cache.", self.index_path)
+            return
+        for key, entry in sorted(data.items(), key=lambda kv: kv[1].get("last_used", 0)):
+            try:
+                if os.path.getsize(self.path(key)) == entry["size"]:
+                    self.entries[key] = entry
+                    continue
+            except OSError:
+                pass
+            self.corrupt += 1
+        logger.info("Audio cache loaded: %d track(s), %.0f MiB", len(self.entries), self.total_bytes() / 2**20)
+
+    def total_bytes(self) -> int:
+        return sum(entry["size"] for entry in self.entries.values())
+
+    def _verify(self, key: str, entry: dict) -> bool:
+        try:
+            return self._digest(self.path(key)) == (entry["size"], entry["sha256"])
+        except OSError:
+            return False
+
+    @staticmethod
+    def _digest(path: str):
+        digest = hashlib.sha256()
+        size = 0
+        with open(path, "rb") as f:
+            head = f.read(4)
+            if head != b"OggS":
+                raise OSError(f"{path} is not an Ogg file")
+            digest.update(head)
+            size += len(head)
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+                size += len(block)
+        return size, digest.hexdigest()
+
+    def _remove(self, key: str):
+        with contextlib.suppress(OSError):
+            os.remove(self.path(key))
+
+    async def _save(self):
+        payload = json.dumps(self.entries, ensure_ascii=False)
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, atomic_write, self.index_path, payload)
+        except Exception:
+            logger.exception("Failed to write %s", self.index_path)
+
+    async def lookup(self, track: dict):
+        """Path of a verified cached file for the track, or None. Counts the play either way."""
+        key = self.key(track) if self.folder else None
+        if key is None:
+            return None
+        loop = asyncio.get_running_loop()
+        if not self.loaded:
+            await loop.run_in_executor(None, self.load)
+        entry = self.entries.get(key)
+        if entry is not None:
+            if await loop.run_in_executor(None, self._verify, key, entry):
+                self.hits += 1
+                entry["last_used"] = time.time()
+                self.entries.move_to_end(key)
+                await self._save()
+                return self.path(key)
+            logger.warning("Cached audio for %s failed its integrity check; dropping it.", track["title"])
+            self.corrupt += 1
+            del self.entries[key]
+            await loop.run_in_executor(None, self._remove, key)
+            await self._save()
+
+        self.misses += 1
+        plays = self.plays[key] = self.plays.get(key, 0) + 1
+        self.plays.move_to_end(key)
+        while len(self.plays) > AUDIO_CACHE_TRACKED:
+            self.plays.popitem(last=False)
+        if (plays >= self.min_plays and key not in self.populating
+                and 0 < track.get("duration", 0) <= AUDIO_CACHE_MAX_SECONDS):
+            self.populating.add(key)
+            task = loop.create_task(self._populate(key, dict(track)))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+        return None
+
+    async def _populate(self, key: str, track: dict):
+        part = self.path(key) + ".part"
+        loop = asyncio.get_running_loop()
+        try:
+            async with self.slots:
+                if not TrackResolver.is_fresh(track):
+                    track.update(await resolver.resolve(track["query"]))
+                if track.get("codec") == "opus":
+                    encode = ["-c:a", "copy"]
+                else:
+                    encode = ["-c:a", "libopus", "-b:a", f"{MUSIC_BITRATE}k", "-ar", "48000", "-ac", "2"]
+                process = await asyncio.create_subprocess_exec(
+                    "ffmpeg", "-nostdin", "-loglevel", "error", *shlex.split(FFMPEG_OPTIONS["before_options"]),
+                    "-i", track["url"], "-vn", "-map_metadata", "-1", *encode, "-f", "opus", "-y", part,
+                    stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE,
+                )
+                try:
+                    _, stderr = await asyncio.wait_for(process.communicate(), timeout=max(120, 2 * track["duration"]))
+                except asyncio.TimeoutError:
+                    process.kill()
+                    await process.wait()
+                    raise
+                if process.returncode != 0:
+                    raise RuntimeError(f"ffmpeg exited with {process.returncode}: {stderr.decode(errors='replace')[-300:]}")
+                size, sha256 = await loop.run_in_executor(None, self._digest, part)
+                await loop.run_in_executor(None, os.replace, part, self.path(key))
+            self.entries[key] = {"title": track["title"], "size": size, "sha256": sha256, "last_used": time.time()}
+            self.plays.pop(key, None)
+            self.populated += 1
+            logger.info("Cached audio for %s (%.1f MiB)", track["title"], size / 2**20)
+            while self.total_bytes() > self.max_bytes and len(self.entries) > 1:
+                old_key, old = self.entries.popitem(last=False)
+                await loop.run_in_executor(None, self._remove, old_key)
+                self.evicted += 1
+                logger.debug("Evicted cached audio for %s", old["title"])
+            await self._save()
+        except Exception as e:
+            self.failed += 1
+            logger.warning("Could not cache audio for %s: %s", track["title"], e)
+            with contextlib.suppress(OSError):
+                await loop.run_in_executor(None, os.remove, part)
+        finally:
+            self.populating.discard(key)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "enabled": bool(self.folder),
+            "tracks": len(self.entries),
+            "mib": round(self.total_bytes() / 2**20, 1),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            "populated": self.populated,
+            "populating": len(self.populating),
+            "evicted": self.evicted,
+            "corrupt": self.corrupt,
+            "failed": self.failed,
+        }
+
+
+audio_cache = AudioCache(AUDIO_CACHE_DIR, AUDIO_CACHE_MAX_MB * 2**20, AUDIO_CACHE_MIN_PLAYS)
+
+async def create_audio_source(track: dict, guild_id: int, volume: float = 1.0):
+    """
+    Build an Opus source for a track. Opus sources are passed through untouched when the
+    volume is unchanged; everything else is encoded to Opus by FFmpeg, with the volume
+    applied as an FFmpeg filter, so no PCM is ever handled in Python. Tracks in the audio
+    cache play from their local file.
+    """
+    options = FFMPEG_OPTIONS["options"]
+    if volume != 1.0:
+        options += f" -af volume={volume:.2f}"
+    cached = await audio_cache.lookup(track)
+    if cached:
+        passthrough = volume == 1.0
+        return TrackAudio(cached, guild_id, passthrough, codec="copy" if passthrough else None,
+                          bitrate=MUSIC_BITRATE, options=options)
+
+    codec = track.get("codec")
+    if not codec or codec == "none":
+        # yt-dlp didn't say; ask ffprobe (discord.py runs it in an executor)
+        try:
+            codec, _ = await TrackAudio.probe(track["url"])
+        except Exception as e:
+            logger.warning("Could not probe codec for %s: %s", track["title"], e)
+            codec = None
+        track["codec"] = codec
+    passthrough = MUSIC_OPUS_PASSTHROUGH and codec == "opus" and volume == 1.0
+    return TrackAudio(
+        track["url"],
+        guild_id,
+        passthrough,
+        codec="copy" if passthrough else None,
+        bitrate=MUSIC_BITRATE,
+        before_options=FFMPEG_OPTIONS["before_options"],
+        options=options,
+    )
+
+class GuildPlayer:
+    """
+    Music state and playback loop for one guild.
+
+    A single task per guild pulls tracks off a deque and waits for the voice client's
+    `after` callback before moving on, so skip/stop/after never race each other over
+    shared globals. Leaves voice after MUSIC_IDLE_TIMEOUT seconds with nothing queued.
+    """
+
+    def __init__(self, guild, channel):
+        self.guild = guild
+        self.channel = channel      # text channel for "Now playing" messages
+        self.queue = deque()
+        self.current = None
+        self.history = deque(maxlen=MUSIC_HISTORY_SIZE)
+        self.loop = False
+        self.volume = MUSIC_VOLUME  # takes effect from the next track
+        self.skip_requested = False
+        self.wakeup = asyncio.Event()
+        self.track_done = asyncio.Event()
+        self.task = asyncio.get_running_loop().create_task(self.player_loop())
+
+    @property
+    def voice(self):
+        return self.guild.voice_client
+
+    def enqueue(self, track: dict):
+        self.queue.append(track)
+        self.wakeup.set()
+
+    def enqueue_many(self, tracks: list) -> list:
+        """Queue as many tracks as MUSIC_QUEUE_LIMIT allows. Returns the ones queued."""
+        accepted = tracks[:max(0, MUSIC_QUEUE_LIMIT - len(self.queue))]
+        self.queue.extend(accepted)
+        if accepted:
+            self.wakeup.set()
+        return accepted
+
+    def discard(self, track: dict):
+        self.queue = deque(t for t in self.queue if t is not track)
+
+    def skip(self):
+        self.skip_requested = True
+        if self.voice:
+            self.voice.stop()  # fires the after callback, which advances the loop
+
+    async def player_loop(self):
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                if self.current is None or not self.loop or self.skip_requested:
+                    if self.current is not None:
+                        self.history.append(self.current)
+                        self.current = None
+                    self.skip_requested = False
+                    if not self.queue:
+                        self.wakeup.clear()
+                        try:
+                            await asyncio.wait_for(self.wakeup.wait(), MUSIC_IDLE_TIMEOUT)
+                        except asyncio.TimeoutError:
+                            logger.info("Leaving voice in guild %s after %ds idle.", self.guild.id, MUSIC_IDLE_TIMEOUT)
+                            return
+                        continue
+                    self.current = self.queue.popleft()
+
+                track = self.current
+                if not TrackResolver.is_fresh(track):
+                    # signed stream URLs expire; a prefetch normally refreshed this already
+                    try:
+                        track.update(await resolver.resolve(track["query"]))
+                    except Exception:
+                        if not track.get("url"):
+                            logger.exception("Could not resolve queued track %s; skipping it.", track["title"])
+                            dispatcher.post(self.channel, f"❌ Couldn't load **{track['title']}**, skipping it.")
+                            self.current = None
+                            continue
+                        logger.exception("Could not refresh stream URL for %s; trying the old one.", track["title"])
+
+                source = await create_audio_source(track, self.guild.id, self.volume)
+                voice = self.voice
+                if voice is None or not voice.is_connected():
+                    source.cleanup()
+                    return
+                self.track_done.clear()
+                voice.play(source, after=lambda e: loop.call_soon_threadsafe(self.track_done.set))
+                if self.queue:
+                    # refresh the next track shortly before this one ends so the transition has no lookup gap
+                    resolver.prefetch(self.queue[0]["query"], delay=max(0, track.get("duration", 0) - 30))
+                embed = discord.Embed(title="🎵 Now playing:", description=track["title"], color=0x1DB954)
+                try:
+                    await dispatcher.send(self.channel, embed=embed)
+                except discord.HTTPException:
+                    logger.warning("Could not announce track in guild %s", self.guild.id)
+                await self.track_done.wait()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Music player for guild %s crashed.", self.guild.id)
+        finally:
+            if players.get(self.guild.id) is self:
+                players.pop(self.guild.id, None)
+            if self.voice:
+                try:
+                    await self.voice.disconnect()
+                except Exception:
+                    logger.exception("Error disconnecting voice client.")
+
+    async def stop(self):
+        self.queue.clear()
+        self.loop = False
+        if players.get(self.guild.id) is self:
+            players.pop(self.guild.id, None)
+        if self.voice:
+            self.voice.stop()
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+
+def get_player(ctx) -> GuildPlayer:
+    player = players.get(ctx.guild.id)
+    if player is None or player.task.done():
+        player = players[ctx.guild.id] = GuildPlayer(ctx.guild, ctx.channel)
+    player.channel = ctx.channel
+    return player
+
 @bot.command(name="play")
 async def play(ctx, *, search: str):
+    """Play a search, a URL, a playlist URL, or several searches separated by | or new lines."""
     if not ctx.author.voice or not ctx.author.voice.channel:
         await ctx.send("You must be in a voice channel to play music!")
         return
@@ -312,67 +3317,64 @@ async def play(ctx, *, search: str):
     elif ctx.voice_client.channel != voice_channel:
         await ctx.voice_client.move_to(voice_channel)
 
-    loop = asyncio.get_running_loop()
-    try:
-        data = await loop.run_in_executor(
-            None,
-            lambda: yt_dlp.YoutubeDL(YTDL_OPTIONS).extract_info(f"ytsearch:{search}", download=False)['entries'][0]
-        )
-    except Exception as e:
-        logger.exception("yt-dlp failed: %s", e)
-        await ctx.send("❌ Could not find that song.")
+    player = get_player(ctx)
+    if len(player.queue) >= MUSIC_QUEUE_LIMIT:
+        await ctx.send(f"🎶 The queue is full ({MUSIC_QUEUE_LIMIT} tracks).")
         return
+    queries = [q.strip() for q in re.split(r"\s*\|\s*|\n", search) if q.strip()]
 
-    url = data.get('url')
-    title = data.get('title', 'Unknown title')
-
-    guild_id = ctx.guild.id
-    queues.setdefault(guild_id, []).append({"title": title, "url": url})
-
-    if not ctx.voice_client.is_playing() and not ctx.voice_client.is_paused() and len(queues[guild_id]) == 1:
-        await play_next(ctx)
-
-    await ctx.send(f"🎶 Added to queue: {title}")
-
-async def play_next(ctx):
-    guild_id = ctx.guild.id
-    if guild_id not in queues or not queues[guild_id]:
-        if ctx.voice_client:
-            try:
-                await ctx.voice_client.disconnect()
-            except Exception:
-                logger.exception("Error disconnecting voice client.")
-        queues.pop(guild_id, None)
-        loop_mode.pop(guild_id, None)
+    if len(queries) == 1 and resolver.is_playlist(queries[0]):
+        try:
+            title, tracks = await resolver.expand(queries[0])
+        except Exception as e:
+            logger.exception("yt-dlp failed to list playlist: %s", e)
+            await ctx.send("❌ Could not load that playlist.")
+            return
+        if not tracks:
+            await ctx.send("❌ That playlist has no playable tracks.")
+            return
+        queued = player.enqueue_many(tracks)
+        for track in queued[:PLAYLIST_WARM]:
+            resolver.prefetch(track["query"])
+        note = f" (queue limit reached, {len(tracks) - len(queued)} left out)" if len(queued) < len(tracks) else ""
+        await ctx.send(f"🎶 Added {len(queued)} tracks from **{title}**{note}", notice=True)
         return
 
-    song = queues[guild_id][0]
-    source = discord.FFmpegPCMAudio(song['url'], **FFMPEG_OPTIONS)
-    ctx.voice_client.play(
-        source,
-        after=lambda e: asyncio.run_coroutine_threadsafe(after_song(ctx), bot.loop)
-    )
-    embed = discord.Embed(title="🎵 Now playing:", description=song['title'], color=0x1DB954)
-    await ctx.send(embed=embed)
+    if len(queries) > 1:
+        # queue placeholders in order right away so the first one can start as soon as it resolves
+        queued = player.enqueue_many([resolver.stub(q) for q in queries])
+        results = await asyncio.gather(*(resolver.resolve_into(track) for track in queued), return_exceptions=True)
+        failed = []
+        for track, result in zip(queued, results):
+            if isinstance(result, Exception):
+                logger.warning("yt-dlp failed for %r: %s", track["query"], result)
+                player.discard(track)
+                failed.append(track["query"])
+        note = f" Couldn't find: {', '.join(failed)}." if failed else ""
+        if len(queued) < len(queries):
+            note += f" Queue limit reached, {len(queries) - len(queued)} left out."
+        await ctx.send(f"🎶 Added {len(queued) - len(failed)} tracks to the queue.{note}", notice=True)
+        return
 
-async def after_song(ctx):
-    guild_id = ctx.guild.id
-    if not ctx.voice_client or not ctx.voice_client.is_connected():
+    try:
+        track = await resolver.resolve(queries[0])
+    except Exception as e:
+        logger.exception("yt-dlp failed: %s", e)
+        await ctx.send("❌ Could not find that song.")
         return
 
-    if not loop_mode.get(guild_id):
-        if queues.get(guild_id):
-            queues[guild_id].pop(0)
-    await play_next(ctx)
+    player.enqueue(track)
+    await ctx.send(f"🎶 Added to queue: {track['title']}", notice=True)
 
 @bot.command(name="queue")
 async def show_queue(ctx):
-    guild_id = ctx.guild.id
-    if not queues.get(guild_id):
+    player = players.get(ctx.guild.id)
+    if not player or (player.current is None and not player.queue):
         await ctx.send("🎶 The queue is empty!")
         return
+    songs = ([player.current] if player.current else []) + list(player.queue)
     response = "**🎵 Current Queue:**\n"
-    for i, song in enumerate(queues[guild_id], start=1):
+    for i, song in enumerate(songs, start=1):
         response += f"{i}. 🎶 {song['title']}\n"
     await ctx.send(response)
 
@@ -392,34 +3394,48 @@ async def resume(ctx):
     else:
         await ctx.send("Music isn’t paused!")
 
+@bot.command(name="volume")
+async def set_volume(ctx, percent: int = None):
+    player = get_player(ctx)
+    if percent is None:
+        await ctx.send(f"🔊 Volume is {player.volume * 100:.0f}%.")
+        return
+    if not 0 <= percent <= 200:
+        await ctx.send("Volume goes from 0 to 200 (e.g., `*volume 50`).")
+        return
+    player.volume = percent / 100
+    await ctx.send(f"🔊 Volume set to {percent}%, starting with the next track.")
+
 @bot.command(name="loop")
 async def toggle_loop(ctx):
-    guild_id = ctx.guild.id
-    loop_mode[guild_id] = not loop_mode.get(guild_id, False)
-    status = "🔁 Loop enabled." if loop_mode[guild_id] else "➡️ Loop disabled."
+    player = get_player(ctx)
+    player.loop = not player.loop
+    status = "🔁 Loop enabled." if player.loop else "➡️ Loop disabled."
     await ctx.send(status)
 
 @bot.command(name="skip")
 async def skip(ctx):
-    if ctx.voice_client and ctx.voice_client.is_playing():
-        ctx.voice_client.stop()
+    player = players.get(ctx.guild.id)
+    if player and ctx.voice_client and ctx.voice_client.is_playing():
+        player.skip()
         await ctx.send("⏭ Skipped the current song!")
     else:
         await ctx.send("No music is playing to skip!")
 
 @bot.command(name="stop")
 async def stop(ctx):
-    guild_id = ctx.guild.id
     if ctx.voice_client:
-        queues[guild_id] = []
-        ctx.voice_client.stop()
-        try:
-            await ctx.voice_client.disconnect()
-        except Exception:
-            logger.exception("Error disconnecting after stop.")
+        player = players.get(ctx.guild.id)
+        if player:
+            await player.stop()
+        else:
+            ctx.voice_client.stop()
+        if ctx.voice_client:
+            try:
+                await ctx.voice_client.disconnect()
+            except Exception:
+                logger.exception("Error disconnecting after stop.")
         await ctx.send("🛑 Stopped music and cleared the queue.")
-        queues.pop(guild_id, None)
-        loop_mode.pop(guild_id, None)
     else:
         await ctx.send("No music is playing to stop!")
 
@@ -445,12 +3461,118 @@ async def set_persona(ctx, *, prompt: str = None):
         return
     channel_key = str(ctx.channel.id)
     user_key = str(ctx.author.id)
-    ensure_user_channel_slot(channel_key, user_key)
-    conversation_memory[channel_key][user_key]["persona"] = prompt
+    set_persona_memory(channel_key, user_key, prompt)
     save_memory()
     await ctx.send(f"✅ Persona set for {ctx.author.name} in this channel: `{prompt}`")
     logger.info("Persona set for %s in channel %s: %s", ctx.author, channel_key, prompt)
 
+# -------------------- RESPONSE CACHE --------------------
+AI_RESPONSE_CACHE = os.getenv("AI_RESPONSE_CACHE", "0") == "1"               # share replies to identical stateless *ask prompts
+AI_RESPONSE_CACHE_TTL = int(os.getenv("AI_RESPONSE_CACHE_TTL", "600"))       # seconds a reply stays reusable
+AI_RESPONSE_CACHE_SIZE = int(os.getenv("AI_RESPONSE_CACHE_SIZE", "500"))
+STATELESS_SYSTEM_PROMPT = "You are a helpful assistant."
+
+class ResponseCache:
+    """
+    Replies to stateless prompts, keyed by the normalized prompt and the configured models.
+
+    Concurrent identical requests are coalesced: the first one calls the AI, the rest wait
+    for its reply. Entries expire after the TTL and the least recently used are dropped
+    past max_entries.
+    """
+
+    def __init__(self, ttl: int, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # key -> (reply, expires)
+        self.inflight = {}            # key -> future resolved with the leader's reply (None on failure)
+        self.hits = 0
+        self.coalesced = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(prompt: str, model: str) -> str:
+        normalized = " ".join(prompt.casefold().split())
+        return hashlib.sha256(f"{model}\0{normalized}".encode()).hexdigest()
+
+    async def get(self, key: str, produce):
+        """
+        Return (reply, fresh). fresh is True when this call ran produce(), which posts its
+        own reply; otherwise the reply came from the cache or a concurrent request and
+        still has to be posted. reply is None only if produce() failed.
+        """
+        entry = self.entries.get(key)
+        if entry is not None:
+            if entry[1] > time.monotonic():
+                self.hits += 1
+                self.entries.move_to_end(key)
+                return entry[0], False
+            del self.entries[key]
+
+        pending = self.inflight.get(key)
+        if pending is not None:
+            reply = await asyncio.shield(pending)
+            if reply is not None:
+                self.coalesced += 1
+                return reply, False
+            # the leader failed; make our own attempt
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self.inflight[key] = future
+        reply = None
+        try:
+            reply = await produce()
+        finally:
+            if self.inflight.get(key) is future:
+                del self.inflight[key]
+            future.set_result(reply)
+        if reply is not None:
+            self.entries[key] = (reply, time.monotonic() + self.ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return reply, True
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.coalesced + self.misses
+        return {
+            "enabled": AI_RESPONSE_CACHE,
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "coalesced": self.coalesced,
+            "misses": self.misses,
+            "hit_rate": round((self.hits + self.coalesced) / lookups, 3) if lookups else 0.0,
+        }
+
+    def prometheus(self) -> str:
+        return (
+            "# TYPE binky_response_cache_total counter\n"
+            f'binky_response_cache_total{{result="hit"}} {self.hits}\n'
+            f'binky_response_cache_total{{result="coalesced"}} {self.coalesced}\n'
+            f'binky_response_cache_total{{result="miss"}} {self.misses}\n'
+        )
+
+
+response_cache = ResponseCache(AI_RESPONSE_CACHE_TTL, AI_RESPONSE_CACHE_SIZE)
+
+async def ask_stateless(ctx, channel_key: str, user_key: str, prompt: str):
+    """Answer an *ask that depends on nothing but the prompt, sharing identical recent replies."""
+    messages = [{"role": "system", "content": STATELESS_SYSTEM_PROMPT}, {"role": "user", "content": prompt}]
+    models = ",".join(backend.model for backend in ai_backends.backends)
+
+    async def produce():
+        async with ai_scheduler.slot(ctx):
+            return await respond_with_ai(ctx, messages, "⚠️ The AI returned an empty response.")
+
+    reply, fresh = await response_cache.get(response_cache.key(prompt, models), produce)
+    if not fresh:
+        for chunk in split_message(reply):
+            await ctx.send(chunk)
+    if reply is not None:
+        append_history(channel_key, user_key, Turn("user", prompt), Turn("assistant", reply))
+        save_memory()
+
 # -------------------- ASK (general AI) --------------------
 @bot.command(name="ask")
 async def ask_ai(ctx, *, prompt: str = None):
@@ -458,34 +3580,33 @@ async def ask_ai(ctx, *, prompt: str = None):
         await ctx.send("🧠 Ask me something! Example: `*ask how do computers think?`")
         return
 
+    if not await check_ai_rate(ctx):
+        return
+
     channel_key = str(ctx.channel.id)
     user_key = str(ctx.author.id)
-    ensure_user_channel_slot(channel_key, user_key)
-
-    persona = conversation_memory[channel_key][user_key].get("persona") or f"{ctx.author.name}'s assistant"
-    history = conversation_memory[channel_key][user_key].get("history", [])
-
-    # Build messages: system persona + entire history (to provide continuous memory) + user message
-    messages = []
-    if persona:
-        messages.append({"role": "system", "content": f"You are {persona}. Respond in that style."})
-    # include the entire stored history (may be trimmed periodically)
-    messages.extend(history)
-    messages.append({"role": "user", "content": prompt})
+    slot = await get_slot(channel_key, user_key, create=True)
+    if AI_RESPONSE_CACHE and not slot.persona and not slot.history:
+        await ask_stateless(ctx, channel_key, user_key, prompt)
+        return
 
-    async with ctx.typing():
-        reply = await call_ai_api(messages)
+    async with ai_scheduler.slot(ctx):
+        persona = slot.persona or f"{ctx.author.name}'s assistant"
+        history = slot.history
 
-    if not reply or not reply.strip():
-        reply = "⚠️ The AI returned an empty response."
+        # Build messages: system persona + as much recent history as fits the token budget
+        # + relevant older turns + user message
+        recollection = await long_memory.recall(channel_key, user_key, prompt)
+        messages, report = build_context(channel_key, user_key, f"You are {persona}. Respond in that style.", history, prompt,
+                                         recollection=recollection)
+        log_context_report("ask", channel_key, report)
 
-    # update and persist history
-    history.append({"role": "user", "content": prompt})
-    history.append({"role": "assistant", "content": reply})
-    conversation_memory[channel_key][user_key]["history"] = history[-HISTORY_MESSAGE_LIMIT:]
-    save_memory()
+        reply = await respond_with_ai(ctx, messages, "⚠️ The AI returned an empty response.")
 
-    await ctx.send(reply[:2000])
+        # update and persist history; a failed request leaves no trace in it
+        if reply is not None:
+            append_history(channel_key, user_key, Turn("user", prompt), Turn("assistant", reply))
+            save_memory()
 
 # -------------------- ROLEPLAY --------------------
 @bot.command(name="roleplay")
@@ -494,30 +3615,28 @@ async def roleplay(ctx, *, message: str = None):
         await ctx.send("🎭 Say something to start roleplaying! Example: `*roleplay Hello there!`")
         return
 
-    channel_key = str(ctx.channel.id)
-    user_key = str(ctx.author.id)
-    ensure_user_channel_slot(channel_key, user_key)
-
-    persona = conversation_memory[channel_key][user_key].get("persona") or "a friendly assistant"
-    history = conversation_memory[channel_key][user_key].get("history", [])
+    if not await check_ai_rate(ctx):
+        return
 
-    messages = [{"role": "system", "content": f"You are {persona}. Stay fully in character and follow the persona's tone and behavior."}]
-    messages.extend(history)
-    messages.append({"role": "user", "content": message})
+    async with ai_scheduler.slot(ctx):
+        channel_key = str(ctx.channel.id)
+        user_key = str(ctx.author.id)
+        slot = await get_slot(channel_key, user_key, create=True)
 
-    async with ctx.typing():
-        reply = await call_ai_api(messages)
+        persona = slot.persona or "a friendly assistant"
+        history = slot.history
 
-    if not reply or not reply.strip():
-        reply = "⚠️ The AI didn’t respond properly."
+        system_prompt = f"You are {persona}. Stay fully in character and follow the persona's tone and behavior."
+        recollection = await long_memory.recall(channel_key, user_key, message)
+        messages, report = build_context(channel_key, user_key, system_prompt, history, message, recollection=recollection)
+        log_context_report("roleplay", channel_key, report)
 
-    # update history and save
-    history.append({"role": "user", "content": message})
-    history.append({"role": "assistant", "content": reply})
-    conversation_memory[channel_key][user_key]["history"] = history[-HISTORY_MESSAGE_LIMIT:]
-    save_memory()
+        reply = await respond_with_ai(ctx, messages, "⚠️ The AI didn’t respond properly.")
 
-    await ctx.send(reply[:2000])
+        # update history and save; a failed request leaves no trace in it
+        if reply is not None:
+            append_history(channel_key, user_key, Turn("user", message), Turn("assistant", reply))
+            save_memory()
 
 # -------------------- ADMIN / UTILITY MEMORY COMMANDS --------------------
 @bot.command(name="forget")
@@ -535,7 +3654,7 @@ async def forget_memory(ctx, target: str = None):
         if not ctx.author.guild_permissions.manage_guild:
             await ctx.send("You need Manage Guild permission to clear all channel memories.")
             return
-        conversation_memory.pop(channel_key, None)
+        forget_channel(channel_key)
         save_memory()
         await ctx.send("🗑️ Cleared all memory for this channel.")
         return
@@ -546,26 +3665,36 @@ async def forget_memory(ctx, target: str = None):
         if not ctx.author.guild_permissions.manage_messages:
             await ctx.send("You need Manage Messages permission to clear another user's memory.")
             return
-        ensure_user_channel_slot(channel_key, str(target_user.id))
-        conversation_memory[channel_key].pop(str(target_user.id), None)
+        forget_slot(channel_key, str(target_user.id))
         save_memory()
         await ctx.send(f"🗑️ Cleared memory for {target_user.mention} in this channel.")
         return
 
     # otherwise clear caller's memory in this channel
     user_key = str(ctx.author.id)
-    ensure_user_channel_slot(channel_key, user_key)
-    conversation_memory[channel_key].pop(user_key, None)
+    forget_slot(channel_key, user_key)
     save_memory()
     await ctx.send("🗑️ I have forgotten your conversation in this channel.")
 
+RECALL_PAGE_SIZE = 5
+
 @bot.command(name="recall")
-async def recall_memory(ctx, limit: int = 10):
-    """Show a short summary of what the bot remembers for you in this channel."""
+async def recall_memory(ctx, *, args: str = ""):
+    """
+    Usage:
+      *recall [N]                       -> your last N remembered messages in this channel
+      *recall search <terms> [page:N]   -> search everything remembered for you here
+    """
     channel_key = str(ctx.channel.id)
     user_key = str(ctx.author.id)
-    ensure_user_channel_slot(channel_key, user_key)
-    history = conversation_memory[channel_key][user_key].get("history", [])
+    words = args.split()
+    if words and words[0].lower() == "search":
+        await search_memory(ctx, channel_key, user_key, words[1:])
+        return
+    limit = int(words[0]) if words and words[0].isdigit() else 10
+
+    slot = await get_slot(channel_key, user_key)
+    history = slot.history if slot else []
     if not history:
         await ctx.send("🧠 I don't remember anything for you in this channel yet.")
         return
@@ -574,16 +3703,208 @@ async def recall_memory(ctx, limit: int = 10):
     recent = history[-limit:]
     formatted = []
     for m in recent:
-        role = m.get("role", "unknown").capitalize()
-        content = m.get("content", "")
+        role = m.role.capitalize()
+        content = m.content
         snippet = content.replace("\n", " ")[:180]
         formatted.append(f"**{role}:** {snippet}")
     await ctx.send("🧾 Recent memory:\n" + "\n".join(formatted))
 
+async def search_memory(ctx, channel_key: str, user_key: str, words: list):
+    page = 1
+    if words and words[-1].lower().startswith("page:") and words[-1][5:].isdigit():
+        page = max(1, int(words.pop()[5:]))
+    terms = re.findall(r"\w+", " ".join(words).lower())
+    if not terms:
+        await ctx.send("🔎 What should I look for? Example: `*recall search dragon castle`")
+        return
+
+    total, rows = await asyncio.get_running_loop().run_in_executor(
+        memory_store.executor, memory_store.search, channel_key, user_key, terms,
+        RECALL_PAGE_SIZE, (page - 1) * RECALL_PAGE_SIZE)
+    if not total:
+        await ctx.send(f"🔎 Nothing in my memory of you here matches `{' '.join(terms)}`.")
+        return
+    pages = (total + RECALL_PAGE_SIZE - 1) // RECALL_PAGE_SIZE
+    if not rows:
+        await ctx.send(f"🔎 There are only {pages} page(s) of results.")
+        return
+    lines = [f"🔎 {total} match(es) for `{' '.join(terms)}` — page {page}/{pages}"]
+    lines += [f"**{role.capitalize()}:** {snippet.replace(chr(10), ' ')}" for role, snippet in rows]
+    if page < pages:
+        lines.append(f"`*recall search {' '.join(terms)} page:{page + 1}` for more")
+    await ctx.send("\n".join(lines))
+
+@bot.command(name="memusage")
+@commands.is_owner()
+async def memory_usage_report(ctx):
+    """Show how much RAM the loaded conversation memory takes (bot owner only)."""
+    usage = memory_usage()
+    stored = await asyncio.get_running_loop().run_in_executor(memory_store.executor, memory_store.count_slots)
+    await ctx.send(
+        f"🧠 {usage['slots']} of {stored} stored slot(s) loaded, {usage['turns']} turns, "
+        f"~{usage['bytes'] / 1024:.1f} KiB ({usage['bytes_per_slot']} bytes/slot)"
+    )
+
 
 
 
+@bot.command(name="stats")
+@commands.is_owner()
+async def show_stats(ctx):
+    """Latency and load numbers for the bot owner."""
+    def ms(seconds):
+        return "inf" if seconds == float("inf") else f"{seconds * 1000:.0f}"
+
+    uptime = int(time.time() - instrumentation.started_at)
+    lag = instrumentation.loop_lag
+    lines = [
+        f"uptime {uptime // 3600}h{uptime % 3600 // 60:02d}m | loop lag p50 <={ms(lag.percentile(50))} ms, "
+        f"p99 <={ms(lag.percentile(99))} ms | {instrumentation.blocked} stall(s)",
+        "",
+        f"{'command':<10} {'n':>5} {'p50':>6} {'p99':>6}  avg wait/upstream/send ms",
+    ]
+    for command, count, p50, p99, phases in instrumentation.summary():
+        parts = "/".join(ms(phases[p]) if p in phases else "-" for p in ("queue_wait", "upstream", "send"))
+        lines.append(f"{command:<10} {count:>5} {ms(p50):>6} {ms(p99):>6}  {parts}")
+    lines.append("")
+    lines.append(f"http    {http_client.stats()}")
+    lines.append(f"ai      {ai_scheduler.stats()}")
+    lines.append(f"models  {ai_backends.stats()}")
+    lines.append(f"replies {response_cache.stats()}")
+    lines.append(f"music   {resolver.stats()}")
+    lines.append(f"audio   {audio_stats.stats()}")
+    lines.append(f"acache  {audio_cache.stats()}")
+    lines.append(f"images  {image_cache.stats()}")
+    lines.append(f"memory  {memory_usage()}")
+    lines.append(f"recall  {long_memory.stats()}")
+    lines.append(f"gateway {gateway_stats.stats()}")
+    lines.append(f"sends   {dispatcher.stats()}")
+    for chunk in split_message("\n".join(lines), DISCORD_MESSAGE_LIMIT - 8):
+        await ctx.send(f"```\n{chunk}\n```")
+
 # -------------------- IMAGE SEARCH COMMAND --------------------
+IMAGE_CACHE_TTL = int(os.getenv("IMAGE_CACHE_TTL", str(24 * 3600)))  # seconds a result batch stays fresh
+IMAGE_CACHE_SIZE = int(os.getenv("IMAGE_CACHE_SIZE", "500"))          # queries kept (LRU)
+IMAGE_CACHE_FILE = os.getenv("IMAGE_CACHE_FILE", "image_cache.json")  # empty string disables persistence
+GOOGLE_DAILY_QUOTA = int(os.getenv("GOOGLE_DAILY_QUOTA", "100"))      # Custom Search free tier
+GOOGLE_QUOTA_RESERVE = int(os.getenv("GOOGLE_QUOTA_RESERVE", "0"))    # calls to hold back from *image
+
+class ImageSearchCache:
+    """
+    Cache of Google image results plus a daily quota counter.
+
+    Each API call fetches up to 10 results for a query; repeat queries rotate through
+    that batch instead of spending another call. The quota day follows Google's reset
+    (midnight Pacific time).
+    """
+
+    def __init__(self, path: str, ttl: int, max_entries: int, daily_quota: int):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.daily_quota = daily_quota
+        self.entries = OrderedDict()  # normalized query -> {"links": [...], "next": int, "expires": float}
+        self.quota_day = None
+        self.calls_today = 0
+        self.calls_saved = 0
+        self.loading = None  # executor future for load()
+
+    @staticmethod
+    def normalize(query: str) -> str:
+        return " ".join(query.lower().split())
+
+    @staticmethod
+    def today() -> str:
+        try:
+            from zoneinfo import ZoneInfo
+            return datetime.datetime.now(ZoneInfo("America/Los_Angeles")).date().isoformat()
+        except Exception:
+            return datetime.datetime.now(datetime.timezone.utc).date().isoformat()
+
+    def _roll_day(self):
+        today = self.today()
+        if today != self.quota_day:
+            self.quota_day, self.calls_today = today, 0
+
+    def ensure_loaded(self):
+        """Start reading the cache file in an executor (once); await the result before using the cache."""
+        if self.loading is None:
+            self.loading = asyncio.get_running_loop().run_in_executor(None, self.load)
+        return self.loading
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            now = time.time()
+            for key, entry in data.get("entries", {}).items():
+                if entry.get("expires", 0) > now:
+                    self.entries[key] = entry
+            self.quota_day = data.get("quota_day")
+            self.calls_today = data.get("calls_today", 0)
+            self.calls_saved = data.get("calls_saved", 0)
+            logger.info("Image cache loaded: %d queries", len(self.entries))
+        except Exception:
+            logger.exception("Failed to load %s; starting with an empty image cache.", self.path)
+
+    def _snapshot(self) -> str:
+        return json.dumps({
+            "entries": self.entries,
+            "quota_day": self.quota_day,
+            "calls_today": self.calls_today,
+            "calls_saved": self.calls_saved,
+        }, ensure_ascii=False)
+
+    async def persist(self):
+        if not self.path:
+            return
+        payload = self._snapshot()
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, atomic_write, self.path, payload)
+        except Exception:
+            logger.exception("Failed to write %s", self.path)
+
+    def next_link(self, query: str, allow_stale: bool = False):
+        """Next cached link for query (None if there is no usable batch; "" if the batch is empty)."""
+        key = self.normalize(query)
+        entry = self.entries.get(key)
+        if entry is None or (entry["expires"] <= time.time() and not allow_stale):
+            return None
+        self.entries.move_to_end(key)
+        self.calls_saved += 1
+        if not entry["links"]:
+            return ""
+        link = entry["links"][entry["next"] % len(entry["links"])]
+        entry["next"] += 1
+        return link
+
+    def store(self, query: str, links: list):
+        key = self.normalize(query)
+        self.entries[key] = {"links": links, "next": 1, "expires": time.time() + self.ttl}
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def quota_left(self) -> int:
+        self._roll_day()
+        return self.daily_quota - GOOGLE_QUOTA_RESERVE - self.calls_today
+
+    def record_call(self):
+        self._roll_day()
+        self.calls_today += 1
+
+    def stats(self) -> dict:
+        return {
+            "cached_queries": len(self.entries),
+            "calls_today": self.calls_today,
+            "quota_left": self.quota_left(),
+            "calls_saved": self.calls_saved,
+        }
+
+
+image_cache = ImageSearchCache(IMAGE_CACHE_FILE, IMAGE_CACHE_TTL, IMAGE_CACHE_SIZE, GOOGLE_DAILY_QUOTA)
 
 @bot.command(name="image")
 async def image_search(ctx, *, query: str = None):
@@ -592,33 +3913,50 @@ async def image_search(ctx, *, query: str = None):
         await ctx.send("❓ Please provide something to search! Example: `*image cute cats`")
         return
 
+    await image_cache.ensure_loaded()
+    link = image_cache.next_link(query)
+    if link is not None:
+        await ctx.send(link or "❌ No image found for that search.")
+        return
+
     # Check API keys first
     if not GOOGLE_API_KEY or not GOOGLE_CSE_ID:
         await ctx.send("⚠️ Google API key or CSE ID is missing. Please set them in your `.env` file.")
         return
 
-    search_url = "https://www.googleapis.com/customsearch/v1"
+    if image_cache.quota_left() <= 0:
+        # out of API calls for today; an expired batch is still better than nothing
+        link = image_cache.next_link(query, allow_stale=True)
+        if link:
+            await ctx.send(link)
+        else:
+            await ctx.send("⏳ I've used up today's image searches. Try again tomorrow!")
+        logger.warning("Google image quota exhausted (%d calls today)", image_cache.calls_today)
+        return
+
     params = {
         "q": query,
         "cx": str(GOOGLE_CSE_ID),
         "key": str(GOOGLE_API_KEY),
         "searchType": "image",
-        "num": 1
+        "num": 10
     }
 
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(search_url, params=params) as resp:
-                if resp.status != 200:
-                    text = await resp.text()
-                    await ctx.send(f"⚠️ Google API error {resp.status}: {text[:150]}")
-                    return
+        image_cache.record_call()
+        async with http_client.get(GOOGLE_SEARCH_URL, params=params) as resp:
+            if resp.status != 200:
+                text = await resp.text()
+                await ctx.send(f"⚠️ Google API error {resp.status}: {text[:150]}")
+                return
 
-                data = await resp.json()
+            data = await resp.json()
 
-        if "items" in data and data["items"]:
-            image_url = data["items"][0]["link"]
-            await ctx.send(image_url)
+        links = [item["link"] for item in data.get("items") or [] if item.get("link")]
+        image_cache.store(query, links)
+        await image_cache.persist()
+        if links:
+            await ctx.send(links[0])
         else:
             await ctx.send("❌ No image found for that search.")
     except Exception as e:
@@ -628,9 +3966,22 @@ async def image_search(ctx, *, query: str = None):
 
 
 # -------------------- RUN --------------------
+mark_startup("module setup")
+
 if __name__ == "__main__":
-    load_memory()
+    if CLUSTER_WORKERS:
+        # migrate/open the store once here so workers don't race on it
+        load_memory()
+        memory_store.close()
+        run_cluster(CLUSTER_WORKERS)
+        log_listener.stop()
+        sys.exit(0)
     try:
-        bot.run(DISCORD_TOKEN, log_level=logging.DEBUG)
+        # logging is already set up above; stop discord.py from adding its own handler
+        bot.run(DISCORD_TOKEN, log_handler=None)
     except Exception as e:
         logger.exception("Bot failed to start: %s", e)
+    finally:
+        save_memory()
+        memory_store.close()
+        log_listener.stop()
@@ -0,0 +1,15 @@
+import os
+import sys
+import tempfile
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, ROOT)
+os.environ.setdefault("LOG_CONSOLE_LEVEL", "WARNING")
+# keep the memory store, logs and caches out of the working tree
+os.chdir(tempfile.mkdtemp(prefix="binky-tests-"))
+
+
+def pytest_sessionfinish(session, exitstatus):
+    main = sys.modules.get("main")
+    if main is not None:
+        main.log_listener.stop()
@@ -0,0 +1,79 @@
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+
+import main
+from conftest import ROOT
+
+# a worker as the launcher starts it, minus the Discord login: run setup_hook, then report
+WORKER = """
+import asyncio, json, sys
+sys.path.insert(0, {root!r})
+import main
+
+async def start():
+    await main.bot._async_setup_hook()
+    await main.bot.setup_hook()
+    await asyncio.sleep(0.5)
+    async with main.http_client.get(f"http://127.0.0.1:{{main.METRICS_PORT}}/metrics") as resp:
+        metrics = resp.status
+    with open(f"cluster/worker-{{main.WORKER_ID}}.json", encoding="utf-8") as f:
+        health = json.load(f)
+    await main.bot.close()
+    return metrics, health
+
+metrics, health = asyncio.run(start())
+main.memory_store.close()
+main.log_listener.stop()
+print("RESULT " + json.dumps({{"bot": type(main.bot).__name__, "shard_ids": main.bot.shard_ids,
+                               "shard_count": main.bot.shard_count, "metrics": metrics, "health": health}}))
+"""
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def test_shard_ranges_cover_every_shard_once():
+    assert main.shard_ranges(10, 3) == [[0, 1, 2, 3], [4, 5, 6], [7, 8, 9]]
+    assert main.shard_ranges(2, 5) == [[0], [1]]
+    for shard_count, workers in ((1, 1), (7, 2), (16, 4), (5, 5)):
+        ranges = main.shard_ranges(shard_count, workers)
+        assert sorted(s for r in ranges for s in r) == list(range(shard_count))
+
+
+def test_worker_env_splits_ports_and_files(monkeypatch):
+    monkeypatch.setenv("CLUSTER_WORKERS", "2")
+    monkeypatch.setenv("METRICS_PORT", "9100")
+    monkeypatch.setenv("GOOGLE_DAILY_QUOTA", "100")
+    monkeypatch.setenv("AUDIO_CACHE_DIR", "audio")
+    monkeypatch.setenv("AUDIO_CACHE_MAX_MB", "1000")
+    ranges = main.shard_ranges(4, 2)
+    envs = [main.worker_env(i, ranges, 4) for i in range(2)]
+    assert [env["SHARD_IDS"] for env in envs] == ["0,1", "2,3"]
+    assert [env["METRICS_PORT"] for env in envs] == ["9100", "9101"]
+    assert envs[0]["LOG_FILE"] != envs[1]["LOG_FILE"]
+    assert envs[0]["IMAGE_CACHE_FILE"] != envs[1]["IMAGE_CACHE_FILE"]
+    assert [env["AUDIO_CACHE_DIR"] for env in envs] == [os.path.join("audio", "worker-0"), os.path.join("audio", "worker-1")]
+    assert all(env["AUDIO_CACHE_MAX_MB"] == "500" for env in envs)
+    assert all(env["GOOGLE_DAILY_QUOTA"] == "50" and "CLUSTER_WORKERS" not in env for env in envs)
+
+
+def test_worker_starts_without_a_token():
+    env = main.worker_env(1, main.shard_ranges(4, 2), 4)
+    env.pop("DISCORD_TOKEN", None)
+    env["METRICS_PORT"] = str(free_port())
+    cwd = tempfile.mkdtemp(prefix="binky-worker-")
+    os.makedirs(os.path.join(cwd, env.get("CLUSTER_DIR", "cluster")))  # the launcher creates it
+    out = subprocess.run([sys.executable, "-c", WORKER.format(root=ROOT)], cwd=cwd, env=env, capture_output=True, text=True, timeout=60)
+    lines = [line for line in out.stdout.splitlines() if line.startswith("RESULT ")]
+    assert lines, out.stderr[-2000:]
+    result = json.loads(lines[0][len("RESULT "):])
+    assert result["bot"] == "BinkyBot" and result["shard_ids"] == [2, 3] and result["shard_count"] == 4
+    assert result["metrics"] == 200
+    assert result["health"]["worker"] == "1" and result["health"]["shards"] == [2, 3]
@@ -0,0 +1,202 @@
+import asyncio
+import time
+
+import pytest
+
+import main
+
+
+class FakeSource:
+    def __init__(self, track):
+        self.url = track["url"]
+        self.title = track["title"]
+        self.cleaned_up = False
+
+    def cleanup(self):
+        self.cleaned_up = True
+
+
+class FakeVoiceClient:
+    """A voice client whose tracks only end when the test says so (or on stop())."""
+
+    def __init__(self):
+        self.connected = True
+        self.played = []
+        self.after = None
+
+    def is_connected(self):
+        return self.connected
+
+    def play(self, source, after=None):
+        self.played.append(source)
+        self.after = after
+
+    def finish(self):
+        after, self.after = self.after, None
+        if after:
+            after(None)
+
+    def stop(self):
+        self.finish()
+
+    async def disconnect(self):
+        self.connected = False
+
+
+class FakeGuild:
+    def __init__(self, guild_id=1):
+        self.id = guild_id
+        self.voice_client = FakeVoiceClient()
+
+
+class FakeDispatcher:
+    def __init__(self):
+        self.posted = []
+
+    async def send(self, channel, content=None, **kwargs):
+        self.posted.append(content or kwargs["embed"].description)
+
+    def post(self, channel, content=None, **kwargs):
+        self.posted.append(content)
+
+
+def track(query, url=None, expires=None):
+    return {"query": query, "title": query, "url": url or f"https://media.example/{query}", "duration": 1,
+            "codec": "opus", "expires": time.time() + 3600 if expires is None else expires}
+
+
+@pytest.fixture
+def music(monkeypatch):
+    """Replace FFmpeg, yt-dlp and Discord around GuildPlayer. Returns (resolved, dispatcher)."""
+    resolved = {}  # query -> track dict or exception to raise
+
+    async def create_audio_source(track, guild_id, volume=1.0):
+        return FakeSource(track)
+
+    async def resolve(query):
+        result = resolved[query]
+        if isinstance(result, Exception):
+            raise result
+        return dict(result)
+
+    dispatcher = FakeDispatcher()
+    monkeypatch.setattr(main, "create_audio_source", create_audio_source)
+    monkeypatch.setattr(main.resolver, "resolve", resolve)
+    monkeypatch.setattr(main.resolver, "prefetch", lambda query, delay=0.0: None)
+    monkeypatch.setattr(main, "dispatcher", dispatcher)
+    monkeypatch.setattr(main, "MUSIC_IDLE_TIMEOUT", 0.2)
+    monkeypatch.setattr(main, "players", {})
+    return resolved, dispatcher
+
+
+async def until(condition, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out waiting for the player"
+        await asyncio.sleep(0.01)
+
+
+def titles(voice):
+    return [source.title for source in voice.played]
+
+
+def test_loop_repeats_until_skipped(music):
+    async def scenario():
+        guild = FakeGuild()
+        voice = guild.voice_client
+        player = main.GuildPlayer(guild, channel=None)
+        player.loop = True
+        player.enqueue(track("a"))
+        player.enqueue(track("b"))
+        await until(lambda: len(voice.played) == 1)
+        voice.finish()
+        await until(lambda: len(voice.played) == 2)
+        assert titles(voice) == ["a", "a"]
+        player.skip()
+        await until(lambda: len(voice.played) == 3)
+        assert titles(voice) == ["a", "a", "b"]
+        assert [t["title"] for t in player.history] == ["a"]
+        await player.stop()
+
+    asyncio.run(scenario())
+
+
+def test_leaves_voice_when_idle(music):
+    async def scenario():
+        guild = FakeGuild()
+        voice = guild.voice_client
+        player = main.players[guild.id] = main.GuildPlayer(guild, channel=None)
+        player.enqueue(track("a"))
+        await until(lambda: voice.played)
+        voice.finish()
+        await asyncio.wait_for(player.task, 2)
+        assert not voice.is_connected()
+        assert guild.id not in main.players
+
+    asyncio.run(scenario())
+
+
+def test_stop_clears_queue_and_disconnects(music):
+    async def scenario():
+        guild = FakeGuild()
+        voice = guild.voice_client
+        player = main.players[guild.id] = main.GuildPlayer(guild, channel=None)
+        player.enqueue_many([track("a"), track("b"), track("c")])
+        await until(lambda: voice.played)
+        await player.stop()
+        assert player.task.cancelled()
+        assert not player.queue
+        assert not voice.is_connected()
+        assert guild.id not in main.players
+        assert titles(voice) == ["a"]
+
+    asyncio.run(scenario())
+
+
+def test_stale_url_is_resolved_again(music):
+    resolved, _ = music
+    resolved["a"] = track("a", url="https://media.example/a?fresh")
+
+    async def scenario():
+        guild = FakeGuild()
+        voice = guild.voice_client
+        player = main.GuildPlayer(guild, channel=None)
+        player.enqueue(track("a", url="https://media.example/a?expired", expires=0))
+        await until(lambda: voice.played)
+        assert voice.played[0].url == "https://media.example/a?fresh"
+        await player.stop()
+
+    asyncio.run(scenario())
+
+
+def test_stale_url_is_kept_when_refresh_fails(music):
+    resolved, _ = music
+    resolved["a"] = RuntimeError("extractor broke")
+
+    async def scenario():
+        guild = FakeGuild()
+        voice = guild.voice_client
+        player = main.GuildPlayer(guild, channel=None)
+        player.enqueue(track("a", url="https://media.example/a?old", expires=0))
+        await until(lambda: voice.played)
+        assert voice.played[0].url == "https://media.example/a?old"
+        await player.stop()
+
+    asyncio.run(scenario())
+
+
+def test_unresolvable_stub_is_skipped(music):
+    resolved, dispatcher = music
+    resolved["gone"] = RuntimeError("video unavailable")
+
+    async def scenario():
+        guild = FakeGuild()
+        voice = guild.voice_client
+        player = main.GuildPlayer(guild, channel=None)
+        player.enqueue_many([main.TrackResolver.stub("gone", "Deleted video"), track("b")])
+        await until(lambda: voice.played)
+        assert titles(voice) == ["b"]
+        assert any("Deleted video" in message for message in dispatcher.posted)
+        await player.stop()
+
+    asyncio.run(scenario())
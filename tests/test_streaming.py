@@ -0,0 +1,134 @@
+import asyncio
+import contextlib
+import json
+import re
+import types
+
+from aiohttp import web
+
+import main
+
+
+def test_split_message_reopens_a_cut_code_block():
+    text = "Here you go:\n```python\n" + "value = compute(value)\n" * 150 + "```\nDone."
+    chunks = main.split_message(text)
+    assert len(chunks) == 2
+    for chunk in chunks:
+        assert len(chunk) <= main.DISCORD_MESSAGE_LIMIT
+        assert len(re.findall(r"^```", chunk, re.MULTILINE)) % 2 == 0
+    assert chunks[0].endswith("\n```")
+    assert chunks[1].startswith("```python\n")
+    assert chunks[1].endswith("Done.")
+
+
+def test_split_message_hard_splits_text_without_spaces():
+    text = "a" * 4500
+    chunks = main.split_message(text)
+    assert len(chunks) == 3
+    assert all(len(chunk) <= main.DISCORD_MESSAGE_LIMIT for chunk in chunks)
+    assert "".join(chunks) == text
+
+
+class FakeMessage:
+    def __init__(self, content):
+        self.content = content
+        self.edits = 0
+
+    async def edit(self, content):
+        self.content = content
+        self.edits += 1
+
+
+class FakeContext:
+    def __init__(self):
+        self.channel = types.SimpleNamespace(id=1)
+        self.sent = []
+
+    async def send(self, content):
+        message = FakeMessage(content)
+        self.sent.append(message)
+        return message
+
+    @contextlib.asynccontextmanager
+    async def typing(self):
+        yield
+
+
+ERROR = object()  # in a stub script: send an SSE error event instead of a delta
+
+
+@contextlib.asynccontextmanager
+async def stub_backend(script, interval=0.0):
+    """Serve one SSE stream per request from script and point the bot's AI backends at it."""
+    async def chat(request):
+        resp = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await resp.prepare(request)
+        await resp.write(b": OPENROUTER PROCESSING\n\n")
+        for item in script:
+            if item is ERROR:
+                event = {"error": {"message": "upstream overloaded"}}
+            else:
+                event = {"choices": [{"delta": {"content": item}}]}
+            await resp.write(f"data: {json.dumps(event)}\n\n".encode())
+            await asyncio.sleep(interval)
+        await resp.write(b"data: [DONE]\n\n")
+        return resp
+
+    app = web.Application()
+    app.router.add_post("/chat/completions", chat)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    saved = main.ai_backends
+    main.ai_backends = main.AIBackendPool(f"stub@http://127.0.0.1:{port}/chat/completions")
+    try:
+        yield
+    finally:
+        main.ai_backends = saved
+        await main.http_client.close()
+        await runner.cleanup()
+
+
+def run_stream(script, interval=0.0):
+    async def scenario():
+        ctx = FakeContext()
+        async with stub_backend(script, interval):
+            reply = await main.stream_reply(ctx, [{"role": "user", "content": "hi"}], "empty")
+        return ctx, reply
+
+    return asyncio.run(scenario())
+
+
+def test_stream_reply_throttles_edits(monkeypatch):
+    monkeypatch.setattr(main, "STREAM_EDIT_INTERVAL", 0.2)
+    words = [f"word{i} " for i in range(20)]
+    ctx, reply = run_stream(words, interval=0.03)
+    assert reply == "".join(words).strip()
+    assert len(ctx.sent) == 1
+    message = ctx.sent[0]
+    assert message.content == reply
+    # 20 deltas over ~0.6s: the first is sent right away, then at most one edit per interval plus the final one
+    assert 1 <= message.edits <= 5
+
+
+def test_stream_reply_rolls_over_at_the_message_limit(monkeypatch):
+    monkeypatch.setattr(main, "STREAM_EDIT_INTERVAL", 0.0)
+    sentence = "The quick brown fox jumps over the lazy dog again. "
+    ctx, reply = run_stream([sentence] * 60)  # ~3000 characters
+    assert reply == (sentence * 60).strip()
+    assert len(ctx.sent) == 2
+    assert all(len(message.content) <= main.DISCORD_MESSAGE_LIMIT for message in ctx.sent)
+    assert " ".join(message.content for message in ctx.sent).split() == reply.split()
+
+
+def test_stream_reply_returns_none_on_a_mid_stream_error(monkeypatch):
+    monkeypatch.setattr(main, "STREAM_EDIT_INTERVAL", 0.0)
+    ctx, reply = run_stream(["Hello ", "there, ", ERROR, "never shown"])
+    assert reply is None
+    assert len(ctx.sent) == 1
+    shown = ctx.sent[0].content
+    assert shown.startswith("Hello there,")
+    assert "upstream overloaded" in shown
+    assert "never shown" not in shown